@@ -0,0 +1,115 @@
+import logging
+from pathlib import Path
+
+import duckdb
+
+from src.logs import setup_logging
+from src.partitioned import N_BUCKETS, sql_path, write_partitioned
+
+log_file = "process_log.log"
+
+# Setup logging
+setup_logging(log_file)
+
+# Explicit schema of the authors snapshot: the fields the table is built from
+AUTHOR_COLUMNS = {
+    "id": "VARCHAR",
+    "display_name": "VARCHAR",
+    "orcid": "VARCHAR",
+    "works_count": "BIGINT",
+    "cited_by_count": "BIGINT",
+    "summary_stats": 'STRUCT("2yr_mean_citedness" DOUBLE, h_index BIGINT, i10_index BIGINT)',
+    "affiliations": "STRUCT(institution STRUCT(id VARCHAR, country_code VARCHAR), years BIGINT[])[]",
+    # older snapshots have a single last_known_institution, newer ones a list
+    "last_known_institution": "STRUCT(id VARCHAR, country_code VARCHAR)",
+    "last_known_institutions": "STRUCT(id VARCHAR, country_code VARCHAR)[]",
+    "counts_by_year": "STRUCT(year BIGINT, works_count BIGINT, cited_by_count BIGINT)[]",
+    "created_date": "DATE",
+    "updated_date": "TIMESTAMP",
+}
+
+FEATURES_QUERY = """
+SELECT
+    id,
+    display_name,
+    orcid,
+    works_count,
+    cited_by_count,
+    summary_stats.h_index AS h_index,
+    summary_stats.i10_index AS i10_index,
+    summary_stats."2yr_mean_citedness" AS two_yr_mean_citedness,
+    coalesce(last_known_institutions[1].id, last_known_institution.id) AS last_known_institution_id,
+    coalesce(
+        last_known_institutions[1].country_code, last_known_institution.country_code
+    ) AS last_known_country_code,
+    list_distinct(list_transform(affiliations, a -> a.institution.id)) AS institution_ids,
+    list_min(flatten(list_transform(affiliations, a -> a.years))) AS first_affiliation_year,
+    list_max(flatten(list_transform(affiliations, a -> a.years))) AS last_affiliation_year,
+    list_min(list_transform(
+        list_filter(counts_by_year, c -> c.works_count > 0), c -> c.year
+    )) AS first_counted_work_year,
+    counts_by_year,
+    created_date,
+    updated_date
+FROM read_json(
+    '{files}', format = 'newline_delimited', compression = 'gzip', columns = {{{columns}}},
+    ignore_errors = true
+)
+-- malformed records are skipped, as in the other stages
+WHERE id IS NOT NULL
+"""
+
+
+def build_author_features(
+    output_dir,
+    input_dir=Path("data/snapshot/openalex-snapshot/data/authors"),
+    n_buckets=N_BUCKETS,
+    threads=None,
+):
+    """
+    Extract a typed, columnar table of the commonly needed author fields
+    (counts, summary stats, last known institution, affiliation years,
+    counts_by_year) in a single scan of the authors snapshot. It is written as a
+    Parquet dataset bucketed by author ID like the other per-author outputs
+    (bucket=B/..., see src/partitioned.py), so later sampling and matching steps
+    can query it instead of rescanning the JSON.
+    output_dir: Directory of the dataset; replaced atomically when the scan succeeds.
+    n_buckets: Number of author buckets.
+    threads: DuckDB threads; defaults to all cores.
+    """
+    output_dir = Path(output_dir)
+    files = sql_path(Path(input_dir) / "**" / "*.gz")
+    columns = ", ".join(f"'{name}': '{kind}'" for name, kind in AUTHOR_COLUMNS.items())
+    query = FEATURES_QUERY.format(files=files, columns=columns)
+
+    conn = duckdb.connect(database=":memory:")
+    if threads:
+        conn.execute(f"SET threads = {int(threads)}")
+    logging.info(f"Building author features from {input_dir}")
+    # built next to the target and swapped in only when complete
+    total = write_partitioned(conn, query, output_dir, author_col="id", n_buckets=n_buckets)
+    conn.close()
+
+    logging.info(f"Author features for {total} authors saved to {output_dir}")
+    return total
+
+
+def query_author_features(features_dir, sql, params=None):
+    """
+    Run a query over the author features table, exposed as the view "authors".
+    Filters on bucket only read the matching partitions; to read given authors,
+    use src.partitioned.read_partitioned(features_dir, author_ids=...).
+    """
+    conn = duckdb.connect(database=":memory:")
+    files = sql_path(Path(features_dir) / "**" / "*.parquet")
+    conn.execute(
+        f"CREATE VIEW authors AS SELECT * FROM read_parquet('{files}', hive_partitioning = true)"
+    )
+    result = conn.execute(sql, params or []).df()
+    conn.close()
+    return result
+
+
+# Example
+if __name__ == "__main__":
+    build_author_features(Path("data/author_features"))
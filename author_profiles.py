@@ -0,0 +1,265 @@
+import logging
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import scipy.sparse as sp
+
+from get_and_clean_topics import build_dimension, dimension_keys, dimensions_dir, load_dimension
+from src.batches import author_ids_column, id_numbers, iter_line_batches, parse_batch
+from src.chunking import chunk_output_path, plan_chunks
+from src.id_lists import contains, load_id_numbers
+from src.ledger import LEDGER_FILE, atomic_dir, atomic_path, record_output, remove_stale_dirs
+from src.logs import line_warning, setup_logging
+from src.task_runner import STATUS_FILE, run_tasks
+
+log_file = "process_log.log"
+
+# Setup logging
+setup_logging(log_file)
+
+MAX_RETRIES = 4
+# Counter rows a worker keeps in memory before spilling them to disk
+SPILL_ROWS = 5_000_000
+
+# Only the fields the profiles are built from
+PROFILE_SCHEMA = pa.schema(
+    [
+        ("publication_year", pa.int64()),
+        ("authorships", pa.list_(pa.struct([("author", pa.struct([("id", pa.string())]))]))),
+        ("primary_topic", pa.struct([("id", pa.string())])),
+        ("primary_location", pa.struct([("source", pa.struct([("id", pa.string())]))])),
+    ]
+)
+
+# Profile kind -> (dimension entity, key column)
+PROFILES = {
+    "topic": ("topics", "topic_key"),
+    "source": ("sources", "source_key"),
+}
+
+
+def parse_lines(lines):
+    """
+    Parse a batch of raw lines, dropping malformed records one by one if the batch
+    as a whole does not parse.
+    """
+    try:
+        return parse_batch(lines, PROFILE_SCHEMA)
+    except pa.ArrowInvalid as e:
+        logging.warning(f"Batch parse failed, parsing lines one by one: {e}")
+    tables = []
+    for line in lines:
+        try:
+            tables.append(parse_batch([line], PROFILE_SCHEMA))
+        except pa.ArrowInvalid as e:
+            line_warning("invalid JSON", e, line)
+    return pa.concat_tables(tables) if tables else PROFILE_SCHEMA.empty_table()
+
+
+def batch_counts(table, valid_authors, dims_dir):
+    """
+    (author, year, key) counts of one batch for every profile kind.
+    Authors are keyed by the numeric part of their ID, topics and sources by
+    their dense dimension key.
+    valid_authors: Sorted array of the author numbers to keep, or None for all.
+    """
+    author_ids, row_indices = author_ids_column(table)
+    authors = id_numbers(author_ids).to_numpy(zero_copy_only=False)
+    row_indices = row_indices.to_numpy()
+    years = table.column("publication_year").to_numpy(zero_copy_only=False)[row_indices]
+
+    keep = ~np.isnan(authors.astype(float)) & ~np.isnan(years.astype(float))
+    if valid_authors is not None:
+        keep[keep] = contains(valid_authors, authors[keep].astype(np.int64))
+
+    ids_per_kind = {
+        "topic": pc.struct_field(table.column("primary_topic"), "id"),
+        "source": pc.struct_field(
+            pc.struct_field(table.column("primary_location"), "source"), "id"
+        ),
+    }
+    counts = {}
+    for kind, (entity, key_col) in PROFILES.items():
+        ids = ids_per_kind[kind].to_numpy(zero_copy_only=False)
+        keys = dimension_keys(entity, ids, dims_dir)[row_indices]
+        rows = keep & (keys >= 0)
+        frame = pd.DataFrame(
+            {
+                "author_id": authors[rows].astype(np.int64),
+                "year": years[rows].astype(np.int16),
+                key_col: keys[rows].astype(np.int32),
+            }
+        )
+        counts[kind] = frame.value_counts(sort=False).rename("n").reset_index()
+    return counts
+
+
+def reduce_counts(frames, key_col):
+    frame = pd.concat(frames, ignore_index=True)
+    return frame.groupby(["author_id", "year", key_col], sort=False)["n"].sum().reset_index()
+
+
+def process_local_file(
+    input_file, input_dir, spill_dir, valid_authors, dims_dir, chunk=None, spill_rows=SPILL_ROWS
+):
+    """
+    Stream one works file (or chunk of it) and count (author, year, topic) and
+    (author, year, source) occurrences. Counters are reduced and spilled to
+    Parquet whenever they grow past spill_rows, so memory stays bounded however
+    large the file is. The spill files of a task are written into their own
+    directory that only appears once the task has finished.
+    """
+    relative_path = Path(input_file).relative_to(input_dir).with_suffix("")
+    task_dir = chunk_output_path(spill_dir / relative_path, chunk)
+    if task_dir.exists():
+        logging.info(f"File already processed: {task_dir}")
+        return
+
+    pending = {kind: [] for kind in PROFILES}
+    pending_rows = {kind: 0 for kind in PROFILES}
+    parts = {kind: 0 for kind in PROFILES}
+    with atomic_dir(task_dir) as tmp_dir:
+
+        def spill(kind):
+            key_col = PROFILES[kind][1]
+            counts = reduce_counts(pending[kind], key_col)
+            counts.to_parquet(tmp_dir / f"{kind}.part{parts[kind]:03d}.parquet", index=False)
+            parts[kind] += 1
+            pending[kind] = []
+            pending_rows[kind] = 0
+
+        for lines in iter_line_batches(input_file, chunk=chunk):
+            counts = batch_counts(parse_lines(lines), valid_authors, dims_dir)
+            for kind, frame in counts.items():
+                pending[kind].append(frame)
+                pending_rows[kind] += len(frame)
+                if pending_rows[kind] >= spill_rows:
+                    spill(kind)
+        for kind in PROFILES:
+            if pending[kind]:
+                spill(kind)
+    logging.info(f"Processed file: {input_file}")
+
+
+def merge_profiles(spill_dir, output_dir):
+    """
+    Sum the spilled counters of all tasks into one Parquet file per profile kind:
+    author_<kind>_profiles.parquet with columns author_id, year, <kind>_key, n.
+    Only the spill directories of finished tasks are read: the temporary
+    directories of killed tasks (names starting with a dot) would count their
+    records twice.
+    """
+    remove_stale_dirs(spill_dir)
+    conn = duckdb.connect(database=":memory:")
+    totals = {}
+    for kind, (_, key_col) in PROFILES.items():
+        output_file = output_dir / f"author_{kind}_profiles.parquet"
+        paths = [
+            path
+            for path in sorted(spill_dir.rglob(f"{kind}.part*.parquet"))
+            if not any(part.startswith(".") for part in path.relative_to(spill_dir).parts)
+        ]
+        if not paths:
+            logging.warning(f"No {kind} counts to merge")
+            continue
+        files = ", ".join("'" + str(path).replace("'", "''") + "'" for path in paths)
+        with atomic_path(output_file) as tmp:
+            conn.execute(
+                f"""
+                COPY (
+                    SELECT author_id, year, {key_col}, CAST(SUM(n) AS BIGINT) AS n
+                    FROM read_parquet([{files}])
+                    GROUP BY author_id, year, {key_col}
+                    ORDER BY author_id, year, {key_col}
+                ) TO '{str(tmp)}' (FORMAT parquet, COMPRESSION zstd)
+                """
+            )
+            totals[kind] = conn.execute(
+                f"SELECT COUNT(*) FROM read_parquet('{str(tmp)}')"
+            ).fetchone()[0]
+        record_output(output_dir / LEDGER_FILE, output_file, totals[kind])
+        logging.info(f"Saved {totals[kind]} {kind} profile rows to {output_file}")
+    conn.close()
+    return totals
+
+
+def build_profiles(
+    output_dir,
+    input_dir=Path("data/snapshot/openalex-snapshot/data/works"),
+    valid_ids_path=None,
+    id_col="id",
+    dims_dir=dimensions_dir,
+    split=True,
+    spill_rows=SPILL_ROWS,
+):
+    """
+    Per-author, per-year topic and venue profiles in a single streaming pass over
+    the works files.
+    valid_ids_path: List of the author IDs to profile (default: every author).
+    dims_dir: Directory of the topics/sources dimension tables; they are built
+    first if missing or stale (see get_and_clean_topics.py).
+    spill_rows: Counter rows each worker keeps in memory before spilling.
+    """
+    output_dir = Path(output_dir)
+    spill_dir = output_dir / "spill"
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    # spill directories of tasks killed in a previous run
+    remove_stale_dirs(spill_dir)
+    for entity, _ in PROFILES.values():
+        build_dimension(entity, dims_dir)
+
+    valid_authors = None
+    if valid_ids_path is not None:
+        _, valid_authors = load_id_numbers(valid_ids_path, id_col)
+        logging.info(f"Profiling {len(valid_authors)} authors")
+
+    input_dir = Path(input_dir)
+    all_files = list(input_dir.rglob("*.gz"))
+    tasks = plan_chunks(all_files) if split else [(file, None) for file in all_files]
+
+    failed = run_tasks(
+        process_local_file,
+        {
+            (file, chunk): (file, input_dir, spill_dir, valid_authors, dims_dir, chunk, spill_rows)
+            for file, chunk in tasks
+        },
+        status_file=spill_dir / STATUS_FILE,
+        max_retries=MAX_RETRIES,
+    )
+    if failed:
+        raise RuntimeError(f"{len(failed)} files failed, not merging profiles")
+    return merge_profiles(spill_dir, output_dir)
+
+
+def profile_matrix(profile_file, kind, min_year=None, max_year=None, dims_dir=dimensions_dir):
+    """
+    Load a profile as a sparse author x key matrix of counts, summed over the
+    selected years. Column j is the entity with dense dimension key j.
+    kind: "topic" or "source".
+    Returns (matrix, author_ids), where author_ids[i] is the author number of row i.
+    """
+    entity, key_col = PROFILES[kind]
+    filters = []
+    if min_year is not None:
+        filters.append(("year", ">=", min_year))
+    if max_year is not None:
+        filters.append(("year", "<=", max_year))
+    profile = pd.read_parquet(profile_file, filters=filters or None)
+    author_ids, rows = np.unique(profile["author_id"].to_numpy(), return_inverse=True)
+    n_keys = len(load_dimension(entity, dims_dir))
+    matrix = sp.csr_matrix(
+        (profile["n"].to_numpy(), (rows, profile[key_col].to_numpy())),
+        shape=(len(author_ids), n_keys),
+    )
+    # duplicate (row, column) pairs from different years are summed
+    matrix.sum_duplicates()
+    return matrix, author_ids
+
+
+# Example
+if __name__ == "__main__":
+    build_profiles(Path("data/profiles"), valid_ids_path="data/ids/allAcademics202501.csv")
@@ -0,0 +1,249 @@
+import argparse
+import csv
+import gzip
+import logging
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import orjson
+import pandas as pd
+
+from src.ledger import atomic_path
+from src.logs import log_queue, setup_logging, worker_logging
+from src.metrics import peak_rss
+from src.synthetic_snapshot import generate_snapshot
+
+# Local Directories
+benchmark_dir = Path("data/benchmarks")
+log_file = "process_log.log"
+
+# Setup logging
+setup_logging(log_file)
+
+# Number of works of each benchmark scale
+SCALES = (1_000, 10_000, 100_000)
+# Share of the authors in the valid ID list the scans filter on
+VALID_SHARE = 0.1
+RESULTS_FILE = "results.jsonl"
+
+
+def snapshot_for(scale, seed, output_dir=benchmark_dir):
+    """
+    Synthetic snapshot of a scale, generated once and reused while its
+    parameters do not change. Also writes the list of valid author IDs.
+    """
+    snapshot_dir = Path(output_dir) / f"snapshot_{scale}_{seed}"
+    params_file = snapshot_dir / "_params.json"
+    params = {"scale": scale, "seed": seed, "valid_share": VALID_SHARE}
+    if params_file.exists() and orjson.loads(params_file.read_bytes()) == params:
+        return snapshot_dir
+    if snapshot_dir.exists():
+        shutil.rmtree(snapshot_dir)
+    n_authors = max(1, scale // 3)
+    generate_snapshot(snapshot_dir, scale, n_authors, seed=seed, n_parts=max(2, scale // 2_000))
+    rng = np.random.default_rng(seed)
+    valid = rng.choice(np.arange(1, n_authors + 1), size=max(1, int(n_authors * VALID_SHARE)), replace=False)
+    with atomic_path(snapshot_dir / "valid_ids.csv") as tmp:
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id"])
+            writer.writerows([f"https://openalex.org/A{n}"] for n in sorted(valid))
+    params_file.write_bytes(orjson.dumps(params))
+    return snapshot_dir
+
+
+def works_parts(snapshot_dir):
+    return sorted((Path(snapshot_dir) / "data" / "works").rglob("*.gz"))
+
+
+def read_lines(parts):
+    lines = []
+    for part in parts:
+        with gzip.open(part, "rt", encoding="utf-8") as f:
+            lines.extend(f)
+    return lines
+
+
+def citation_targets(lines, share=VALID_SHARE):
+    """
+    work_id_list as get_citations_for_each_work builds it, for a sample of the
+    works: the IDs published up to each year.
+    """
+    works = []
+    for line in lines[:: max(1, int(1 / share))]:
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            continue
+        works.append((record["id"], record["publication_year"]))
+    return {year: {w for w, y in works if y <= year} for year in range(2001, 2026)}
+
+
+# Benchmarks. Each runs in a fresh worker process, so its peak memory is its
+# own, and returns the number of records it processed.
+
+
+def bench_process_scopes(snapshot_dir, work_dir, batched=False):
+    import process_scopes
+    from src.id_lists import load_ids
+
+    valid_ids = load_ids(Path(snapshot_dir) / "valid_ids.csv")
+    process_scopes.output_dir = Path(work_dir)
+    folder_name = "scopes_batched" if batched else "scopes"
+    records = 0
+    for part in works_parts(snapshot_dir):
+        # parts of different updated_date partitions share names
+        part_folder = f"{folder_name}/{part.parent.name}"
+        metrics = process_scopes.process_local_file(part, valid_ids, part_folder, batched)
+        records += metrics["records_read"]
+    return records
+
+
+def bench_process_scopes_batched(snapshot_dir, work_dir):
+    return bench_process_scopes(snapshot_dir, work_dir, batched=True)
+
+
+def bench_pick_line(snapshot_dir, work_dir):
+    from get_relevant_works import pick_line
+    from src.id_lists import load_ids
+
+    valid_ids = load_ids(Path(snapshot_dir) / "valid_ids.csv")
+    lines = read_lines(works_parts(snapshot_dir))
+    start = time.perf_counter()
+    for line in lines:
+        try:
+            pick_line(line, valid_ids)
+        except Exception:
+            pass
+    return len(lines), time.perf_counter() - start
+
+
+def bench_citations_process_line(snapshot_dir, work_dir):
+    from get_citations_for_each_work import process_line
+
+    lines = read_lines(works_parts(snapshot_dir))
+    work_id_list = citation_targets(lines)
+    start = time.perf_counter()
+    for line in lines:
+        process_line(line, work_id_list)
+    return len(lines), time.perf_counter() - start
+
+
+def bench_juntator(snapshot_dir, work_dir):
+    import juntator
+
+    # the scopes written by the process_scopes benchmark, one folder per partition
+    records = 0
+    for input_dir in sorted((Path(work_dir) / "scopes").iterdir()):
+        output_dir = Path(work_dir) / "aggregated" / input_dir.name
+        output_dir.mkdir(parents=True, exist_ok=True)
+        juntator.aggregate_all(input_dir, output_dir)
+        for file in input_dir.rglob("*.csv"):
+            with open(file, encoding="utf-8") as f:
+                records += sum(1 for _ in f) - 1
+    return records
+
+
+# name -> function; juntator reads the outputs of process_scopes
+BENCHMARKS = {
+    "process_scopes": bench_process_scopes,
+    "process_scopes_batched": bench_process_scopes_batched,
+    "pick_line": bench_pick_line,
+    "citations_process_line": bench_citations_process_line,
+    "juntator": bench_juntator,
+}
+
+
+def measure(name, snapshot_dir, work_dir):
+    """
+    Run a benchmark in this process. Benchmarks that load their input first
+    return their own timing of the part being measured.
+    """
+    baseline = peak_rss()
+    start = time.perf_counter()
+    result = BENCHMARKS[name](snapshot_dir, work_dir)
+    seconds = time.perf_counter() - start
+    records, seconds = result if isinstance(result, tuple) else (result, seconds)
+    return {"records": records, "seconds": seconds, "peak_rss_bytes": peak_rss(), "baseline_rss_bytes": baseline}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales=SCALES, names=tuple(BENCHMARKS), repeat=3, seed=0, output_dir=benchmark_dir):
+    """
+    Run the benchmarks at each scale, repeat times each, and append the results
+    to output_dir/results.jsonl, tagged with the git commit so runs of different
+    versions can be compared. Returns the results as a DataFrame.
+    """
+    output_dir = Path(output_dir)
+    commit = git_commit()
+    results = []
+    for scale in scales:
+        snapshot_dir = snapshot_for(scale, seed, output_dir)
+        for run in range(repeat):
+            work_dir = output_dir / f"run_{scale}"
+            if work_dir.exists():
+                shutil.rmtree(work_dir)
+            work_dir.mkdir(parents=True)
+            for name in names:
+                if name == "juntator" and "process_scopes" not in names:
+                    BENCHMARKS["process_scopes"](snapshot_dir, work_dir)
+                # a fresh process per benchmark, so memory is not shared between them
+                with ProcessPoolExecutor(1, initializer=worker_logging, initargs=(log_queue(),)) as executor:
+                    result = executor.submit(measure, name, snapshot_dir, work_dir).result()
+                result.update(
+                    {
+                        "benchmark": name,
+                        "scale": scale,
+                        "run": run,
+                        "records_per_second": result["records"] / result["seconds"] if result["seconds"] else None,
+                        "commit": commit,
+                        "time": time.time(),
+                    }
+                )
+                logging.info(
+                    f"{name} at {scale} works (run {run + 1}/{repeat}): "
+                    f"{result['records_per_second']:,.0f} records/s, "
+                    f"peak RSS {result['peak_rss_bytes'] / 2**20:,.0f} MB"
+                )
+                results.append(result)
+                with open(output_dir / RESULTS_FILE, "ab") as f:
+                    f.write(orjson.dumps(result) + b"\n")
+    return pd.DataFrame(results)
+
+
+def summary(results):
+    """
+    Median records per second and peak memory per benchmark and scale.
+    """
+    results = results.assign(peak_rss_mb=results["peak_rss_bytes"] / 2**20)
+    return (
+        results.groupby(["benchmark", "scale"])
+        .agg(records=("records", "first"), records_per_second=("records_per_second", "median"),
+             peak_rss_mb=("peak_rss_mb", "max"))
+        .round(1)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scan stages on synthetic snapshots")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES), help="Numbers of works")
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", type=Path, default=benchmark_dir)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, args.benchmarks, args.repeat, args.seed, args.output_dir)
+    print(summary(results).to_string())
@@ -1,40 +1,7 @@
 #!/bin/bash
 
-# Initialize a counter
-count=0
-max_files=5000000000
-
-for data_file in openalex-snapshot/data/authors/*/*.gz; do
-    # Check if we've reached the limit
-    if [ $count -ge $max_files ]; then
-        echo "Reached limit of $max_files files. Exiting."
-        break
-    fi
-    
-    # Use the full path for tracking
-    file_key=$(echo "$data_file" | sed 's/[\/]/_/g')
-    
-    # Check if file was already loaded successfully
-    if grep -q "$file_key" loaded_authors_files.txt 2>/dev/null; then
-        echo "Skipping $data_file (already loaded)"
-        continue
-    fi
-    
-    # Try to load the file
-    if bq load --source_format=CSV -F '\t' \
-        --schema 'author:string' \
-        --project_id openalex-bq \
-        openalex.authors "$data_file"; then
-        
-        # If successful, add to our tracking file
-        echo "$file_key" >> loaded_authors_files.txt
-        echo "Successfully loaded $data_file"
-    else
-        echo "Failed to load $data_file, will retry next run"
-    fi
-    
-    # Increment the counter
-    count=$((count+1))
-done
-
-echo "Processed $count files"
\ No newline at end of file
+# Loads the authors parts into BigQuery with src/bq_loader.py: many parts per load
+# job, several jobs at a time, progress kept in bq_ledger.sqlite (parts listed in
+# loaded_authors_files.txt by earlier runs are skipped). Extra arguments are passed
+# on, e.g. --uri-prefix gs://bucket/openalex-snapshot/data --jobs 8
+cd "$(dirname "$0")/../.." && exec python -m src.bq_loader authors --project-id openalex-bq "$@"
@@ -1,143 +1,255 @@
-import csv
-import gzip
-import shutil
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 
-import orjson
+import duckdb
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from src.download_s3 import download_all_files
+from src.ledger import LEDGER_FILE, atomic_path, is_complete, record_output
+from src.logs import setup_logging
 
 # Local Directories
-download_dir = Path("data/snapshot")
+snapshot_dir = Path("data/snapshot/openalex-snapshot/data")
+dimensions_dir = Path("data/dimensions")
 log_file = "process_log.log"
 
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
-
-# Retry mechanism
-MAX_RETRIES = 4
-
-
-def process_line(line):
-    record = orjson.loads(line.strip())
-    
-    topic_id = record.get("id")
-    display_name = record.get("display_name")
-    description = record.get("description")
-    subfield = record.get("subfield")['id']
-    field = record.get("field")['id']
-    domain = record.get("domain")['id']
-
-    row = [
-        topic_id,
-        display_name,
-        description,
-        subfield,
-        field,
-        domain
-    ]
-    return row
-    
-# for each file, we grab the lines that contain any of the valid_ids and save them to a new file
-
-def process_local_file(input_file, valid_ids, output_dir):
-    # grab the bit relative to openalex-snapshot/data/works
-    relative_path = input_file.relative_to("data/snapshot/openalex-snapshot/data/works")
-    output_file = output_dir / relative_path.with_suffix(".gz")
-
-    # check if the file is already processed
-    if output_file.exists():
-        logging.info(f"File already processed: {output_file}")
-    else:
-        logging.info(f"Processing file: {input_file}")
-        lines = []
-        try:
-            with gzip.open(input_file, "rt", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        line_result = orjson.loads(line.strip())
-                        if line_result:
-                            lines.append(line_result)
-                    except Exception as e:
-                        logging.warning(f"Failed processing line: {e}")
-
-            if lines:
-                # make sure the output directory exists
-                output_file.parent.mkdir(parents=True, exist_ok=True)
-                with gzip.open(output_file, "wt", encoding="utf-8") as f:
-                    # use the process_line function to make the row
-                    for line in lines:
-                        row = process_line(line)
-                        if row:
-                            f.write(orjson.dumps(row) + "\n")
-                    
-
-            logging.info(f"Processed file: {input_file}")
-        except Exception as e:
-            logging.error(f"Error processing file {input_file}: {e}")
-            raise
-
-
-
-def separate_topics(output_dir, valid_ids_path):
+setup_logging(log_file)
+
+# Small entities that are loaded whole. For each: the explicit schema of the
+# snapshot fields that are read, and the flattened columns written to Parquet.
+DIMENSIONS = {
+    "domains": {
+        "schema": {"id": "VARCHAR", "display_name": "VARCHAR", "works_count": "BIGINT"},
+        "columns": ["id", "display_name", "works_count"],
+    },
+    "fields": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "domain": "STRUCT(id VARCHAR)",
+            "works_count": "BIGINT",
+        },
+        "columns": ["id", "display_name", "domain.id AS domain_id", "works_count"],
+    },
+    "subfields": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "field": "STRUCT(id VARCHAR)",
+            "domain": "STRUCT(id VARCHAR)",
+            "works_count": "BIGINT",
+        },
+        "columns": [
+            "id",
+            "display_name",
+            "field.id AS field_id",
+            "domain.id AS domain_id",
+            "works_count",
+        ],
+    },
+    "topics": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "description": "VARCHAR",
+            "subfield": "STRUCT(id VARCHAR, display_name VARCHAR)",
+            "field": "STRUCT(id VARCHAR, display_name VARCHAR)",
+            "domain": "STRUCT(id VARCHAR, display_name VARCHAR)",
+            "works_count": "BIGINT",
+        },
+        "columns": [
+            "id",
+            "display_name",
+            "description",
+            "subfield.id AS subfield_id",
+            "subfield.display_name AS subfield_name",
+            "field.id AS field_id",
+            "field.display_name AS field_name",
+            "domain.id AS domain_id",
+            "domain.display_name AS domain_name",
+            "works_count",
+        ],
+    },
+    "sources": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "issn_l": "VARCHAR",
+            "type": "VARCHAR",
+            "host_organization": "VARCHAR",
+            "country_code": "VARCHAR",
+            "is_oa": "BOOLEAN",
+            "works_count": "BIGINT",
+            "cited_by_count": "BIGINT",
+        },
+        "columns": [
+            "id",
+            "display_name",
+            "issn_l",
+            "type",
+            "host_organization",
+            "country_code",
+            "is_oa",
+            "works_count",
+            "cited_by_count",
+        ],
+    },
+    "institutions": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "ror": "VARCHAR",
+            "type": "VARCHAR",
+            "country_code": "VARCHAR",
+            "works_count": "BIGINT",
+            "cited_by_count": "BIGINT",
+        },
+        "columns": [
+            "id",
+            "display_name",
+            "ror",
+            "type",
+            "country_code",
+            "works_count",
+            "cited_by_count",
+        ],
+    },
+    "concepts": {
+        "schema": {
+            "id": "VARCHAR",
+            "display_name": "VARCHAR",
+            "level": "BIGINT",
+            "wikidata": "VARCHAR",
+            "works_count": "BIGINT",
+        },
+        "columns": ["id", "display_name", "level", "wikidata", "works_count"],
+    },
+}
+
+
+def dimension_path(entity, output_dir=dimensions_dir):
+    return Path(output_dir) / f"{entity}.parquet"
+
+
+def is_up_to_date(output_file, input_files, ledger):
     """
-    Process all files in the download directory using given valid IDs file as reference.
-    valid_ids_path: Path to the file containing valid author IDs.
+    Whether output_file was completed and is newer than every input file.
     """
+    if not is_complete(ledger, output_file):
+        return False
+    built = output_file.stat().st_mtime
+    return all(f.stat().st_mtime <= built for f in input_files)
 
-    valid_ids = pd.read_csv(valid_ids_path)[id_col].tolist()
-    # make it a set
-    valid_ids = set(valid_ids)
-    print(f"Valid IDs: {len(valid_ids)}")
-
-    folder_name = output_dir / Path(valid_ids_path).stem
-    folder_name.mkdir(parents=True, exist_ok=True)
-
-    all_files = list( Path("data/snapshot/openalex-snapshot/data/works").rglob("*.gz"))
-    total_files = len(all_files)
-
-    max_workers = os.cpu_count() - 4  # 2 cores for other tasks
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(
-            max_workers=max_workers
-        ) as executor:  # max_workers=max_workers
-            futures = {
-                executor.submit(process_local_file, file, valid_ids, folder_name): file
-                for file in all_files
-            }
-
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # Raises exception if worker failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
+
+def build_dimension(entity, output_dir=dimensions_dir, input_dir=snapshot_dir, force=False):
+    """
+    Load one dimension entity from the snapshot into a Parquet file, in a single
+    DuckDB scan with an explicit schema. Rows are sorted by id and given a dense
+    integer key (0..n-1), so other tables can store the key instead of the
+    OpenAlex URL. Skipped if the file is up to date with the snapshot.
+    entity: One of DIMENSIONS.
+    Returns the number of rows.
+    """
+    spec = DIMENSIONS[entity]
+    output_file = dimension_path(entity, output_dir)
+    ledger = Path(output_dir) / LEDGER_FILE
+    input_files = sorted((Path(input_dir) / entity).rglob("*.gz"))
+    if not input_files:
+        logging.warning(f"No {entity} files under {input_dir}, skipping")
+        return 0
+    if not force and is_up_to_date(output_file, input_files, ledger):
+        logging.info(f"Dimension already built: {output_file}")
+        return pd.read_parquet(output_file, columns=["key"]).shape[0]
+
+    files = str(Path(input_dir) / entity / "**" / "*.gz").replace("'", "''")
+    schema = ", ".join(f"'{name}': '{kind}'" for name, kind in spec["schema"].items())
+    columns = ", ".join(spec["columns"])
+    # the snapshot can hold a record in more than one updated_date part; keep
+    # the latest version, like the views of warehouse.py
+    query = f"""
+        SELECT CAST(row_number() OVER (ORDER BY id) - 1 AS INTEGER) AS key, *
+        FROM (
+            SELECT {columns}
+            FROM read_json(
+                '{files}', format = 'newline_delimited', compression = 'gzip',
+                columns = {{{schema}}}, hive_partitioning = true, filename = true,
+                ignore_errors = true
+            )
+            -- malformed records are skipped, as in the other stages
+            WHERE id IS NOT NULL
+            QUALIFY row_number() OVER (
+                PARTITION BY id ORDER BY TRY_CAST(updated_date AS DATE) DESC NULLS LAST, filename DESC
+            ) = 1
+        )
+        ORDER BY key
+    """
+
+    conn = duckdb.connect(database=":memory:")
+    with atomic_path(output_file) as tmp:
+        tmp_path = str(tmp).replace("'", "''")
+        conn.execute(f"COPY ({query}) TO '{tmp_path}' (FORMAT parquet, COMPRESSION zstd)")
+        rows = conn.execute(f"SELECT COUNT(*) FROM read_parquet('{tmp_path}')").fetchone()[0]
+    conn.close()
+    record_output(ledger, output_file, rows)
+    # a rebuilt file must not be served from a stale cache
+    load_dimension.cache_clear()
+    logging.info(f"Saved {rows} {entity} to {output_file}")
+    return rows
+
+
+def build_dimensions(entities=None, output_dir=dimensions_dir, input_dir=snapshot_dir, force=False):
+    """
+    Build the Parquet files of all (or the given) dimension entities.
+    Returns a dict of entity -> number of rows.
+    """
+    return {
+        entity: build_dimension(entity, output_dir, input_dir, force)
+        for entity in (entities or DIMENSIONS)
+    }
 
 
+@lru_cache(maxsize=None)
+def load_dimension(entity, output_dir=dimensions_dir):
+    """
+    Memoized, memory-resident dimension table indexed by OpenAlex ID, with the
+    dense integer key and the attributes as columns. Loaded from Parquet once per
+    process.
+    """
+    table = pd.read_parquet(dimension_path(entity, output_dir))
+    return table.set_index("id")
+
 
+def dimension_keys(entity, ids, output_dir=dimensions_dir):
+    """
+    Dense integer keys of the given IDs, -1 for IDs not in the dimension.
+    """
+    table = load_dimension(entity, output_dir)
+    positions = table.index.get_indexer(pd.Index(ids))
+    return np.where(positions >= 0, table["key"].to_numpy()[positions], -1)
+
+
+def join_dimension(df, id_col, entity, columns=None, prefix=None, output_dir=dimensions_dir):
+    """
+    Add the attributes of a dimension to df by looking up df[id_col], e.g. the
+    topic, subfield, field and domain of the works rows from make_work_dataset:
+        join_dimension(works, "primary_topic_id", "topics")
+    columns: Attributes to add (default: all, including key).
+    prefix: Prefix of the added column names (default: "<entity>_").
+    """
+    table = load_dimension(entity, output_dir)
+    if columns is not None:
+        table = table[list(columns)]
+    prefix = f"{entity}_" if prefix is None else prefix
+    # unknown IDs get missing values
+    joined = table.reindex(df[id_col].to_numpy()).add_prefix(prefix)
+    joined.index = df.index
+    result = pd.concat([df, joined], axis=1)
+    return result
+
+
+# Example
+if __name__ == "__main__":
+    build_dimensions()
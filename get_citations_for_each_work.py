@@ -1,17 +1,36 @@
 import csv
 import gzip
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 import random
 import ast
 
 import orjson
 import pandas as pd
-from tqdm import tqdm
 
+from src.batches import iter_matching_lines, references_mask, to_id_array, year_mask
+from src.chunking import (
+    chunk_merger,
+    chunk_output_path,
+    merge_csv_chunks,
+    open_chunk,
+    plan_chunks,
+)
 from src.download_s3 import download_all_files
+from src.id_lists import load_ids
+from src.ledger import (
+    LEDGER_FILE,
+    atomic_path,
+    completed_outputs,
+    is_complete,
+    load_ledger,
+    record_output,
+)
+from src.logs import line_warning, setup_logging
+from src.metrics import METRICS_FILE, TaskMetrics, write_run_report
+from src.partitioned import write_partitioned_df
+from src.task_runner import STATUS_FILE, run_tasks
 
 # Local Directories
 download_dir = Path("data/snapshot")
@@ -22,25 +41,27 @@ log_file = "process_log.log"
 output_dir.mkdir(parents=True, exist_ok=True)
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 # Retry mechanism
 MAX_RETRIES = 4
 
-def process_line(line, work_id_list):
+def parse_line(line):
     try:
-        record = orjson.loads(line.strip())
+        return orjson.loads(line.strip())
     except Exception as e:
-        logging.warning(f"Invalid JSON: {line} - {e}")
+        line_warning("invalid JSON", e, line)
         return None  # Skip invalid or malformed lines
-    
+
+
+def process_line(line, work_id_list):
+    record = parse_line(line)
+    if record is None:
+        return None
+    return cited_rows(record, work_id_list)
+
+
+def cited_rows(record, work_id_list):
     publication_year = record.get("publication_year")
     cited_works = record.get("referenced_works", [])
     
@@ -53,37 +74,81 @@ def process_line(line, work_id_list):
                 results.append((cited_work, record.get("id"), publication_year))
         return results
 
-def save_to_csv(rows, file_prefix, folder_name):
-    file_path = folder_name / f"{file_prefix}.csv"
-    file_exists = file_path.exists()
-    with open(file_path, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        if not file_exists:
+def save_to_csv(rows, file_prefix, folder_name, chunk=None):
+    file_path = chunk_output_path(folder_name / f"{file_prefix}.csv", chunk)
+    # written to a temp file and renamed, so a crash never leaves half a file
+    with atomic_path(file_path) as tmp:
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
             writer.writerow(["cited_work_id", "citing_work_id", "citation_year"])
-        writer.writerows(rows)
+            writer.writerows(rows)
+
+def process_lines(lines, work_id_list, results, metrics=None):
+    metrics = metrics or TaskMetrics()
+    for line in lines:
+        try:
+            with metrics.timer("parse"):
+                record = parse_line(line)
+            if record is None:
+                metrics.add("parse_errors")
+                continue
+            metrics.add("records_parsed")
+            with metrics.timer("filter"):
+                line_results = cited_rows(record, work_id_list)
+            if line_results:
+                metrics.add("records_matched")
+                results.extend(line_results)
+        except Exception as e:
+            line_warning("failed line", e)
 
-def process_local_file(local_file_path, work_id_list, folder_name):
+
+def citation_mask(table, id_array):
+    # works from 2001 on that cite at least one of the works we follow
+    return year_mask(table, min_year=2001) & references_mask(table, id_array)
+
+
+def process_local_file(local_file_path, work_id_list, folder_name, batched=False, chunk=None):
     file_prefix = Path(local_file_path).stem
-    # skikp if the file has already been processed
-    if (folder_name / f"{file_prefix}.csv").exists():
+    merged_file = folder_name / f"{file_prefix}.csv"
+    output_file = chunk_output_path(merged_file, chunk)
+    ledger = folder_name / LEDGER_FILE
+    # skikp if the file (or this chunk of it) has already been processed
+    entries = load_ledger(ledger)
+    if is_complete(ledger, merged_file, entries=entries) or is_complete(
+        ledger, output_file, entries=entries
+    ):
         logging.info(f"File already processed: {local_file_path}")
         return None
     else:
         results = []
+        metrics = TaskMetrics()
         try:
-            with gzip.open(local_file_path, "rt", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        line_results = process_line(line, work_id_list)
-                        if line_results:
-                            results.extend(line_results)
-                    except Exception as e:
-                        logging.warning(f"Failed processing line: {e}")
+            if batched:
+                # the latest year holds every work, so it works as the pre-filter
+                id_array = to_id_array(work_id_list[max(work_id_list)])
+                process_lines(
+                    iter_matching_lines(
+                        local_file_path,
+                        lambda table: citation_mask(table, id_array),
+                        chunk=chunk,
+                        metrics=metrics,
+                    ),
+                    work_id_list,
+                    results,
+                    metrics,
+                )
+            else:
+                with open_chunk(local_file_path, chunk, metrics=metrics) as f:
+                    process_lines(f, work_id_list, results, metrics)
             
-            if results:
-                save_to_csv(results, file_prefix, folder_name)
+            with metrics.timer("write"):
+                if results:
+                    save_to_csv(results, file_prefix, folder_name, chunk)
+                record_output(ledger, output_file, len(results))
+            metrics.add("rows_emitted", len(results))
             
             logging.info(f"Successfully processed file: {local_file_path}")
+            return metrics.result()
         except Exception as e:
             logging.error(f"Error processing file {local_file_path}: {e}")
             raise
@@ -128,8 +193,7 @@ def process_local_file(local_file_path, work_id_list, folder_name):
 
 
 
-def set_aside_citations(output_dir, work_ids_path, sample_name, test):
-    print("Setting aside citations")
+def load_work_id_list(work_ids_path):
     work_ids = pd.read_csv(work_ids_path)  
     # make sublists of work_ids for each year>t, t=1961 to 2022
     work_id_list = {}
@@ -137,8 +201,17 @@ def set_aside_citations(output_dir, work_ids_path, sample_name, test):
         valid_ids = work_ids[work_ids["year"] <= year]["work_id"].unique()
         work_id_list[year] = set(valid_ids)
 
-
     logging.info(f"Works to process: {len(work_ids)}")
+    return work_id_list
+
+
+def set_aside_citations(output_dir, work_ids_path, sample_name, test, batched=False, split=True):
+    """
+    batched: Use the vectorized Arrow filter in the workers (see src/batches.py).
+    split: Split large files into record-range chunks processed concurrently.
+    """
+    print("Setting aside citations")
+    work_id_list = load_work_id_list(work_ids_path)
     
     folder_name = Path(output_dir) / sample_name
     folder_name.mkdir(parents=True, exist_ok=True)
@@ -148,44 +221,67 @@ def set_aside_citations(output_dir, work_ids_path, sample_name, test):
     else: # randomize the order of the files
         all_files = list(download_dir.glob("*.gz"))
         random.shuffle(all_files)
-    total_files = len(all_files)
-    print(total_files)
+    tasks = plan_chunks(all_files) if split else [(file, None) for file in all_files]
+    print(len(tasks))
     
-    max_workers = os.cpu_count() # - 2  # Reserve 2 cores for other tasks
-    logging.info(f"Using {max_workers} workers")
     
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(
-            max_workers=max_workers
-        ) as executor:  # max_workers=max_workers
-            futures = {
-                executor.submit(process_local_file, file, work_id_list, folder_name): file
-                for file in all_files
-            }
-
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # Raises exception if worker failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
+    run_tasks(
+        process_local_file,
+        {
+            (file, chunk): (file, work_id_list, folder_name, batched, chunk)
+            for file, chunk in tasks
+        },
+        status_file=folder_name / STATUS_FILE,
+        on_done=chunk_merger(
+            tasks,
+            lambda file, n_chunks: merge_csv_chunks(
+                folder_name / f"{Path(file).stem}.csv", n_chunks, folder_name / LEDGER_FILE
+            ),
+        ),
+        max_retries=MAX_RETRIES,
+        metrics_file=folder_name / METRICS_FILE,
+    )
+    write_run_report(folder_name / METRICS_FILE)
+
+
+# Entry points for distributed runs (see src/distributed.py). params holds
+# output_dir, work_ids_path, sample_name and optionally batched.
+
+@lru_cache(maxsize=1)
+def cached_work_id_list(work_ids_path):
+    # loaded once per worker process, not once per task
+    return load_work_id_list(work_ids_path)
+
+
+def list_files(params):
+    return list(download_dir.glob("*.gz"))
+
+
+def run_task(params, file, chunk):
+    work_id_list = cached_work_id_list(params["work_ids_path"])
+    folder_name = Path(params["output_dir"]) / params["sample_name"]
+    folder_name.mkdir(parents=True, exist_ok=True)
+    process_local_file(
+        Path(file), work_id_list, folder_name, params.get("batched", False), chunk
+    )
+
+
+def finalize(params, file, n_chunks):
+    folder_name = Path(params["output_dir"]) / params["sample_name"]
+    merge_csv_chunks(
+        folder_name / f"{Path(file).stem}.csv", n_chunks, folder_name / LEDGER_FILE
+    )
 
 
 # function that takes all the processed files and aggregates them
 def agg_citations(input_dir, output_dir, work_ids_path):
     print("Aggregating citations")
-    all_files = list(input_dir.glob("*.csv"))
+    # only read outputs verified by the ledger (falls back to all CSVs for old runs)
+    ledger = input_dir / LEDGER_FILE
+    if ledger.exists():
+        all_files = completed_outputs(ledger, ".csv")
+    else:
+        all_files = [f for f in input_dir.glob("*.csv") if f.name != "all_data.csv"]
     print(f"Total files: {len(all_files)}")
     
     # read all the files and concatenate them
@@ -203,16 +299,23 @@ def agg_citations(input_dir, output_dir, work_ids_path):
     # drop the cited_work_id column
     all_data = all_data.drop("cited_work_id", axis=1)
 
-    all_data.to_csv(output_dir / "all_data.csv", index=False)
+    with atomic_path(output_dir / "all_data.csv") as tmp:
+        all_data.to_csv(tmp, index=False)
     print("Aggregation completed successfully.")
 
 
 # now we take the output of the previous function count citations per author each year
-def count_citations_per_author_per_year(agg_citations, relelant_ids_path, relevant_ids_column, output_dir, test):
+def count_citations_per_author_per_year(
+    agg_citations, relelant_ids_path, relevant_ids_column, output_dir, test, partitioned=False
+):
+    """
+    partitioned: Write a Parquet dataset bucketed by author and partitioned by year
+    (see src/partitioned.py) instead of a single CSV.
+    """
     print("Counting citations per author per year")
 
     # read the relevant ids
-    relevant_ids = pd.read_csv(relelant_ids_path)[relevant_ids_column]
+    relevant_ids = load_ids(relelant_ids_path, relevant_ids_column)
     print(f"Total relevant ids: {len(relevant_ids)}")
 
     # read the data
@@ -237,7 +340,7 @@ def count_citations_per_author_per_year(agg_citations, relelant_ids_path, releva
     print(all_data.head())
 
     # filter the data
-    all_data = all_data[all_data["author_ids"].isin(relevant_ids)]
+    all_data = all_data[all_data["author_ids"].isin(list(relevant_ids))]
 
     # count the number of citations per author per citation_year for works of each year
     all_data = all_data.groupby(["author_ids", "citation_year", "year"]).agg({"citations": "sum"}).reset_index()
@@ -245,7 +348,14 @@ def count_citations_per_author_per_year(agg_citations, relelant_ids_path, releva
     # sort the data
     all_data = all_data.sort_values(by=["author_ids", "year", "citation_year"])
 
-    all_data.to_csv(output_dir / "citations_per_author_per_year.csv", index=False)
+    if partitioned:
+        write_partitioned_df(
+            all_data, output_dir / "citations_per_author_per_year", "author_ids", "year"
+        )
+        return
+
+    with atomic_path(output_dir / "citations_per_author_per_year.csv") as tmp:
+        all_data.to_csv(tmp, index=False)
 
 
 
@@ -2,15 +2,26 @@ import csv
 import gzip
 import shutil
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 
 import orjson
 import pandas as pd
-from tqdm import tqdm
 
+from src.batches import author_mask, iter_matching_lines, to_id_array
+from src.chunking import (
+    chunk_merger,
+    chunk_output_path,
+    merge_gz_chunks,
+    open_chunk,
+    plan_chunks,
+)
 from src.download_s3 import download_all_files
+from src.id_lists import load_ids
+from src.ledger import LEDGER_FILE, atomic_path, is_complete, load_ledger, record_output
+from src.logs import line_warning, setup_logging
+from src.metrics import METRICS_FILE, TaskMetrics, write_run_report
+from src.task_runner import STATUS_FILE, run_tasks
 
 # Local Directories
 download_dir = Path("data/snapshot")
@@ -18,23 +29,20 @@ log_file = "process_log.log"
 
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 # Retry mechanism
 MAX_RETRIES = 4
 
 
+def has_valid_author(record, valid_ids):
+    return any(authorship["author"]["id"] in valid_ids for authorship in record["authorships"])
+
+
 def pick_line(line, valid_ids):
     record = orjson.loads(line.strip())
     # if any of the valid_ids is in authorships, return the record
-    if any(authorship["author"]["id"] in valid_ids for authorship in record["authorships"]):
+    if has_valid_author(record, valid_ids):
         #print(record)
         return record
 
@@ -42,87 +50,146 @@ def pick_line(line, valid_ids):
     
 # for each file, we grab the lines that contain any of the valid_ids and save them to a new file
 
-def process_local_file(input_file, valid_ids, output_dir):
+def pick_lines(lines, valid_ids, metrics=None):
+    metrics = metrics or TaskMetrics()
+    picked = []
+    for line in lines:
+        try:
+            with metrics.timer("parse"):
+                record = orjson.loads(line.strip())
+        except Exception as e:
+            metrics.add("parse_errors")
+            line_warning("invalid JSON", e, line)
+            continue
+        metrics.add("records_parsed")
+        try:
+            with metrics.timer("filter"):
+                keep = has_valid_author(record, valid_ids)
+            if keep:
+                metrics.add("records_matched")
+                picked.append(record)
+        except Exception as e:
+            line_warning("failed line", e)
+    return picked
+
+
+def output_path(input_file, output_dir):
     # grab the bit relative to openalex-snapshot/data/works
     relative_path = input_file.relative_to("data/snapshot/openalex-snapshot/data/works")
-    output_file = output_dir / relative_path.with_suffix(".gz")
+    return output_dir / relative_path.with_suffix(".gz")
+
+
+def process_local_file(input_file, valid_ids, output_dir, batched=False, chunk=None):
+    merged_file = output_path(input_file, output_dir)
+    output_file = chunk_output_path(merged_file, chunk)
+    ledger = output_dir / LEDGER_FILE
 
-    # check if the file is already processed
-    if output_file.exists():
+    # check if the file (or this chunk of it) is already processed
+    entries = load_ledger(ledger)
+    if is_complete(ledger, merged_file, entries=entries) or is_complete(
+        ledger, output_file, entries=entries
+    ):
         logging.info(f"File already processed: {output_file}")
     else:
         logging.info(f"Processing file: {input_file}")
-        lines = []
+        metrics = TaskMetrics()
         try:
-            with gzip.open(input_file, "rt", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        line_result = pick_line(line, valid_ids)
-                        if line_result:
-                            lines.append(line_result)
-                    except Exception as e:
-                        logging.warning(f"Failed processing line: {e}")
-
-            if lines:
-                # make sure the output directory exists
-                output_file.parent.mkdir(parents=True, exist_ok=True)
-                with gzip.open(output_file, "wt", encoding="utf-8") as f:
-                    for line in lines:
-                        f.write(orjson.dumps(line).decode("utf-8") + "\n")
+            if batched:
+                # vectorized pre-filter, pick_line only sees candidate works
+                id_array = to_id_array(valid_ids)
+                lines = pick_lines(
+                    iter_matching_lines(
+                        input_file,
+                        lambda table: author_mask(table, id_array),
+                        chunk=chunk,
+                        metrics=metrics,
+                    ),
+                    valid_ids,
+                    metrics,
+                )
+            else:
+                with open_chunk(input_file, chunk, metrics=metrics) as f:
+                    lines = pick_lines(f, valid_ids, metrics)
+
+            with metrics.timer("write"):
+                if lines:
+                    # written to a temp file and renamed, so a crash never leaves half a file
+                    with atomic_path(output_file) as tmp:
+                        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                            for line in lines:
+                                f.write(orjson.dumps(line).decode("utf-8") + "\n")
+                record_output(ledger, output_file, len(lines))
+            metrics.add("rows_emitted", len(lines))
 
             logging.info(f"Processed file: {input_file}")
+            return metrics.result()
         except Exception as e:
             logging.error(f"Error processing file {input_file}: {e}")
             raise
 
 
 
-def get_all(output_dir, valid_ids_path, id_col):
+def get_all(output_dir, valid_ids_path, id_col, batched=False, split=True):
     """
     Process all files in the download directory using given valid IDs file as reference.
     valid_ids_path: Path to the file containing valid author IDs.
+    batched: Use the vectorized Arrow filter in the workers (see src/batches.py).
+    split: Split large files into record-range chunks processed concurrently.
     """
 
-    valid_ids = pd.read_csv(valid_ids_path)[id_col].tolist()
-    # make it a set
-    valid_ids = set(valid_ids)
+    valid_ids = load_ids(valid_ids_path, id_col)
     print(f"Valid IDs: {len(valid_ids)}")
 
     folder_name = output_dir / Path(valid_ids_path).stem
     folder_name.mkdir(parents=True, exist_ok=True)
 
     all_files = list( Path("data/snapshot/openalex-snapshot/data/works").rglob("*.gz"))
-    total_files = len(all_files)
-
-    max_workers = os.cpu_count() - 4  # 2 cores for other tasks
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(
-            max_workers=max_workers
-        ) as executor:  # max_workers=max_workers
-            futures = {
-                executor.submit(process_local_file, file, valid_ids, folder_name): file
-                for file in all_files
-            }
-
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # Raises exception if worker failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
+    tasks = plan_chunks(all_files) if split else [(file, None) for file in all_files]
 
+    run_tasks(
+        process_local_file,
+        {
+            (file, chunk): (file, valid_ids, folder_name, batched, chunk)
+            for file, chunk in tasks
+        },
+        status_file=folder_name / STATUS_FILE,
+        on_done=chunk_merger(
+            tasks,
+            lambda file, n_chunks: merge_gz_chunks(
+                output_path(file, folder_name), n_chunks, folder_name / LEDGER_FILE
+            ),
+        ),
+        max_retries=MAX_RETRIES,
+        metrics_file=folder_name / METRICS_FILE,
+    )
+    write_run_report(folder_name / METRICS_FILE)
+
+
+
+
+
+# Entry points for distributed runs (see src/distributed.py). params holds
+# output_dir, valid_ids_path, id_col and optionally batched.
+
+@lru_cache(maxsize=1)
+def cached_valid_ids(valid_ids_path, id_col):
+    # loaded once per worker process, not once per task
+    return load_ids(valid_ids_path, id_col)
+
+
+def list_files(params):
+    return list(Path("data/snapshot/openalex-snapshot/data/works").rglob("*.gz"))
+
+
+def run_task(params, file, chunk):
+    valid_ids = cached_valid_ids(params["valid_ids_path"], params["id_col"])
+    folder_name = Path(params["output_dir"]) / Path(params["valid_ids_path"]).stem
+    folder_name.mkdir(parents=True, exist_ok=True)
+    process_local_file(
+        Path(file), valid_ids, folder_name, params.get("batched", False), chunk
+    )
 
 
+def finalize(params, file, n_chunks):
+    folder_name = Path(params["output_dir"]) / Path(params["valid_ids_path"]).stem
+    merge_gz_chunks(output_path(Path(file), folder_name), n_chunks, folder_name / LEDGER_FILE)
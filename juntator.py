@@ -2,47 +2,80 @@ from pathlib import Path
 
 import duckdb
 
+from src.ledger import LEDGER_FILE, atomic_path, completed_outputs
+from src.metrics import METRICS_FILE, TaskMetrics, record_metrics, write_run_report
+from src.partitioned import write_partitioned
 
-def aggregate_table(input_dir, scope, output_file, aggregation_query):
+
+def aggregate_table(input_dir, scope, output_file, aggregation_query, partitioned=False):
     """
     Generic function to aggregate a specific scope (citations, coauthors, works).
+    partitioned: Write a Parquet dataset bucketed by author_id and partitioned by
+    year (see src/partitioned.py) at output_file without its suffix, instead of a CSV.
+    Its metrics are appended to the metrics file next to output_file.
     """
     scope_path = Path(input_dir) / scope
-    all_files = list(scope_path.glob("*.csv"))
+    # only read outputs verified by the ledger (falls back to all CSVs for old runs)
+    ledger = Path(input_dir) / LEDGER_FILE
+    if ledger.exists():
+        all_files = [f for f in completed_outputs(ledger, ".csv") if f.parent == scope_path]
+    else:
+        all_files = list(scope_path.glob("*.csv"))
 
     if not all_files:
         raise FileNotFoundError(f"No CSV files found for {scope} in {scope_path}")
 
     conn = duckdb.connect(database=":memory:")
+    metrics = TaskMetrics()
+    metrics_file = Path(output_file).parent / METRICS_FILE
 
     # Incrementally load files and ensure column consistency
     for idx, file in enumerate(all_files):
         print(f"Loading file {idx + 1}/{len(all_files)}: {file}")
-        if idx == 0:
-            conn.execute(
-                f"CREATE TABLE {scope} AS SELECT * FROM read_csv_auto('{file}', ALL_VARCHAR=TRUE)"
-            )
-        else:
-            conn.execute(
-                f"INSERT INTO {scope} SELECT * FROM read_csv_auto('{file}', ALL_VARCHAR=TRUE)"
-            )
+        metrics.add("bytes_read", Path(file).stat().st_size)
+        with metrics.timer("parse"):
+            if idx == 0:
+                conn.execute(
+                    f"CREATE TABLE {scope} AS SELECT * FROM read_csv_auto('{file}', ALL_VARCHAR=TRUE)"
+                )
+            else:
+                conn.execute(
+                    f"INSERT INTO {scope} SELECT * FROM read_csv_auto('{file}', ALL_VARCHAR=TRUE)"
+                )
 
     # Debugging: Check row count after loading
     row_count = conn.execute(f"SELECT COUNT(*) FROM {scope}").fetchone()[0]
+    metrics.add("records_parsed", row_count)
     print(f"Total rows loaded into {scope}: {row_count}")
 
     # Perform aggregation
     print(f"Aggregating {scope} data...")
-    aggregated_data = conn.execute(aggregation_query).df()
+    if partitioned:
+        output_file = Path(output_file).with_suffix("")
+        # DuckDB aggregates while it writes, so this is all timed as write
+        with metrics.timer("write"):
+            rows = write_partitioned(conn, aggregation_query, output_file, "author_id", "year")
+        metrics.add("rows_emitted", rows)
+        record_metrics(metrics_file, f"aggregate:{scope}", metrics.result())
+        print(f"Aggregated {scope} ({rows} rows) saved to {output_file}")
+        return
+
+    with metrics.timer("aggregate"):
+        aggregated_data = conn.execute(aggregation_query).df()
 
     # Save aggregated data
-    aggregated_data.to_csv(output_file, index=False)
+    with metrics.timer("write"):
+        with atomic_path(output_file) as tmp:
+            aggregated_data.to_csv(tmp, index=False)
+    metrics.add("rows_emitted", len(aggregated_data))
+    record_metrics(metrics_file, f"aggregate:{scope}", metrics.result())
     print(f"Aggregated {scope} saved to {output_file}")
 
 
-def aggregate_all(input_dir, output_dir):
+def aggregate_all(input_dir, output_dir, partitioned=False):
     """
     Aggregate all scopes: citations, coauthors, and works.
+    partitioned: Write author-bucketed Parquet datasets instead of CSVs.
     """
     # Citations aggregation
     aggregate_table(
@@ -54,6 +87,7 @@ def aggregate_all(input_dir, output_dir):
         FROM citations
         GROUP BY author_id, year, citation_year, type
         """,
+        partitioned=partitioned,
     )
 
     # Coauthors aggregation (no deduplication)
@@ -66,6 +100,7 @@ def aggregate_all(input_dir, output_dir):
         FROM coauthors
         GROUP BY author_id, year, type
         """,
+        partitioned=partitioned,
     )
 
     # Works aggregation
@@ -78,7 +113,9 @@ def aggregate_all(input_dir, output_dir):
         FROM works
         GROUP BY author_id, year, type
         """,
+        partitioned=partitioned,
     )
+    write_run_report(Path(output_dir) / METRICS_FILE)
 
 
 # Example
@@ -1,126 +1,185 @@
 import os
-import pandas as pd
-import numpy as np
-import pathlib
-import matplotlib.pyplot as plt
 from pathlib import Path
-#from juntator import aggregate_all
-from get_relevant_works import get_all
-from make_work_dataset import prep_works, agg_relevant_works
-from get_citations_for_each_work import set_aside_citations, agg_citations, count_citations_per_author_per_year
-from sample_authors import get_all_authors, aggregate_authors
-
 
+from get_citations_for_each_work import agg_citations, count_citations_per_author_per_year, set_aside_citations
+from get_relevant_works import get_all
+from make_work_dataset import agg_relevant_works, prep_works
+from relations import aggregate_relations, extract_relations
+from sample_authors import INSTITUTION_CACHE, build_institution_cache, sample_author_ids, select_authors
+from src.ledger import LEDGER_FILE
+from src.pipeline import main, stage
+
+# Local Directories definitions---------------------------------------------------------------------------------------------
+snapshot_dir = Path("data/snapshot/openalex-snapshot/data")
+selected_dir = Path("data/selected_authors")  # <<< where the selected and sampled authors will be saved
+relevant_dir = Path("data/relevant_works")  # <<< where the set-aside works will be saved
+works_csvs_dir = Path("data/works_csvs")
+citing_dir = Path("data/citing_works")
+relations_dir = Path("data/relations")  # <<< relations of the whole snapshot, shared by every sample
+relation_scopes_dir = Path("data/relation_scopes")
+
+# Sampling parameters--------------------------------------------------------------------------------------------------------
+sample_name = "sample_authors_2025-03-16"
+sample_size = 75000
+seed = 42
+
+
+def build_stages():
+    """
+    The stages of the pipeline: select authors -> sample -> relevant works ->
+    work dataset -> citations -> per-author counts. The snapshot is tracked
+    through its manifests, which change whenever the snapshot is synced.
+    """
+    db_path = os.getenv("db_path")
+    if not db_path:
+        raise ValueError("Environment variable 'db_path' is not set.")
+    potentially_on_twitter_path = (
+        Path(db_path) / "Science Twitter/Data/Raw/openalex/people/VS_academics_2025-01/allAcademics.csv"
+    )
+    institutions_path = Path(db_path) / "Science Twitter/Data/Raw/openalex/institutions/top150_openalex_ids.xlsx"
+
+    all_authors = selected_dir / "all_data.parquet"
+    sample = selected_dir / f"{sample_name}.csv"
+    relevant_works = relevant_dir / sample_name
+    works_csvs = works_csvs_dir / sample_name
+    works_dataset = works_csvs / "all_data.csv"
+    citing_works = citing_dir / sample_name
+    citations = citing_works / "all_data.csv"
+    relation_scopes = relation_scopes_dir / sample_name
+
+    return [
+        stage(
+            "institutions",
+            build_institution_cache,
+            inputs=[institutions_path],
+            outputs=[INSTITUTION_CACHE],
+            params={
+                "excel_path": institutions_path,
+                "cache_path": INSTITUTION_CACHE,
+            },
+        ),
+        # authors affiliated with the listed institutions, in one DuckDB pass
+        stage(
+            "select_authors",
+            select_authors,
+            inputs=[snapshot_dir / "authors" / "manifest", INSTITUTION_CACHE],
+            outputs=[all_authors],
+            params={
+                "output_file": all_authors,
+                "institution_cache": INSTITUTION_CACHE,
+            },
+        ),
+        # seed-reproducible sample, with the potential Twitter matches forced in
+        stage(
+            "sample_authors",
+            sample_author_ids,
+            inputs=[all_authors, potentially_on_twitter_path],
+            outputs=[sample],
+            params={
+                "input_path": all_authors,
+                "output_file": sample,
+                "n": sample_size,
+                "seed": seed,
+                "forced": [potentially_on_twitter_path],
+            },
+        ),
+        stage(
+            "relevant_works",
+            get_all,
+            inputs=[snapshot_dir / "works" / "manifest", sample],
+            outputs=[relevant_works],
+            params={
+                "output_dir": relevant_dir,
+                "valid_ids_path": sample,
+                "id_col": "id",
+            },
+        ),
+        stage(
+            "works_csvs",
+            prep_works,
+            inputs=[sample, relevant_works],
+            outputs=[works_csvs],
+            params={
+                "output_dir": works_csvs_dir,
+                "valid_ids_path": sample,
+                "input_dir": relevant_works,
+            },
+        ),
+        stage(
+            "works_dataset",
+            agg_relevant_works,
+            inputs=[works_csvs],
+            outputs=[works_dataset],
+            params={
+                "input_dir": works_csvs,
+                "output_dir": works_csvs,
+            },
+        ),
+        stage(
+            "citing_works",
+            set_aside_citations,
+            inputs=[snapshot_dir / "works" / "manifest", works_dataset],
+            outputs=[citing_works],
+            params={
+                "output_dir": citing_dir,
+                "work_ids_path": works_dataset,
+                "sample_name": sample_name,
+                "test": False,
+            },
+        ),
+        # the ledger of the citing works, not their directory, which also holds
+        # the outputs of this stage and the next
+        stage(
+            "citations",
+            agg_citations,
+            inputs=[citing_works / LEDGER_FILE, works_dataset],
+            outputs=[citations],
+            params={
+                "input_dir": citing_works,
+                "output_dir": citing_works,
+                "work_ids_path": works_dataset,
+            },
+        ),
+        stage(
+            "author_citations",
+            count_citations_per_author_per_year,
+            inputs=[citations, sample],
+            outputs=[citing_works / "citations_per_author_per_year.csv"],
+            params={
+                "agg_citations": citations,
+                "relelant_ids_path": sample,
+                "relevant_ids_column": "id",
+                "output_dir": citing_works,
+                "test": False,
+            },
+        ),
+        # authorship and reference relations of the whole snapshot (citations
+        # come from every citing work, not only the sample's), and the works,
+        # coauthors and citations scopes of the sample computed from them
+        stage(
+            "relations",
+            extract_relations,
+            inputs=[snapshot_dir / "works" / "manifest"],
+            outputs=[relations_dir],
+            params={
+                "output_dir": relations_dir,
+                "input_dir": snapshot_dir / "works",
+            },
+        ),
+        stage(
+            "relation_scopes",
+            aggregate_relations,
+            inputs=[relations_dir, sample],
+            outputs=[relation_scopes],
+            params={
+                "input_dir": relations_dir,
+                "output_dir": relation_scopes,
+                "valid_ids_path": sample,
+            },
+        ),
+    ]
 
 
 if __name__ == "__main__":
-    # Local Directories definitions-------------------------------------------------------------------------------------------
-    potentially_on_twitter_path = Path(os.getenv('db_path')) / "Science Twitter/Data/Raw/openalex/people/VS_academics_2025-01/allAcademics.csv"
-    potentially_on_twitter_filename = Path(potentially_on_twitter_path).stem.replace(
-        ".csv", ""
-    )  # File name without extension
-
-    relevant_dir = Path("data/relevant_works")  # <<< where the set-aside works will be saved
-
-    # Ensure directories exist-------------------------------------------------------------------------------------------------
-    relevant_dir.mkdir(parents=True, exist_ok=True)
-    works_csvs_dir = Path("data/works_csvs")
-    works_csvs_dir.mkdir(parents=True, exist_ok=True) 
-    #aggregated_dir.mkdir(parents=True, exist_ok=True)
-
-
-
-    # Logging configuration---------------------------------------------------------------------------------------------------
-    log_file = "process_log.log"
-
-    # PROCESSING PIPELINE------------------------------------------------------------------------------------------------------
-
-    # # Get all authors
-    # get_all_authors(output_dir=Path("data/selected_authors"))
-
-    # Aggregate all authors
-    # aggregate_authors(input_dir=Path("data/selected_authors"), output_file=Path("data/selected_authors") / "all_data.csv")
-
-    # # there are too many, over 5m, so we need to sample them. Let's pick 75k
-    # all_authors= pd.read_csv(Path("data/selected_authors") / "all_data.csv")
-    # np.random.seed(42)
-    # sample_authors = all_authors.sample(n=75000) 
-    # sample_authors.to_csv(Path("data/selected_authors") / "sample_authors_2025-03-16.csv", index=False)
-    # # add to these authors those in the potential mathches file. They will be our target authors
-    # sample_authors = pd.read_csv(Path("data/selected_authors") / "sample_authors_2025-03-16.csv")
-    # n_potentially_on_twitter = pd.read_csv(potentially_on_twitter_path).shape[0]
-    # potential_matches = pd.read_csv(potentially_on_twitter_path)['id']
-    # sample_authors = pd.concat([sample_authors, potential_matches])
-    # # drop duplicates
-    # sample_authors = sample_authors.drop_duplicates()
-    # # how many authors do we have now?
-    # print( len(sample_authors))
-    # # how many dups were dropped?
-    # print(n_potentially_on_twitter+75000 - len(sample_authors)) # 670, makes sense I guess since it's way more people than the 75k
-    # # save the sample authors
-    # sample_authors.to_csv(Path("data/selected_authors") / "sample_authors_2025-03-16.csv", index=False)
-
-    # # Let's first put aside the relevant works
-    # get_all(
-    #     valid_ids_path = Path("data/selected_authors") / "sample_authors_2025-03-16.csv", 
-    #     output_dir=relevant_dir, 
-    #     id_col='id'
-    # )
-
-    # bestMathcIdsPath = "C:/Users/deivi/Dropbox/Science Twitter/Data/Intermediate/VS_academics_bestMatch.csv"
-    # bestMatchIds = "OA_id"  # <<< INPUT
-    # bestMathcIdsFilename = Path(bestMathcIdsPath).stem.replace(".csv", "")  
-
-    # # get the data we want to extract from each work and put it into csvs. Then we will aggregate them
-    # prep_works(
-    #     valid_ids_path = Path("data/selected_authors") / "sample_authors_2025-03-16.csv",
-    #     input_dir =  relevant_dir / "sample_authors_2025-03-16",
-    #     output_dir = works_csvs_dir,
-    # )
-
-    # # put works in a single dataset
-    # agg_relevant_works(
-    #     input_dir= works_csvs_dir / "sample_authors_2025-03-16",
-    #     output_dir = works_csvs_dir / "sample_authors_2025-03-16",
-    # )
-
-    # # have a look at the data integrity in the aggregated dataset
-    # data= pd.read_csv(works_csvs_dir / "sample_authors_2025-03-16" / "sample_authors_2025-03-16_all_data.csv")
-    # print(data.head())
-    # print(data.shape)
-    # print(data.columns)
-    # print(data.dtypes)
-    # print(data.isnull().sum()/data.shape[0]) 
-    # # make a histogram of the publication years
-    # plt.hist(data['year'], bins=range(1900, 2026))
-    # plt.show()
-
-    # STOPPED HERE ON 2025-03-16
-
-    # set aside the citations to those works
-    
-    # set_aside_citations(
-    #     output_dir = Path("data/citing_works"),
-    #     work_ids_path = Path(selected_dir) / bestMathcIdsFilename/ "all_data.csv",
-    #     sample_name = bestMathcIdsFilename,
-    #     test=False
-    # )
-
-    # agg_citations
-    # agg_citations(
-    #     input_dir = Path("data/citing_works") / bestMathcIdsFilename,
-    #     output_dir = Path("data/citing_works") / bestMathcIdsFilename,
-    #     work_ids_path = Path(selected_dir) / bestMathcIdsFilename/ "all_data.csv",
-    # )
-
-    # # count_citations_per_author_per_year
-    # count_citations_per_author_per_year(
-    #     agg_citations= Path("data/citing_works") / bestMathcIdsFilename / "all_data.csv",
-    #     relelant_ids_path = bestMathcIdsPath,
-    #     relevant_ids_column = "OA_id",
-    #     output_dir = Path("data/citing_works") / bestMathcIdsFilename,
-    #     test=False
-    # )
-
-
-
+    # e.g. python main_new.py author_citations, or --dry-run to see what would run
+    main(build_stages(), description="Sample authors and collect their works and citations")
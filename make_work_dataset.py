@@ -1,23 +1,32 @@
 import csv
-import gzip
 import logging
-import os
+import duckdb
 import orjson
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from tqdm import tqdm
+
+from src.chunking import (
+    chunk_merger,
+    chunk_output_path,
+    merge_csv_chunks,
+    open_chunk,
+    plan_chunks,
+)
+from src.ledger import (
+    LEDGER_FILE,
+    atomic_path,
+    completed_outputs,
+    is_complete,
+    load_ledger,
+    record_output,
+)
+from src.logs import line_warning, setup_logging
+from src.partitioned import write_partitioned
+from src.task_runner import STATUS_FILE, run_tasks
 
 
 log_file = "process_log.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 MAX_RETRIES = 4
 
@@ -25,7 +34,7 @@ def process_line(line):
     try:
         record = orjson.loads(line.strip())
     except Exception as e:
-        logging.warning(f"Invalid JSON: {line} - {e}")
+        line_warning("invalid JSON", e, line)
         return None
 
     # Safely extract authorship IDs.
@@ -69,33 +78,40 @@ def process_line(line):
 
 
 
-def process_local_file(input_file, output_dir, input_dir):
+def output_path(input_file, output_dir, input_dir):
     relative_path = input_file.relative_to(input_dir)
-    output_file = output_dir / relative_path.with_suffix(".csv")
+    return output_dir / relative_path.with_suffix(".csv")
+
 
-    # check if the file is already processed
-    if output_file.exists():
+def process_local_file(input_file, output_dir, input_dir, chunk=None):
+    merged_file = output_path(input_file, output_dir, input_dir)
+    output_file = chunk_output_path(merged_file, chunk)
+    ledger = output_dir / LEDGER_FILE
+
+    # check if the file (or this chunk of it) is already processed
+    entries = load_ledger(ledger)
+    if is_complete(ledger, merged_file, entries=entries) or is_complete(
+        ledger, output_file, entries=entries
+    ):
         logging.info(f"File already processed: {output_file}")
         return
     
     rows = []
     try:
-        with gzip.open(input_file, "rt", encoding="utf-8") as f:
+        with open_chunk(input_file, chunk) as f:
             for line in f:
                 try:
                     row = process_line(line)
                     if row:
                         rows.append(row)
                 except Exception as e:
-                    logging.warning(f"Failed processing line: {e}")
+                    line_warning("failed line", e)
 
         if rows:
-            # make sure the output directory exists
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            file_exists = output_file.exists()
-            with open(output_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                if not file_exists:
+            # written to a temp file and renamed, so a crash never leaves half a file
+            with atomic_path(output_file) as tmp:
+                with open(tmp, "w", newline="", encoding="utf-8") as f:
+                    writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
                     headers = [
                         "work_id", 
                         "year", 
@@ -105,17 +121,19 @@ def process_local_file(input_file, output_dir, input_dir):
                         "author_ids"
                     ]
                     writer.writerow(headers)
-                writer.writerows(rows)
+                    writer.writerows(rows)
             print(f"Saved {len(rows)} rows to {output_file}")
+        record_output(ledger, output_file, len(rows))
 
         logging.info(f"Processed file: {input_file}")
     except Exception as e:
         logging.error(f"Error processing file {input_file}: {e}")
         raise
 
-def prep_works(output_dir, valid_ids_path, input_dir):
+def prep_works(output_dir, valid_ids_path, input_dir, split=True):
     """
     Process all files in the input_dir using the valid IDs from valid_ids_path.
+    split: Split large files into record-range chunks processed concurrently.
     """
 
     out_subfolder = output_dir / Path(valid_ids_path).stem
@@ -123,41 +141,59 @@ def prep_works(output_dir, valid_ids_path, input_dir):
 
     all_files = list(input_dir.rglob("*.gz"))
     print(f"Total files: {len(all_files)}")
-    total_files = len(all_files)
-
-    max_workers = os.cpu_count() - 2  # leave some cores free
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(process_local_file, file, out_subfolder, input_dir): file
-                for file in all_files
-            }
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # will raise exception if processing failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
-
-
-def agg_relevant_works(input_dir, output_dir):
-
-
-    all_files = list(input_dir.rglob("*.csv"))
+    tasks = plan_chunks(all_files) if split else [(file, None) for file in all_files]
+
+    run_tasks(
+        process_local_file,
+        {
+            (file, chunk): (file, out_subfolder, input_dir, chunk)
+            for file, chunk in tasks
+        },
+        status_file=out_subfolder / STATUS_FILE,
+        on_done=chunk_merger(
+            tasks,
+            lambda file, n_chunks: merge_csv_chunks(
+                output_path(file, out_subfolder, input_dir),
+                n_chunks,
+                out_subfolder / LEDGER_FILE,
+            ),
+        ),
+        max_retries=MAX_RETRIES,
+    )
+
+
+def agg_relevant_works(input_dir, output_dir, partitioned=False):
+    """
+    partitioned: Also write the works as a Parquet dataset with one row per
+    (work, author), bucketed by author and partitioned by year (see
+    src/partitioned.py), at output_dir/work_authors.
+    """
+
+    # only read outputs verified by the ledger (falls back to all CSVs for old runs)
+    ledger = input_dir / LEDGER_FILE
+    if ledger.exists():
+        all_files = completed_outputs(ledger, ".csv")
+    else:
+        all_files = [f for f in input_dir.rglob("*.csv") if f.name != "all_data.csv"]
     print(f"Total files: {len(all_files)}")
     
     all_data = pd.concat([pd.read_csv(file) for file in all_files])
-    all_data.to_csv(output_dir / "all_data.csv", index=False)
+    with atomic_path(output_dir / "all_data.csv") as tmp:
+        all_data.to_csv(tmp, index=False)
+
+    if partitioned:
+        conn = duckdb.connect(database=":memory:")
+        conn.register("all_data", all_data)
+        rows = write_partitioned(
+            conn,
+            """
+            SELECT * EXCLUDE (author_ids), UNNEST(string_split(author_ids, '|')) AS author_id
+            FROM all_data
+            WHERE author_ids IS NOT NULL AND author_ids <> ''
+            """,
+            output_dir / "work_authors",
+            "author_id",
+            "year",
+        )
+        conn.close()
+        print(f"Saved {rows} work-author rows to {output_dir / 'work_authors'}")
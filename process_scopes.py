@@ -1,15 +1,24 @@
 import csv
-import gzip
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import orjson
 import pandas as pd
-from tqdm import tqdm
 
+from src.batches import author_mask, iter_matching_lines, to_id_array
+from src.chunking import (
+    chunk_merger,
+    chunk_output_path,
+    merge_csv_chunks,
+    open_chunk,
+    plan_chunks,
+)
 from src.download_s3 import download_all_files
+from src.id_lists import load_ids
+from src.ledger import LEDGER_FILE, atomic_path, is_complete, load_ledger, record_output
+from src.logs import line_warning, setup_logging
+from src.metrics import METRICS_FILE, TaskMetrics, write_run_report
+from src.task_runner import STATUS_FILE, run_tasks
 
 # Local Directories
 download_dir = Path("data/snapshot")
@@ -20,39 +29,33 @@ log_file = "process_log.log"
 output_dir.mkdir(parents=True, exist_ok=True)
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 # Retry mechanism
 MAX_RETRIES = 3
 
 
 def load_valid_ids(path, id_col):
-    if path.endswith(".txt"):
-        with open(path, "r", encoding="utf-8") as f:
-            return {line.strip() for line in f if line.strip()}
-    elif path.endswith(".csv"):
-        df = pd.read_csv(path)
-        return set(df[id_col])
-    else:
-        # excel
-        df = pd.read_excel(path)
-        return set(df[id_col])
+    # normalized and cached by the shared loader (TXT, CSV, Excel or Parquet)
+    return load_ids(path, id_col)
 
 
-def process_line(line, valid_ids):
+def parse_line(line):
     try:
-        record = orjson.loads(line.strip())
+        return orjson.loads(line.strip())
     except Exception as e:
-        logging.warning(f"Invalid JSON: {line} - {e}")
+        line_warning("invalid JSON", e, line)
         return None  # Skip invalid or malformed lines
 
+
+def process_line(line, valid_ids):
+    record = parse_line(line)
+    if record is None:
+        return None
+    return scope_record(record, valid_ids)
+
+
+def scope_record(record, valid_ids):
     publication_year = record.get("publication_year")
     record_type = record.get("type")
     authorships = record.get("authorships", [])
@@ -104,45 +107,106 @@ def process_line(line, valid_ids):
     return results
 
 
-def save_to_csv(scope, rows, file_prefix, folder_name):
-    scope_dir = output_dir / folder_name / scope
-    scope_dir.mkdir(parents=True, exist_ok=True)
-    file_path = scope_dir / f"{file_prefix}_{scope}.csv"
+def scope_file(scope, file_prefix, folder_name):
+    return output_dir / folder_name / scope / f"{file_prefix}_{scope}.csv"
+
+
+def ledger_file(folder_name):
+    return output_dir / folder_name / LEDGER_FILE
+
+
+def save_to_csv(scope, rows, file_prefix, folder_name, chunk=None):
+    file_path = chunk_output_path(scope_file(scope, file_prefix, folder_name), chunk)
 
-    file_exists = file_path.exists()
-    with open(file_path, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        if not file_exists:
+    # written to a temp file and renamed, so a crash never leaves half a file
+    with atomic_path(file_path) as tmp:
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
             headers = {
                 "works": ["author_id", "year", "type", "count"],
                 "coauthors": ["author_id", "year", "type", "coauthors"],
                 "citations": ["author_id", "year", "citation_year", "type", "count"],
             }
             writer.writerow(headers[scope])
-        writer.writerows(rows)
-
-
-def process_local_file(local_file_path, valid_ids, folder_name):
+            writer.writerows(rows)
+    record_output(ledger_file(folder_name), file_path, len(rows))
+
+
+def is_processed(file_prefix, folder_name, chunk=None):
+    entries = load_ledger(ledger_file(folder_name))
+    for scope in ["works", "coauthors", "citations"]:
+        merged_file = scope_file(scope, file_prefix, folder_name)
+        if not (
+            is_complete(None, merged_file, entries=entries)
+            or is_complete(None, chunk_output_path(merged_file, chunk), entries=entries)
+        ):
+            return False
+    return True
+
+
+def process_lines(lines, valid_ids, results, metrics=None):
+    metrics = metrics or TaskMetrics()
+    for line in lines:
+        try:
+            with metrics.timer("parse"):
+                record = parse_line(line)
+            if record is None:
+                metrics.add("parse_errors")
+                continue
+            metrics.add("records_parsed")
+            with metrics.timer("filter"):
+                line_result = scope_record(record, valid_ids)
+            if any(line_result.values()):
+                metrics.add("records_matched")
+            for scope in results:
+                results[scope].extend(line_result[scope])
+        except Exception as e:
+            line_warning("failed line", e)
+
+
+def process_local_file(local_file_path, valid_ids, folder_name, batched=False, chunk=None):
+    """
+    batched: Parse the file in Arrow batches and only run process_line on the
+    works that have at least one valid author.
+    chunk: Only process this record range of the file (see src/chunking.py).
+    Returns the task's metrics (see src/metrics.py).
+    """
     file_prefix = Path(local_file_path).stem
     results = {"works": [], "coauthors": [], "citations": []}
 
+    # skip files whose outputs are all recorded in the ledger
+    if is_processed(file_prefix, folder_name, chunk):
+        logging.info(f"File already processed: {local_file_path}")
+        return
+
+    metrics = TaskMetrics()
     try:
-        # Process file in chunks to reduce memory usage
-        with gzip.open(local_file_path, "rt", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    line_result = process_line(line, valid_ids)
-                    if line_result:
-                        for scope in results:
-                            results[scope].extend(line_result[scope])
-                except Exception as e:
-                    logging.warning(f"Failed processing line: {e}")
+        if batched:
+            id_array = to_id_array(valid_ids)
+            process_lines(
+                iter_matching_lines(
+                    local_file_path,
+                    lambda table: author_mask(table, id_array),
+                    chunk=chunk,
+                    metrics=metrics,
+                ),
+                valid_ids,
+                results,
+                metrics,
+            )
+        else:
+            # Process file in chunks to reduce memory usage
+            with open_chunk(local_file_path, chunk, metrics=metrics) as f:
+                process_lines(f, valid_ids, results, metrics)
 
         # Save results for each scope
-        for scope, rows in results.items():
-            save_to_csv(scope, rows, file_prefix, folder_name)
+        with metrics.timer("write"):
+            for scope, rows in results.items():
+                save_to_csv(scope, rows, file_prefix, folder_name, chunk)
+                metrics.add("rows_emitted", len(rows))
 
         logging.info(f"Successfully processed file: {local_file_path}")
+        return metrics.result()
     except Exception as e:
         logging.error(f"Error processing file {local_file_path}: {e}")
         raise
@@ -160,48 +224,45 @@ def make_folder(output_dir, ids_path):
     return folder_name
 
 
-def process_all(output_dir, valid_ids_path, id_col):
+def merge_scopes(file, folder_name, n_chunks):
+    file_prefix = Path(file).stem
+    for scope in ["works", "coauthors", "citations"]:
+        merge_csv_chunks(
+            scope_file(scope, file_prefix, folder_name),
+            n_chunks,
+            ledger_file(folder_name),
+        )
+
+
+def process_all(output_dir, valid_ids_path, id_col, batched=False, split=True):
     """
     Process all files in the download directory using given valid IDs file as reference.
     output_dir: Path to the defined output directory.
     valid_ids_path: Path to the file containing valid author IDs.
+    batched: Use the vectorized Arrow filter in the workers (see src/batches.py).
+    split: Split large files into record-range chunks processed concurrently.
     """
 
     valid_ids = load_valid_ids(valid_ids_path, id_col)
 
     folder_name = make_folder(output_dir, valid_ids_path)
     all_files = list(download_dir.glob("*.gz"))
-    total_files = len(all_files)
-
-    max_workers = os.cpu_count() - 2  # 2 cores for other tasks
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(
-            max_workers=max_workers
-        ) as executor:  # max_workers=max_workers
-            futures = {
-                executor.submit(process_local_file, file, valid_ids, folder_name): file
-                for file in all_files
-            }
-
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # Raises exception if worker failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
+    tasks = plan_chunks(all_files) if split else [(file, None) for file in all_files]
+
+    run_tasks(
+        process_local_file,
+        {
+            (file, chunk): (file, valid_ids, folder_name, batched, chunk)
+            for file, chunk in tasks
+        },
+        status_file=output_dir / folder_name / STATUS_FILE,
+        on_done=chunk_merger(
+            tasks, lambda file, n_chunks: merge_scopes(file, folder_name, n_chunks)
+        ),
+        max_retries=MAX_RETRIES,
+        metrics_file=output_dir / folder_name / METRICS_FILE,
+    )
+    write_run_report(output_dir / folder_name / METRICS_FILE)
 
 
 # Example
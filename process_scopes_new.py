@@ -1,15 +1,15 @@
 import csv
 import gzip
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import orjson
 import pandas as pd
-from tqdm import tqdm
 
 from src.download_s3 import download_all_files
+from src.id_lists import load_ids
+from src.logs import line_warning, setup_logging
+from src.task_runner import run_tasks
 
 # Local Directories
 download_dir = Path("data/snapshot")
@@ -20,37 +20,22 @@ log_file = "process_log.log"
 output_dir.mkdir(parents=True, exist_ok=True)
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 # Retry mechanism
 MAX_RETRIES = 4
 
 
 def load_valid_ids(path, id_col):
-    if path.endswith(".txt"):
-        with open(path, "r", encoding="utf-8") as f:
-            return {line.strip() for line in f if line.strip()}
-    elif path.endswith(".csv"):
-        df = pd.read_csv(path)
-        return set(df[id_col])
-    else:
-        # excel
-        df = pd.read_excel(path)
-        return set(df[id_col])
+    # normalized and cached by the shared loader (TXT, CSV, Excel or Parquet)
+    return load_ids(path, id_col)
 
 
 def process_line(line, valid_ids):
     try:
         record = orjson.loads(line.strip())
     except Exception as e:
-        logging.warning(f"Invalid JSON: {line} - {e}")
+        line_warning("invalid JSON", e, line)
         return None  # Skip invalid or malformed lines
 
     publication_year = record.get("publication_year")
@@ -119,7 +104,7 @@ def process_local_file(local_file_path, valid_ids, folder_name):
                         for scope in results:
                             results[scope].extend(line_result[scope])
                 except Exception as e:
-                    logging.warning(f"Failed processing line: {e}")
+                    line_warning("failed line", e)
 
         # Save results for each scope
         for scope, rows in results.items():
@@ -154,37 +139,12 @@ def process_all(output_dir, valid_ids_path, id_col):
 
     folder_name = make_folder(output_dir, valid_ids_path)
     all_files = list(download_dir.glob("*.gz"))
-    total_files = len(all_files)
-
-    max_workers = os.cpu_count() - 2  # 2 cores for other tasks
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(
-            max_workers=max_workers
-        ) as executor:  # max_workers=max_workers
-            futures = {
-                executor.submit(process_local_file, file, valid_ids, folder_name): file
-                for file in all_files
-            }
 
-            for future in as_completed(futures):
-                file = futures[future]
-                retries = 0
-                while retries < MAX_RETRIES:
-                    try:
-                        future.result()  # Raises exception if worker failed
-                        progress.update(1)
-                        break
-                    except Exception as e:
-                        retries += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {retries}/{MAX_RETRIES}): {e}"
-                        )
-                        if retries >= MAX_RETRIES:
-                            logging.error(
-                                f"File {file} failed after {MAX_RETRIES} retries."
-                            )
+    run_tasks(
+        process_local_file,
+        {(file, None): (file, valid_ids, folder_name) for file in all_files},
+        max_retries=MAX_RETRIES,
+    )
 
 
 # Example
@@ -0,0 +1,158 @@
+import logging
+from pathlib import Path
+
+import duckdb
+import pandas as pd
+
+from src.id_lists import load_ids
+from src.ledger import atomic_path
+from src.logs import setup_logging
+from src.partitioned import write_partitioned
+from src.task_runner import STATUS_FILE, run_tasks
+from warehouse import create_views, process_part, prune_stale, sql_path
+
+# Local Directories
+works_dir = Path("data/snapshot/openalex-snapshot/data/works")
+relations_dir = Path("data/relations")
+log_file = "process_log.log"
+
+# Setup logging
+setup_logging(log_file)
+
+MAX_RETRIES = 4
+
+# Tables of the warehouse (see warehouse.py) the relations are made of:
+# authorship(work_id, author_id, position, institution_ids, year, ...),
+# reference(citing_id, cited_id, citing_year) and work, which holds the
+# attributes of each work (type, ...) and decides which version of a work counts
+RELATION_TABLES = ("work", "authorship", "reference")
+
+# The scopes of process_scopes.py as joins over the relations. {authors} is
+# replaced by the filter on the selected authors
+SCOPE_QUERIES = {
+    "works": """
+        SELECT a.author_id, a.year, w.type, COUNT(*) AS total_count
+        FROM authorship a
+        JOIN work w ON w.id = a.work_id
+        WHERE {authors}
+        GROUP BY a.author_id, a.year, w.type
+    """,
+    # coauthors are identified by their IDs rather than their display names
+    "coauthors": """
+        SELECT a.author_id, a.year, w.type, STRING_AGG(c.author_id, ';') AS all_coauthors
+        FROM authorship a
+        JOIN work w ON w.id = a.work_id
+        LEFT JOIN authorship c ON c.work_id = a.work_id AND c.author_id <> a.author_id
+        WHERE {authors}
+        GROUP BY a.author_id, a.year, w.type
+    """,
+    # citations received by each author's works, by year of the citing work.
+    # Complete only if the reference relation comes from the whole snapshot
+    "citations": """
+        SELECT
+            a.author_id, a.year, r.citing_year AS citation_year, w.type,
+            COUNT(*) AS total_count
+        FROM reference r
+        JOIN authorship a ON a.work_id = r.cited_id
+        JOIN work w ON w.id = a.work_id
+        WHERE {authors}
+        GROUP BY a.author_id, a.year, r.citing_year, w.type
+    """,
+}
+
+
+def extract_relations(output_dir=relations_dir, input_dir=works_dir):
+    """
+    Extract the authorship and reference relations (and the work table) of
+    works parts into compressed Parquet files, in one pass over each part.
+    Parts are processed in parallel and only new parts on a rerun.
+    input_dir: The snapshot's works. The citations scope counts the references
+    of every work, so relations extracted from a subset (e.g. the relevant works
+    of get_relevant_works.py) only hold the citations made within that subset.
+    """
+    if not (Path(input_dir) / "manifest").exists():
+        logging.warning(
+            f"{input_dir} is not a snapshot entity directory: the citations scope "
+            "will only count citations made by the works in it"
+        )
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    parts = sorted(Path(input_dir).rglob("*.gz"))
+    tasks = {(part, None): ("works", part, input_dir, output_dir, RELATION_TABLES) for part in parts}
+    logging.info(f"Extracting relations from {len(tasks)} parts")
+
+    failed = run_tasks(
+        process_part,
+        tasks,
+        status_file=output_dir / STATUS_FILE,
+        max_retries=MAX_RETRIES,
+    )
+    prune_stale("works", parts, input_dir, output_dir, RELATION_TABLES)
+    return failed
+
+
+def connect(input_dir=relations_dir):
+    """
+    In-memory DuckDB connection with a view per relation, keeping the latest
+    version of each work.
+    """
+    conn = duckdb.connect(database=":memory:")
+    create_views(conn, input_dir)
+    return conn
+
+
+def select_authors(conn, valid_ids_path=None, id_col="id"):
+    """
+    Register the authors of an ID list as the table selected_authors and return
+    the filter of SCOPE_QUERIES on them (no filter without a list).
+    """
+    if valid_ids_path is None:
+        return "TRUE"
+    selected_authors = pd.DataFrame({"author_id": sorted(load_ids(valid_ids_path, id_col))})
+    conn.register("selected_authors", selected_authors)
+    return "a.author_id IN (SELECT author_id FROM selected_authors)"
+
+
+def scope_table(scope, input_dir=relations_dir, valid_ids_path=None, id_col="id"):
+    """
+    One scope (works, coauthors or citations) per author, year and type as a
+    DataFrame, for the authors of an ID list (default: all authors).
+    """
+    conn = connect(input_dir)
+    authors = select_authors(conn, valid_ids_path, id_col)
+    df = conn.execute(SCOPE_QUERIES[scope].format(authors=authors)).df()
+    conn.close()
+    return df
+
+
+def aggregate_relations(input_dir, output_dir, valid_ids_path=None, id_col="id", partitioned=False):
+    """
+    Write the aggregated scopes of juntator.aggregate_all, computed from the
+    relations instead of the processed_scopes CSVs.
+    partitioned: Write author-bucketed Parquet datasets instead of CSVs.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    conn = connect(input_dir)
+    authors = select_authors(conn, valid_ids_path, id_col)
+    for scope, query in SCOPE_QUERIES.items():
+        query = query.format(authors=authors)
+        output_file = output_dir / f"aggregated_{scope}.csv"
+        if partitioned:
+            rows = write_partitioned(conn, query, output_file.with_suffix(""), "author_id", "year")
+        else:
+            with atomic_path(output_file) as tmp:
+                conn.execute(f"COPY ({query}) TO '{sql_path(tmp)}' (HEADER, DELIMITER ',')")
+            rows = conn.execute(f"SELECT COUNT(*) FROM read_csv('{sql_path(output_file)}')").fetchone()[0]
+        logging.info(f"Aggregated {scope} ({rows} rows) saved to {output_file}")
+    conn.close()
+
+
+# Example
+if __name__ == "__main__":
+    extract_relations()
+    aggregate_relations(
+        relations_dir,
+        Path("aggregated_results_duckdb/allAcademics202501"),
+        valid_ids_path="data/ids/allAcademics202501.csv",
+    )
@@ -1,45 +1,84 @@
 import csv
 import gzip
+import hashlib
+import heapq
 import logging
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+import duckdb
 import orjson
 import pandas as pd
-from tqdm import tqdm
+import pyarrow.dataset as ds
+
+from src.id_lists import load_ids
+from src.ledger import LEDGER_FILE, atomic_path, completed_outputs, is_complete, record_output
+from src.logs import line_warning, setup_logging
+from src.progress import load_manifest_sizes, manifest_dir
+from src.task_runner import STATUS_FILE, run_tasks
 
 log_file = "process_log.log"
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(),
-    ],
-)
+setup_logging(log_file)
 
 MAX_RETRIES = 4
 
-# Load the institution IDs once (outside the per-line function)
-def load_institution_ids():
+# Parquet copy of the institutions sheet, so workers never parse the Excel file
+INSTITUTION_CACHE = Path("data/cache/top150_openalex_ids.parquet")
+
+
+def institution_excel_path():
     db_path = os.getenv("db_path")
     if not db_path:
         raise ValueError("Environment variable 'db_path' is not set.")
-    excel_path = Path(db_path, "Science Twitter/Data/Raw/openalex/institutions/top150_openalex_ids.xlsx")
-    df = pd.read_excel(excel_path)
-    return set(df["id"])
+    return Path(db_path, "Science Twitter/Data/Raw/openalex/institutions/top150_openalex_ids.xlsx")
+
+
+def build_institution_cache(excel_path=None, cache_path=INSTITUTION_CACHE):
+    """
+    Convert the institution IDs sheet to a one-column Parquet file, unless the
+    cache is already newer than the sheet. Returns the cache path.
+    """
+    excel_path = Path(excel_path) if excel_path else institution_excel_path()
+    cache_path = Path(cache_path)
+    if cache_path.exists() and cache_path.stat().st_mtime >= excel_path.stat().st_mtime:
+        return cache_path
+    logging.info(f"Caching institution IDs from {excel_path}")
+    ids = pd.read_excel(excel_path, usecols=["id"])["id"].dropna().astype(str)
+    with atomic_path(cache_path) as tmp:
+        pd.DataFrame({"id": ids.drop_duplicates()}).to_parquet(tmp, index=False)
+    return cache_path
+
+
+def load_institution_ids(cache_path=INSTITUTION_CACHE):
+    return set(pd.read_parquet(cache_path, columns=["id"])["id"])
+
+
+# Per-process cache for institution_ids, filled by init_worker or on first use
+INSTITUTION_IDS = None
+
+
+def init_worker(cache_path=INSTITUTION_CACHE):
+    """
+    Pool initializer: load the institution IDs once per worker process.
+    """
+    global INSTITUTION_IDS
+    INSTITUTION_IDS = load_institution_ids(cache_path)
+
+
+def get_institution_ids():
+    if INSTITUTION_IDS is None:
+        init_worker(build_institution_cache())
+    return INSTITUTION_IDS
 
-# Global cache for institution_ids (loaded only once)
-INSTITUTION_IDS = load_institution_ids()
 
 def pick_author_id(line):
     record = orjson.loads(line.strip())
     # check if the author has any affiliations at all
     if not record.get("affiliations"):
         return None
-    elif any(aff["institution"]["id"] in INSTITUTION_IDS for aff in record["affiliations"]):
+    institution_ids = get_institution_ids()
+    if any(aff["institution"]["id"] in institution_ids for aff in record["affiliations"]):
         return record["id"]
     return None
 
@@ -47,9 +86,10 @@ def process_local_file(input_file, output_dir):
     # grab the bit relative to openalex-snapshot/data/authors
     relative_path = input_file.relative_to("data/snapshot/openalex-snapshot/data/authors")
     output_file = output_dir / relative_path.with_suffix(".csv")
+    ledger = output_dir / LEDGER_FILE
     
     # check if the file is already processed
-    if output_file.exists():
+    if is_complete(ledger, output_file):
         logging.info(f"File already processed: {output_file}")
         return
     
@@ -64,15 +104,16 @@ def process_local_file(input_file, output_dir):
                         # Wrap the result in a list to form a valid CSV row.
                         lines.append([line_result])
                 except Exception as e:
-                    logging.warning(f"Failed processing line: {e}")
+                    line_warning("failed line", e)
 
         # Save results
         if lines:
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(output_file, "w", encoding="utf-8", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(["id"])
-                writer.writerows(lines)
+            with atomic_path(output_file) as tmp:
+                with open(tmp, "w", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["id"])
+                    writer.writerows(lines)
+        record_output(ledger, output_file, len(lines))
                     
         logging.info(f"Successfully processed file: {input_file}")
     except Exception as e:
@@ -85,36 +126,27 @@ def get_all_authors(output_dir):
     """
     input_dir = Path("data/snapshot/openalex-snapshot/data/authors")
     all_files = list(input_dir.rglob("*.gz"))
-    total_files = len(all_files)
 
-    max_workers = os.cpu_count() - 2 if os.cpu_count() and os.cpu_count() > 2 else 1
-    logging.info(f"Using {max_workers} workers")
-
-    with tqdm(total=total_files, desc="Overall Progress") as progress:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            # Map file to its future.
-            futures = {executor.submit(process_local_file, file, output_dir): file for file in all_files}
-
-            for future in as_completed(futures):
-                file = futures[future]
-                attempt = 0
-                while attempt < MAX_RETRIES:
-                    try:
-                        future.result()  # This will raise if the worker failed.
-                        progress.update(1)
-                        break  # Break out if successful.
-                    except Exception as e:
-                        attempt += 1
-                        logging.error(
-                            f"Failed processing file {file} (Attempt {attempt}/{MAX_RETRIES}): {e}"
-                        )
-                        if attempt >= MAX_RETRIES:
-                            logging.error(f"File {file} failed after {MAX_RETRIES} retries.")
-                            break  # Optionally, you could re-submit the task here.
+    # convert the institutions sheet once, here, instead of in every worker
+    cache_path = build_institution_cache()
+
+    run_tasks(
+        process_local_file,
+        {(file, None): (file, output_dir) for file in all_files},
+        status_file=Path(output_dir) / STATUS_FILE,
+        max_retries=MAX_RETRIES,
+        initializer=init_worker,
+        initargs=(cache_path,),
+    )
 
 # finally let's define a function that takes all the processed files and aggregates them
 def aggregate_authors(input_dir, output_file):
-    all_files = list(input_dir.rglob("*.csv"))
+    # only read outputs verified by the ledger (falls back to all CSVs for old runs)
+    ledger = input_dir / LEDGER_FILE
+    if ledger.exists():
+        all_files = completed_outputs(ledger, ".csv")
+    else:
+        all_files = [f for f in input_dir.rglob("*.csv") if f != Path(output_file)]
     total_files = len(all_files)
     logging.info(f"Found {total_files} files to aggregate.")
 
@@ -128,7 +160,205 @@ def aggregate_authors(input_dir, output_file):
 
     logging.info(f"Total authors: {len(all_authors)}")
 
-    with open(output_file, "w", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["id"])
-        writer.writerows([[author] for author in all_authors])
\ No newline at end of file
+    with atomic_path(output_file) as tmp:
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id"])
+            writer.writerows([[author] for author in all_authors])
+
+# Explicit schema of the authors snapshot: only the fields the filter needs
+AUTHOR_COLUMNS = {
+    "id": "VARCHAR",
+    "affiliations": "STRUCT(institution STRUCT(id VARCHAR), years BIGINT[])[]",
+}
+
+
+def select_authors(
+    output_file,
+    input_dir=Path("data/snapshot/openalex-snapshot/data/authors"),
+    institution_cache=None,
+    min_year=None,
+    max_year=None,
+    threads=None,
+):
+    """
+    Vectorized alternative to get_all_authors + aggregate_authors. DuckDB reads the
+    authors snapshot with an explicit schema, unnests the affiliations, keeps the
+    ones at the listed institutions and writes one sorted, deduplicated Parquet
+    list of author IDs. Malformed records are skipped, and the records read are
+    logged against the record count of the manifest.
+    institution_cache: Parquet file with an "id" column; defaults to the cached
+    top150 institutions sheet (see build_institution_cache).
+    min_year, max_year: Only count affiliations with at least one year in range.
+    threads: DuckDB threads; defaults to all cores.
+    """
+    institution_cache = institution_cache or build_institution_cache()
+    files = str(Path(input_dir) / "**" / "*.gz").replace("'", "''")
+    columns = ", ".join(f"'{name}': '{kind}'" for name, kind in AUTHOR_COLUMNS.items())
+
+    conn = duckdb.connect(database=":memory:")
+    if threads:
+        conn.execute(f"SET threads = {int(threads)}")
+    # a few hundred institutions, inlined so the filter runs inside one lambda
+    institutions = conn.execute("SELECT id FROM read_parquet(?)", [str(institution_cache)]).fetchall()
+    institution_list = ", ".join("'" + str(i).replace("'", "''") + "'" for (i,) in institutions)
+    condition = f"list_contains([{institution_list}]::VARCHAR[], aff.institution.id)"
+    if min_year is not None or max_year is not None:
+        low = int(min_year) if min_year is not None else 0
+        high = int(max_year) if max_year is not None else 9999
+        condition += f" AND len(list_filter(aff.years, y -> y BETWEEN {low} AND {high})) > 0"
+
+    # one scan counts the records read and collects the matching authors;
+    # malformed records are skipped, as in the other stages
+    conn.execute(
+        f"""
+        CREATE TEMP TABLE scan AS
+        SELECT count(id) AS records, list(id) FILTER (WHERE matched) AS ids
+        FROM (
+            SELECT id, len(list_filter(affiliations, aff -> {condition})) > 0 AS matched
+            FROM read_json(
+                '{files}', format = 'newline_delimited', compression = 'gzip',
+                columns = {{{columns}}}, ignore_errors = true
+            )
+        )
+        """
+    )
+    records = conn.execute("SELECT records FROM scan").fetchone()[0]
+    query = "SELECT DISTINCT id FROM (SELECT UNNEST(ids) AS id FROM scan) WHERE id IS NOT NULL ORDER BY id"
+    with atomic_path(output_file) as tmp:
+        conn.execute(f"COPY ({query}) TO '{str(tmp).replace(chr(39), chr(39) * 2)}' (FORMAT parquet)")
+    total = conn.execute("SELECT COUNT(*) FROM read_parquet(?)", [str(output_file)]).fetchone()[0]
+    conn.close()
+    log_records_read(records, input_dir)
+    logging.info(f"Total authors: {total}")
+    return total
+
+
+def log_records_read(records, input_dir):
+    """
+    Log the records read from a snapshot entity against its manifest's record
+    count; fewer means malformed records were skipped.
+    """
+    entity_dir = manifest_dir(input_dir)
+    sizes = load_manifest_sizes(entity_dir).values() if entity_dir is not None else []
+    expected = sum(size["records"] or 0 for size in sizes)
+    if not expected:
+        logging.info(f"Read {records:,} records from {input_dir}")
+    elif records < expected:
+        logging.warning(
+            f"Read {records:,} of the {expected:,} records in the manifest of {input_dir}; "
+            f"{expected - records:,} malformed records were skipped"
+        )
+    else:
+        logging.info(f"Read {records:,} records from {input_dir} ({expected:,} in the manifest)")
+
+
+def id_hash(author_id, seed):
+    """
+    Deterministic 64-bit hash of an author ID under a seed. The sample is the set
+    of IDs with the smallest hashes, so it only depends on the seed and the IDs,
+    not on file order, and a larger n always contains the smaller sample.
+    """
+    digest = hashlib.blake2b(f"{seed}:{author_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def iter_id_batches(path, columns, batch_size=1_000_000):
+    """
+    Stream the given columns of a CSV or Parquet file (or directory of them) in
+    record batches, without loading the whole list.
+    """
+    path = Path(path)
+    suffix = path.suffix if path.is_file() else next(path.rglob("*.*")).suffix
+    file_format = "parquet" if suffix == ".parquet" else "csv"
+    dataset = ds.dataset(path, format=file_format)
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        yield batch.to_pydict()
+
+
+def read_forced_ids(path, id_col):
+    return sorted(load_ids(path, id_col))
+
+
+def sample_author_ids(
+    input_path,
+    output_file,
+    n=None,
+    seed=42,
+    id_col="id",
+    strata=None,
+    n_per_stratum=None,
+    forced=None,
+    forced_id_col="id",
+):
+    """
+    Streaming, reproducible sample of author IDs (bottom-k hash sampling).
+    input_path: CSV/Parquet list of author IDs (e.g. the output of aggregate_authors
+    or select_authors), streamed in batches.
+    n: Sample size when not stratified.
+    strata, n_per_stratum: Column names (e.g. institution, field, career start year)
+    and the number of authors to sample from each combination of their values.
+    forced: Paths of ID lists to always include (e.g. the potential Twitter matches),
+    written first and not counted in n.
+    Writes a CSV with the id, a "source" column (forced/sample) and the strata.
+    """
+    if (n is None) == (n_per_stratum is None):
+        raise ValueError("Give either n or n_per_stratum.")
+    strata = list(strata or [])
+    if n_per_stratum is not None and not strata:
+        raise ValueError("n_per_stratum needs strata columns.")
+    k = n if n is not None else n_per_stratum
+
+    forced_ids = {}
+    for path in forced or []:
+        for author_id in read_forced_ids(path, forced_id_col):
+            forced_ids.setdefault(author_id, None)
+
+    # per stratum, a max-heap of (-hash, id, stratum values) holding the k smallest
+    # hashes; members holds the IDs in any heap, so an ID listed under several
+    # strata is sampled once (in the first stratum that holds it)
+    heaps = {}
+    members = set()
+    seen = 0
+    for batch in iter_id_batches(input_path, [id_col] + strata):
+        ids = batch[id_col]
+        values = list(zip(*(batch[col] for col in strata))) if strata else [()] * len(ids)
+        for author_id, stratum in zip(ids, values):
+            if author_id is None:
+                continue
+            seen += 1
+            author_id = str(author_id)
+            if author_id in forced_ids:
+                forced_ids[author_id] = stratum
+                continue
+            h = id_hash(author_id, seed)
+            if author_id in members:
+                continue  # duplicate ID
+            heap = heaps.setdefault(stratum, [])
+            if len(heap) < k:
+                heapq.heappush(heap, (-h, author_id, stratum))
+                members.add(author_id)
+            elif -heap[0][0] > h:
+                _, dropped, _ = heapq.heapreplace(heap, (-h, author_id, stratum))
+                members.discard(dropped)
+                members.add(author_id)
+
+    # stratum values can be None, which do not compare with the other values
+    sampled = sorted(
+        ((author_id, stratum) for heap in heaps.values() for _, author_id, stratum in heap),
+        key=lambda t: (t[0], tuple(map(str, t[1]))),
+    )
+    logging.info(
+        f"Sampled {len(sampled)} of {seen} authors in {len(heaps)} strata, "
+        f"plus {len(forced_ids)} forced"
+    )
+
+    with atomic_path(output_file) as tmp:
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "source"] + strata)
+            for author_id, stratum in forced_ids.items():
+                writer.writerow([author_id, "forced"] + list(stratum or [None] * len(strata)))
+            for author_id, stratum in sampled:
+                writer.writerow([author_id, "sample"] + list(stratum))
+    return len(forced_ids) + len(sampled)
@@ -0,0 +1,160 @@
+import io
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+
+from src.chunking import open_chunk
+from src.metrics import TaskMetrics
+
+# Number of lines parsed together in batched mode
+BATCH_SIZE = 20_000
+
+# Only the fields the workers actually use are parsed; everything else is ignored
+AUTHOR_TYPE = pa.struct([("id", pa.string()), ("display_name", pa.string())])
+
+WORKS_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("publication_year", pa.int64()),
+        ("type", pa.string()),
+        ("authorships", pa.list_(pa.struct([("author", AUTHOR_TYPE)]))),
+        (
+            "counts_by_year",
+            pa.list_(pa.struct([("year", pa.int64()), ("cited_by_count", pa.int64())])),
+        ),
+        ("referenced_works", pa.list_(pa.string())),
+    ]
+)
+
+
+def iter_line_batches(path, batch_size=BATCH_SIZE, chunk=None, metrics=None):
+    """
+    Yield lists of raw (bytes) lines from a gzipped JSON-lines file.
+    path: Path to the .gz file.
+    batch_size: Number of lines per batch.
+    chunk: Only read this record range of the file (see src/chunking.py).
+    metrics: TaskMetrics to count and time the reads (see src/metrics.py).
+    """
+    with open_chunk(path, chunk, text=False, metrics=metrics) as f:
+        batch = []
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def parse_batch(lines, schema=WORKS_SCHEMA):
+    """
+    Parse a batch of raw JSON lines into an Arrow table with an explicit schema.
+    Raises if any line in the batch is malformed; callers fall back to per-line
+    processing in that case.
+    """
+    data = b"".join(line if line.endswith(b"\n") else line + b"\n" for line in lines)
+    return pa_json.read_json(
+        io.BytesIO(data),
+        read_options=pa_json.ReadOptions(block_size=max(len(data), 1 << 20)),
+        parse_options=pa_json.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior="ignore"
+        ),
+    )
+
+
+def author_ids_column(table):
+    """
+    Flatten the authorships of a works table.
+    Returns (author_ids, row_indices): one entry per authorship, with the index of
+    the work it belongs to.
+    """
+    authorships = table.column("authorships").combine_chunks()
+    row_indices = pc.list_parent_indices(authorships)
+    authors = pc.struct_field(pc.list_flatten(authorships), "author")
+    author_ids = pc.struct_field(authors, "id")
+    return author_ids, row_indices
+
+
+def author_mask(table, valid_ids):
+    """
+    Boolean mask of the works that have at least one author in valid_ids.
+    valid_ids: pyarrow string array of author IDs (see to_id_array).
+    """
+    author_ids, row_indices = author_ids_column(table)
+    hits = pc.filter(row_indices, pc.is_in(author_ids, value_set=valid_ids))
+    mask = np.zeros(table.num_rows, dtype=bool)
+    mask[hits.to_numpy()] = True
+    return mask
+
+
+def references_mask(table, valid_ids):
+    """
+    Boolean mask of the works that reference at least one work in valid_ids.
+    valid_ids: pyarrow string array of work IDs (see to_id_array).
+    """
+    references = table.column("referenced_works").combine_chunks()
+    row_indices = pc.list_parent_indices(references)
+    hits = pc.filter(row_indices, pc.is_in(pc.list_flatten(references), value_set=valid_ids))
+    mask = np.zeros(table.num_rows, dtype=bool)
+    mask[hits.to_numpy()] = True
+    return mask
+
+
+def year_mask(table, min_year=None, max_year=None):
+    """
+    Boolean mask of the works whose publication_year lies in [min_year, max_year].
+    Works without a year never match.
+    """
+    years = table.column("publication_year")
+    mask = pc.is_valid(years)
+    if min_year is not None:
+        mask = pc.and_(mask, pc.greater_equal(years, min_year))
+    if max_year is not None:
+        mask = pc.and_(mask, pc.less_equal(years, max_year))
+    return pc.fill_null(mask, False).to_numpy(zero_copy_only=False)
+
+
+def id_numbers(ids):
+    """
+    Numeric part of OpenAlex IDs (https://openalex.org/A5012345678 -> 5012345678)
+    as an int64 array: a compact key that needs no lookup table. IDs without a
+    numeric suffix become null.
+    """
+    digits = pc.struct_field(pc.extract_regex(ids, r"(?P<n>\d+)$"), "n")
+    return pc.cast(digits, pa.int64())
+
+
+def to_id_array(ids):
+    """
+    Convert a Python set of IDs into a pyarrow string array once per file,
+    so it can be reused as the value set for every batch.
+    """
+    return pa.array([str(i) for i in ids], type=pa.string())
+
+
+def iter_matching_lines(path, mask_fn, batch_size=BATCH_SIZE, chunk=None, metrics=None):
+    """
+    Yield only the raw lines of a gzipped JSON-lines file selected by mask_fn.
+    mask_fn: takes an Arrow table of a batch and returns a boolean numpy mask.
+    When a batch fails to parse as a whole (e.g. one malformed record), all of its
+    lines are yielded so the per-line logic can still handle them one by one.
+    metrics: TaskMetrics; batch parsing is timed as parse and mask_fn as filter.
+    """
+    metrics = metrics or TaskMetrics()
+    for lines in iter_line_batches(path, batch_size, chunk, metrics):
+        try:
+            with metrics.timer("parse"):
+                table = parse_batch(lines)
+        except pa.ArrowInvalid as e:
+            logging.warning(f"Batch parse failed in {path}, falling back to lines: {e}")
+            yield from lines
+            continue
+        with metrics.timer("filter"):
+            selected = np.flatnonzero(mask_fn(table))
+        for idx in selected:
+            yield lines[idx]
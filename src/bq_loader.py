@@ -0,0 +1,426 @@
+"""
+Load OpenAlex snapshot parts into BigQuery, one JSON record per row, in
+concurrent load jobs that each cover many parts.
+
+Replaces the add-*-to-bq.sh scripts. Which parts are loaded is kept in a SQLite
+ledger instead of grepping a text file for every part. Old
+loaded_<entity>_files.txt lists are imported into the ledger, so nothing that
+was loaded by the scripts is loaded again.
+
+When the parts are mirrored on Cloud Storage (--uri-prefix gs://...), a job
+loads many parts, using one wildcard URI per complete updated_date partition.
+Local files can only be loaded one per job by bq. Every job's row count is
+checked against the record counts in the entity's manifest.
+
+    python -m src.bq_loader works --jobs 8 --uri-prefix gs://bucket/openalex-snapshot/data
+    python -m src.bq_loader authors --backend duckdb --duckdb-path data/openalex.duckdb
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import duckdb
+import orjson
+
+SNAPSHOT_DIR = Path("data/snapshot/openalex-snapshot/data")
+LEDGER_PATH = Path("data/snapshot/bq_ledger.sqlite")
+DEFAULT_PROJECT = "openalex-bq-453818"
+
+# Table and (single, string) column each entity is loaded into
+ENTITIES = {
+    "works": ("openalex.works", "work"),
+    "authors": ("openalex.authors", "author"),
+    "concepts": ("openalex.concepts", "concepts"),
+    "institutions": ("openalex.institutions", "institutions"),
+    "sources": ("openalex.sources", "sources"),
+    "topics": ("openalex.topics", "topic"),
+}
+
+# Load jobs running at the same time
+MAX_JOBS = 8
+# Limits per load job
+MAX_FILES_PER_JOB = 500
+MAX_BYTES_PER_JOB = 200 * 1024**3
+# Attempts per batch before it is left for the next run
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loaded_files (
+    path TEXT PRIMARY KEY,
+    entity TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    loaded_at REAL
+);
+CREATE INDEX IF NOT EXISTS loaded_files_entity ON loaded_files (entity);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    entity TEXT NOT NULL,
+    uris TEXT NOT NULL,
+    n_files INTEGER NOT NULL,
+    expected_rows INTEGER,
+    output_rows INTEGER,
+    status TEXT NOT NULL,
+    error TEXT,
+    started_at REAL,
+    finished_at REAL
+);
+"""
+
+
+class BqClient:
+    """
+    Runs load jobs with the bq command line tool, like the old scripts.
+    Jobs get deterministic IDs, so a job that was submitted by a run that died
+    before recording it is picked up instead of being loaded twice.
+    """
+
+    def __init__(self, project_id=DEFAULT_PROJECT, bq="bq"):
+        self.project_id = project_id
+        self.bq = bq
+
+    def run(self, *args):
+        return subprocess.run(
+            [self.bq, f"--project_id={self.project_id}", *args],
+            capture_output=True,
+            text=True,
+        )
+
+    def load(self, table, uris, column, job_id):
+        """
+        Load the files behind uris into table. Returns the number of rows loaded.
+        """
+        result = self.run(
+            f"--job_id={job_id}",
+            "load",
+            "--source_format=CSV",
+            "-F",
+            "\t",
+            "--schema",
+            f"{column}:string",
+            table,
+            ",".join(uris),
+        )
+        if result.returncode != 0 and "Already Exists" not in result.stderr + result.stdout:
+            raise RuntimeError(f"bq load failed: {result.stderr.strip() or result.stdout.strip()}")
+        if result.returncode != 0:
+            # submitted by an earlier run: wait for that job instead
+            self.run("wait", job_id)
+        shown = self.run("--format=json", "show", "-j", job_id)
+        if shown.returncode != 0:
+            raise RuntimeError(f"bq show failed: {shown.stderr.strip()}")
+        job = json.loads(shown.stdout)
+        if job["status"].get("errorResult"):
+            raise RuntimeError(f"Load job {job_id} failed: {job['status']['errorResult']}")
+        return int(job["statistics"]["load"]["outputRows"])
+
+
+class DuckDBClient:
+    """
+    Stand-in warehouse that loads into a local DuckDB database with the same
+    semantics (tab-separated single string column, wildcard URIs), for testing
+    the loader and for local work without BigQuery.
+    """
+
+    def __init__(self, db_path=":memory:"):
+        self.conn = duckdb.connect(str(db_path))
+        self.lock = threading.Lock()
+
+    def load(self, table, uris, column, job_id):
+        schema = table.split(".")[0]
+        files = ", ".join("'" + str(u).replace("'", "''") + "'" for u in uris)
+        with self.lock:
+            self.conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({column} VARCHAR)")
+            before = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            self.conn.execute(
+                f"""
+                INSERT INTO {table}
+                SELECT {column} FROM read_csv(
+                    [{files}], delim = '\t', quote = '', escape = '', header = false,
+                    columns = {{'{column}': 'VARCHAR'}}, compression = 'gzip'
+                )
+                """
+            )
+            return self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - before
+
+
+def connect_ledger(ledger_path):
+    Path(ledger_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(ledger_path, timeout=60, isolation_level=None, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def legacy_key(entity, relative_path):
+    """
+    Key under which the old scripts recorded a part in loaded_<entity>_files.txt.
+    """
+    return f"openalex-snapshot/data/{entity}/{relative_path}".replace("/", "_")
+
+
+def import_legacy_ledger(conn, entity, files, legacy_file):
+    """
+    Mark the parts listed in an old loaded_<entity>_files.txt as loaded.
+    files: Relative paths of the entity's parts.
+    """
+    if not Path(legacy_file).exists():
+        return 0
+    with open(legacy_file, "r", encoding="utf-8") as f:
+        keys = {line.strip() for line in f if line.strip()}
+    rows = [
+        (path, entity, "legacy", "loaded", None)
+        for path in files
+        if legacy_key(entity, path) in keys
+    ]
+    cur = conn.executemany("INSERT OR IGNORE INTO loaded_files VALUES (?, ?, ?, ?, ?)", rows)
+    if cur.rowcount:
+        logging.info(f"Imported {cur.rowcount} loaded {entity} parts from {legacy_file}")
+    return cur.rowcount
+
+
+def load_manifest(entity_dir):
+    """
+    Record count per part (relative path), from the entity's manifest file.
+    """
+    manifest = Path(entity_dir) / "manifest"
+    if not manifest.exists():
+        logging.warning(f"No manifest in {entity_dir}, loads cannot be validated")
+        return {}
+    entity = Path(entity_dir).name
+    counts = {}
+    for entry in orjson.loads(manifest.read_bytes())["entries"]:
+        relative = entry["url"].split(f"/{entity}/", 1)[-1]
+        counts[relative] = entry["meta"]["record_count"]
+    return counts
+
+
+def plan_batches(pending, all_files, sizes, uri_prefix, max_files, max_bytes):
+    """
+    Group pending parts into load jobs. A partition (updated_date directory)
+    whose parts are all pending becomes a single wildcard URI; the others are
+    listed part by part.
+    Returns a list of (uris, relative paths) batches.
+    """
+    by_partition = {}
+    for path in all_files:
+        by_partition.setdefault(str(Path(path).parent), []).append(path)
+    pending_set = set(pending)
+
+    units = []  # (uri, parts)
+    for partition, parts in sorted(by_partition.items()):
+        todo = [p for p in parts if p in pending_set]
+        if not todo:
+            continue
+        if len(todo) == len(parts):
+            units.append((f"{uri_prefix}/{partition}/*.gz", todo))
+        else:
+            units.extend((f"{uri_prefix}/{p}", [p]) for p in todo)
+
+    batches = []
+    uris, paths, size = [], [], 0
+    for uri, parts in units:
+        unit_size = sum(sizes[p] for p in parts)
+        if paths and (len(paths) + len(parts) > max_files or size + unit_size > max_bytes):
+            batches.append((uris, paths))
+            uris, paths, size = [], [], 0
+        uris.append(uri)
+        paths.extend(parts)
+        size += unit_size
+    if paths:
+        batches.append((uris, paths))
+    return batches
+
+
+def job_id_for(entity, paths, attempt):
+    digest = hashlib.sha1("\n".join(sorted(paths)).encode()).hexdigest()[:16]
+    return f"openalex_{entity}_{digest}_{attempt}"
+
+
+def record_job(conn, lock, job_id, entity, uris, paths, expected, output_rows, status, error, started):
+    with lock:
+        conn.execute("BEGIN")
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                job_id,
+                entity,
+                orjson.dumps(uris).decode(),
+                len(paths),
+                expected,
+                output_rows,
+                status,
+                error,
+                started,
+                time.time(),
+            ),
+        )
+        if status != "failed":
+            conn.executemany(
+                "INSERT OR REPLACE INTO loaded_files VALUES (?, ?, ?, ?, ?)",
+                [(p, entity, job_id, status, time.time()) for p in paths],
+            )
+        conn.execute("COMMIT")
+
+
+def run_batch(client, conn, lock, entity, uris, paths, manifest, max_attempts=MAX_ATTEMPTS):
+    """
+    Run one load job, retrying failures with backoff, and record every attempt.
+    A job whose row count differs from the manifest is recorded as a mismatch;
+    its parts are not reloaded automatically, since the rows are already in the
+    table.
+    """
+    table, column = ENTITIES[entity]
+    expected = None
+    if all(p in manifest for p in paths):
+        expected = sum(manifest[p] for p in paths)
+
+    with lock:
+        # attempts of earlier runs too: a failed job's ID cannot be reused
+        previous = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE entity = ? AND uris = ?",
+            (entity, orjson.dumps(uris).decode()),
+        ).fetchone()[0]
+    for attempt in range(max_attempts):
+        job_id = job_id_for(entity, paths, previous + attempt)
+        started = time.time()
+        try:
+            output_rows = client.load(table, uris, column, job_id)
+            error = None
+            status = "loaded"
+            if expected is not None and output_rows != expected:
+                status = "mismatch"
+                error = f"loaded {output_rows} rows, manifest has {expected}"
+        except Exception as e:
+            output_rows, status, error = None, "failed", str(e)
+        record_job(conn, lock, job_id, entity, uris, paths, expected, output_rows, status, error, started)
+        if status != "failed":
+            break
+        logging.warning(f"Load job {job_id} failed (Attempt {attempt + 1}/{max_attempts}): {error}")
+        if attempt + 1 < max_attempts:
+            time.sleep(BACKOFF_SECONDS * 2**attempt)
+    return job_id, status, error
+
+
+def load_entity(
+    entity,
+    client,
+    snapshot_dir=SNAPSHOT_DIR,
+    ledger_path=LEDGER_PATH,
+    max_jobs=MAX_JOBS,
+    uri_prefix=None,
+    max_files_per_job=MAX_FILES_PER_JOB,
+    max_bytes_per_job=MAX_BYTES_PER_JOB,
+    max_files=None,
+    reverse=False,
+):
+    """
+    Load every part of an entity that is not in the ledger yet.
+    client: BqClient, DuckDBClient or anything with the same load method.
+    uri_prefix: Cloud Storage location mirroring snapshot_dir (e.g.
+    gs://bucket/openalex-snapshot/data); local files are loaded if not given.
+    max_files: Only load this many parts in this run.
+    reverse: Load the newest partitions first.
+    Returns a dict of job status -> number of jobs.
+    """
+    entity_dir = Path(snapshot_dir) / entity
+    all_files = sorted(
+        str(p.relative_to(entity_dir)) for p in entity_dir.rglob("*.gz")
+    )
+    if reverse:
+        all_files.reverse()
+    sizes = {p: (entity_dir / p).stat().st_size for p in all_files}
+
+    conn = connect_ledger(ledger_path)
+    import_legacy_ledger(
+        conn, entity, all_files, Path(snapshot_dir).parent.parent / f"loaded_{entity}_files.txt"
+    )
+    loaded = {
+        row[0] for row in conn.execute("SELECT path FROM loaded_files WHERE entity = ?", (entity,))
+    }
+    pending = [p for p in all_files if p not in loaded]
+    if max_files is not None:
+        pending = pending[:max_files]
+    logging.info(f"{entity}: {len(loaded)} parts already loaded, {len(pending)} to load")
+    if not pending:
+        conn.close()
+        return {}
+
+    manifest = load_manifest(entity_dir)
+    if uri_prefix is None:
+        # bq loads local files one at a time
+        batches = [([str(entity_dir / p)], [p]) for p in pending]
+    else:
+        batches = plan_batches(
+            pending, all_files, sizes, uri_prefix.rstrip("/") + f"/{entity}",
+            max_files_per_job, max_bytes_per_job,
+        )
+    logging.info(f"{entity}: {len(batches)} load jobs, {max_jobs} at a time")
+
+    lock = threading.Lock()
+    counts = {}
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = [
+            executor.submit(run_batch, client, conn, lock, entity, uris, paths, manifest)
+            for uris, paths in batches
+        ]
+        for future in as_completed(futures):
+            job_id, status, error = future.result()
+            counts[status] = counts.get(status, 0) + 1
+            if status == "failed":
+                logging.error(f"Load job {job_id} failed, will retry next run: {error}")
+            elif status == "mismatch":
+                logging.error(f"Load job {job_id} row count mismatch: {error}")
+            else:
+                logging.info(f"Load job {job_id} done")
+    conn.close()
+    logging.info(f"{entity}: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load snapshot parts into BigQuery")
+    parser.add_argument("entity", choices=sorted(ENTITIES))
+    parser.add_argument("--snapshot-dir", default=str(SNAPSHOT_DIR))
+    parser.add_argument("--ledger", default=str(LEDGER_PATH))
+    parser.add_argument("--jobs", type=int, default=MAX_JOBS, help="Concurrent load jobs")
+    parser.add_argument("--uri-prefix", help="gs:// mirror of --snapshot-dir")
+    parser.add_argument("--files-per-job", type=int, default=MAX_FILES_PER_JOB)
+    parser.add_argument("--max-files", type=int, help="Only load this many parts")
+    parser.add_argument("--reverse", action="store_true", help="Newest partitions first")
+    parser.add_argument("--project-id", default=os.getenv("BQ_PROJECT_ID", DEFAULT_PROJECT))
+    parser.add_argument("--backend", choices=["bq", "duckdb"], default="bq")
+    parser.add_argument("--duckdb-path", default="data/openalex.duckdb")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    if args.backend == "bq":
+        client = BqClient(args.project_id)
+    else:
+        client = DuckDBClient(args.duckdb_path)
+    load_entity(
+        args.entity,
+        client,
+        snapshot_dir=args.snapshot_dir,
+        ledger_path=args.ledger,
+        max_jobs=args.jobs,
+        uri_prefix=args.uri_prefix,
+        max_files_per_job=args.files_per_job,
+        max_files=args.max_files,
+        reverse=args.reverse,
+    )
+
+
+if __name__ == "__main__":
+    main()
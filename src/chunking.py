@@ -0,0 +1,226 @@
+import gzip
+import io
+import logging
+import os
+import shutil
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import orjson
+
+from src.ledger import atomic_path, is_complete, ledger_rows, load_ledger, record_output
+from src.metrics import MeteredFile
+
+# Files whose compressed size is above this are split into record-range chunks
+MIN_SPLIT_BYTES = 100 * 1024 * 1024
+# Number of lines (records) per chunk
+CHUNK_LINES = 50_000
+# Size of the blocks read while indexing line offsets
+READ_BLOCK = 16 * 1024 * 1024
+
+
+def index_path(path):
+    return Path(f"{path}.lines.json")
+
+
+def build_line_index(path, chunk_lines=CHUNK_LINES):
+    """
+    Fast first pass over a gzipped JSON-lines file recording the decompressed byte
+    offset of every chunk_lines-th line. The index is cached next to the file and
+    reused as long as the file size and mtime do not change.
+    Returns a list of (offset, n_lines) pairs, one per chunk.
+    """
+    stat = os.stat(path)
+    cache = index_path(path)
+    if cache.exists():
+        cached = orjson.loads(cache.read_bytes())
+        if (
+            cached["size"] == stat.st_size
+            and cached["mtime"] == stat.st_mtime
+            and cached["chunk_lines"] == chunk_lines
+        ):
+            return [tuple(c) for c in cached["chunks"]]
+
+    chunks = []
+    start = 0  # offset of the first line of the current chunk
+    position = 0  # decompressed offset of the current block
+    lines_in_chunk = 0
+    last_byte = b"\n"
+    with gzip.open(path, "rb") as f:
+        while True:
+            block = f.read(READ_BLOCK)
+            if not block:
+                break
+            i = 0
+            while True:
+                needed = chunk_lines - lines_in_chunk
+                found = block.count(b"\n", i)
+                if found < needed:
+                    lines_in_chunk += found
+                    break
+                # walk to the newline closing the current chunk
+                for _ in range(needed):
+                    i = block.index(b"\n", i) + 1
+                chunks.append((start, chunk_lines))
+                start = position + i
+                lines_in_chunk = 0
+            position += len(block)
+            last_byte = block[-1:]
+    if last_byte != b"\n" and position > start:
+        lines_in_chunk += 1  # last line without a trailing newline
+    if lines_in_chunk:
+        chunks.append((start, lines_in_chunk))
+
+    cache.write_bytes(
+        orjson.dumps(
+            {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "chunk_lines": chunk_lines,
+                "chunks": chunks,
+            }
+        )
+    )
+    return chunks
+
+
+def plan_chunks(files, chunk_lines=CHUNK_LINES, min_split_bytes=MIN_SPLIT_BYTES):
+    """
+    Turn a list of files into a list of (file, chunk) tasks.
+    Small files are a single task with chunk=None. Large files are split into
+    chunks (index, n_chunks, offset, n_lines) that can be processed concurrently.
+    """
+    tasks = []
+    for file in files:
+        if os.path.getsize(file) < min_split_bytes:
+            tasks.append((file, None))
+            continue
+        chunks = build_line_index(file, chunk_lines)
+        if len(chunks) < 2:
+            tasks.append((file, None))
+            continue
+        logging.info(f"Splitting {file} into {len(chunks)} chunks")
+        for index, (offset, n_lines) in enumerate(chunks):
+            tasks.append((file, (index, len(chunks), offset, n_lines)))
+    return tasks
+
+
+def count_chunks(tasks):
+    """
+    Number of outstanding chunks per split file, used by the schedulers to know
+    when every chunk of a file is done and its outputs can be merged.
+    """
+    pending = {}
+    for file, chunk in tasks:
+        if chunk is not None:
+            pending[file] = chunk[1]
+    return pending
+
+
+def chunk_merger(tasks, merge_fn):
+    """
+    Build an on_done(key) callback for src/task_runner.run_tasks that calls
+    merge_fn(file, n_chunks) once every chunk of a split file is done.
+    merge_fn must be idempotent: it is also called for files completed by a
+    previous run.
+    """
+    pending = count_chunks(tasks)
+
+    def on_done(key):
+        file, chunk = key
+        if chunk is None:
+            return
+        pending[file] -= 1
+        if pending[file] == 0:
+            merge_fn(file, chunk[1])
+
+    return on_done
+
+
+@contextmanager
+def open_chunk(path, chunk=None, text=True, metrics=None):
+    """
+    Open a gzipped JSON-lines file, or only the record range of one chunk of it.
+    Yields an iterator over the lines (str if text, else bytes).
+    metrics: TaskMetrics (see src/metrics.py) that counts the bytes read and
+    decompressed and the lines, and times reading and decompression.
+    """
+    with open(path, "rb") as raw:
+        source = raw if metrics is None else MeteredFile(raw, metrics)
+        with gzip.GzipFile(fileobj=source, mode="rb") as f:
+            # kept referenced: the wrapper closes f when it is garbage collected
+            reader = io.TextIOWrapper(f, encoding="utf-8") if text else f
+            lines = reader
+            start = 0
+            if chunk is not None:
+                _, _, start, n_lines = chunk
+                # gzip seeks by decompressing everything before the offset
+                with metrics.timer("decompress") if metrics is not None else nullcontext():
+                    f.seek(start)
+                lines = (line for _, line in zip(range(n_lines), reader))
+            if metrics is not None:
+                lines = metrics.timed_lines(lines)
+            try:
+                yield lines
+            finally:
+                if metrics is not None:
+                    metrics.add("bytes_decompressed", f.tell() - start)
+
+
+def chunk_output_path(output_file, chunk):
+    """
+    Output path for one chunk of a file; the file's own output path if not split.
+    """
+    output_file = Path(output_file)
+    if chunk is None:
+        return output_file
+    return output_file.with_name(
+        f"{output_file.stem}.chunk{chunk[0]:05d}{output_file.suffix}"
+    )
+
+
+def chunk_outputs(output_file, n_chunks):
+    """
+    Paths of the per-chunk outputs of a file, in chunk order.
+    """
+    return [chunk_output_path(output_file, (i, n_chunks)) for i in range(n_chunks)]
+
+
+def merge_chunks(output_file, n_chunks, ledger=None, csv_header=False):
+    """
+    Concatenate per-chunk outputs in chunk order into output_file (atomically),
+    record it in the ledger with the summed chunk row counts, then remove the
+    chunk files. Chunks that produced no rows have no file and are skipped.
+    If the file was already merged, only the chunk files left behind (by a crash
+    after the merge, or a worker that lost its lease) are removed.
+    csv_header: Keep only the first chunk's header line.
+    """
+    output_file = Path(output_file)
+    entries = load_ledger(ledger)
+    all_parts = chunk_outputs(output_file, n_chunks)
+    if is_complete(ledger, output_file, entries=entries):
+        for part in all_parts:
+            part.unlink(missing_ok=True)
+        return
+    parts = [p for p in all_parts if p.exists()]
+    if parts:
+        with atomic_path(output_file) as tmp, open(tmp, "wb") as out:
+            for i, part in enumerate(parts):
+                with open(part, "rb") as f:
+                    if csv_header:
+                        header = f.readline()
+                        if i == 0:
+                            out.write(header)
+                    shutil.copyfileobj(f, out)
+    record_output(ledger, output_file, ledger_rows(ledger, all_parts, entries))
+    for part in parts:
+        part.unlink()
+
+
+def merge_csv_chunks(output_file, n_chunks, ledger=None):
+    merge_chunks(output_file, n_chunks, ledger, csv_header=True)
+
+
+def merge_gz_chunks(output_file, n_chunks, ledger=None):
+    # a multi-member gzip file is still a valid gzip file
+    merge_chunks(output_file, n_chunks, ledger)
@@ -0,0 +1,397 @@
+"""
+Distributed execution of snapshot scans.
+
+A coordinator puts one task per snapshot part (or chunk of a part, see
+src/chunking.py) into a SQLite work queue that lives on shared storage. Worker
+hosts claim tasks from the queue, run them and write their outputs to shared
+storage, then mark them done. A claimed task holds a lease that a heartbeat
+thread of its worker renews while the task runs, however long it takes; when a
+worker dies or hangs, the lease expires and the coordinator puts the task back
+in the queue so another worker picks it up.
+
+All hosts must run from the repository root and see the same data/ layout.
+
+Coordinator:  python -m src.distributed coordinate --db queue.sqlite --job get_relevant_works ...
+Worker:       python -m src.distributed work --db queue.sqlite
+Local test:   python -m src.distributed local --db queue.sqlite --workers 4 --job ...
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import orjson
+
+from src.chunking import plan_chunks
+from src.resources import MemoryBudget
+
+# Seconds a task is re-issued to someone else after its worker's last heartbeat
+LEASE_SECONDS = 10 * 60
+# Heartbeats per lease, so a few missed ones (e.g. a slow shared disk) do not lose it
+HEARTBEATS_PER_LEASE = 5
+# Attempts before a task is given up on
+MAX_ATTEMPTS = 4
+# Seconds between polls of the queue
+POLL_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    module TEXT NOT NULL,
+    params TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    file TEXT NOT NULL,
+    chunk TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until);
+CREATE INDEX IF NOT EXISTS tasks_file ON tasks (job_id, file);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 60000")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def task_id(job_id, file, chunk):
+    index = "all" if chunk is None else chunk[0]
+    return f"{job_id}:{file}:{index}"
+
+
+def submit_job(db_path, job_id, module, params, tasks):
+    """
+    Register a job and enqueue its (file, chunk) tasks. Tasks already in the
+    queue keep their status, so resubmitting a job only adds what is missing.
+    module: Name of the module whose run_task(params, file, chunk) runs a task and
+    whose finalize(params, file, n_chunks) merges the chunks of a split file.
+    """
+    conn = connect(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+            (job_id, module, orjson.dumps(params).decode()),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO tasks (task_id, job_id, file, chunk) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    task_id(job_id, str(file), chunk),
+                    job_id,
+                    str(file),
+                    None if chunk is None else orjson.dumps(chunk).decode(),
+                )
+                for file, chunk in tasks
+            ],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.close()
+    logging.info(f"Submitted {len(tasks)} tasks for job {job_id}")
+
+
+def claim_task(conn, worker, lease_seconds=LEASE_SECONDS):
+    """
+    Atomically claim the next pending task. Returns the task row or None.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT task_id, job_id, file, chunk FROM tasks "
+            "WHERE status = 'pending' ORDER BY attempts, task_id LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE task_id = ?",
+                (worker, time.time() + lease_seconds, row[0]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def finish_task(conn, task, worker, error=None):
+    """
+    Report a task as done, or as failed with error. A failed task goes back to
+    pending until it has used MAX_ATTEMPTS. A task is done as soon as any worker
+    finishes it, also one that has lost its lease (the outputs are written
+    atomically); failures from a worker that has lost its lease are ignored.
+    """
+    if error is None:
+        conn.execute(
+            "UPDATE tasks SET status = 'done', worker = ?, error = NULL, finished_at = ? "
+            "WHERE task_id = ? AND status != 'done'",
+            (worker, time.time(), task),
+        )
+    else:
+        conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = ?, worker = NULL, lease_until = NULL "
+            "WHERE task_id = ? AND worker = ? AND status = 'running'",
+            (MAX_ATTEMPTS, error, task, worker),
+        )
+
+
+def renew_lease(conn, task, worker, lease_seconds=LEASE_SECONDS):
+    """
+    Extend the lease of a task the worker is running. If the lease expired
+    meanwhile and the task was not claimed again, the worker takes it back
+    without the expiry counting as an attempt.
+    Returns whether the worker holds the task.
+    """
+    lease_until = time.time() + lease_seconds
+    cur = conn.execute(
+        "UPDATE tasks SET lease_until = ? WHERE task_id = ? AND worker = ? AND status = 'running'",
+        (lease_until, task, worker),
+    )
+    if cur.rowcount:
+        return True
+    cur = conn.execute(
+        "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, error = NULL, "
+        "attempts = MAX(0, attempts - 1) "
+        "WHERE task_id = ? AND status IN ('pending', 'failed') AND error = 'lease expired'",
+        (worker, lease_until, task),
+    )
+    return cur.rowcount > 0
+
+
+class Heartbeat:
+    """
+    Renews the lease of a task from a background thread, with its own
+    connection, while the worker runs it.
+    """
+
+    def __init__(self, db_path, task, worker, lease_seconds=LEASE_SECONDS):
+        self.db_path = db_path
+        self.task = task
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        conn = connect(self.db_path)
+        held = True
+        try:
+            while not self.stopped.wait(self.lease_seconds / HEARTBEATS_PER_LEASE):
+                try:
+                    holds = renew_lease(conn, self.task, self.worker, self.lease_seconds)
+                except sqlite3.Error as e:
+                    logging.warning(f"Worker {self.worker} could not renew the lease of {self.task}: {e}")
+                    continue
+                if held and not holds:
+                    logging.warning(f"Worker {self.worker} lost the lease of {self.task} to another worker")
+                held = holds
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def requeue_expired(conn):
+    """
+    Put running tasks whose lease has expired back in the queue (dead or hung
+    workers, which stopped renewing it). Returns the number of re-issued tasks.
+    """
+    cur = conn.execute(
+        "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "error = 'lease expired', worker = NULL, lease_until = NULL "
+        "WHERE status = 'running' AND lease_until < ?",
+        (MAX_ATTEMPTS, time.time()),
+    )
+    return cur.rowcount
+
+
+def queue_status(db_path, job_id=None):
+    """
+    Number of tasks per status, optionally for a single job.
+    """
+    conn = connect(db_path)
+    query = "SELECT status, COUNT(*) FROM tasks"
+    args = ()
+    if job_id is not None:
+        query += " WHERE job_id = ?"
+        args = (job_id,)
+    counts = dict(conn.execute(query + " GROUP BY status", args).fetchall())
+    conn.close()
+    return counts
+
+
+def load_job(conn, job_id, jobs):
+    if job_id not in jobs:
+        module, params = conn.execute(
+            "SELECT module, params FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        jobs[job_id] = (importlib.import_module(module), orjson.loads(params))
+    return jobs[job_id]
+
+
+def run_worker(db_path, worker=None, lease_seconds=LEASE_SECONDS, stop_when_empty=True):
+    """
+    Claim and run tasks until the queue is drained.
+    worker: Name reported to the queue; defaults to host:pid.
+    stop_when_empty: Exit once a job has been submitted and nothing is pending
+    or running, instead of waiting for more jobs. A worker started before the
+    coordinator has submitted its job waits for it.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(db_path)
+    jobs = {}
+    logging.info(f"Worker {worker} started")
+    while True:
+        row = claim_task(conn, worker, lease_seconds)
+        if row is None:
+            counts = queue_status(db_path)
+            submitted = conn.execute("SELECT 1 FROM jobs LIMIT 1").fetchone() is not None
+            if stop_when_empty and submitted and not counts.get("pending") and not counts.get("running"):
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        task, job_id, file, chunk = row
+        chunk = None if chunk is None else tuple(orjson.loads(chunk))
+        try:
+            module, params = load_job(conn, job_id, jobs)
+            with Heartbeat(db_path, task, worker, lease_seconds):
+                module.run_task(params, file, chunk)
+            finish_task(conn, task, worker)
+        except Exception as e:
+            logging.error(f"Worker {worker} failed task {task}: {e}")
+            finish_task(conn, task, worker, error=str(e))
+    conn.close()
+    logging.info(f"Worker {worker} finished")
+
+
+def finalize_split_files(conn, job_id, finalized):
+    """
+    Merge the outputs of split files whose chunks are all done.
+    """
+    rows = conn.execute(
+        "SELECT file, MIN(chunk), SUM(status = 'done'), COUNT(*) FROM tasks "
+        "WHERE job_id = ? AND chunk IS NOT NULL GROUP BY file",
+        (job_id,),
+    ).fetchall()
+    module = params = None
+    for file, chunk, done, total in rows:
+        if file in finalized or done < total:
+            continue
+        if module is None:
+            module, params = load_job(conn, job_id, {})
+        module.finalize(params, file, orjson.loads(chunk)[1])
+        finalized.add(file)
+
+
+def coordinate(db_path, job_id, poll_seconds=POLL_SECONDS):
+    """
+    Watch a job until every task is done or failed: re-issue tasks with expired
+    leases and merge the chunks of split files as soon as they are complete.
+    """
+    conn = connect(db_path)
+    finalized = set()
+    while True:
+        reissued = requeue_expired(conn)
+        if reissued:
+            logging.warning(f"Re-issued {reissued} tasks with expired leases")
+        finalize_split_files(conn, job_id, finalized)
+        counts = queue_status(db_path, job_id)
+        logging.info(f"Job {job_id}: {counts}")
+        if not counts.get("pending") and not counts.get("running"):
+            break
+        time.sleep(poll_seconds)
+    conn.close()
+    if counts.get("failed"):
+        logging.error(f"Job {job_id} finished with {counts['failed']} failed tasks")
+    return counts
+
+
+def run_local(db_path, job_id, n_workers, lease_seconds=LEASE_SECONDS):
+    """
+    Run n_workers worker processes on this machine, standing in for worker hosts,
+    while this process coordinates.
+    """
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(db_path, f"local-{i}", lease_seconds)
+        )
+        for i in range(n_workers)
+    ]
+    for w in workers:
+        w.start()
+    counts = coordinate(db_path, job_id)
+    for w in workers:
+        w.join()
+    return counts
+
+
+def make_tasks(module, params, split=True):
+    """
+    Build the (file, chunk) task list of a job from its module's list_files(params).
+    """
+    files = module.list_files(params)
+    return plan_chunks(files) if split else [(file, None) for file in files]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed snapshot scans")
+    parser.add_argument("mode", choices=["coordinate", "work", "local", "status"])
+    parser.add_argument("--db", required=True, help="SQLite queue on shared storage")
+    parser.add_argument("--job", help="Module implementing the job, e.g. get_relevant_works")
+    parser.add_argument("--job-id", help="Defaults to the job module name")
+    parser.add_argument("--params", default="{}", help="JSON parameters of the job")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Local workers; sized from the CPUs and memory by default"
+    )
+    parser.add_argument("--lease", type=float, default=LEASE_SECONDS)
+    parser.add_argument("--no-split", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+
+    job_id = args.job_id or args.job
+    if args.mode == "work":
+        run_worker(args.db, lease_seconds=args.lease)
+        return
+    if args.mode == "status":
+        print(queue_status(args.db, job_id))
+        return
+
+    module = importlib.import_module(args.job)
+    params = orjson.loads(args.params)
+    submit_job(args.db, job_id, args.job, params, make_tasks(module, params, not args.no_split))
+    if args.mode == "coordinate":
+        coordinate(args.db, job_id)
+    else:
+        run_local(args.db, job_id, args.workers or MemoryBudget({}).pool_size(), args.lease)
+
+
+if __name__ == "__main__":
+    main()
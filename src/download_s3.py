@@ -7,12 +7,7 @@ from pathlib import Path
 import boto3
 from tqdm import tqdm
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.FileHandler("download_log.log"), logging.StreamHandler()],
-)
+from src.logs import log_queue, setup_logging, worker_logging
 
 # Suppressing checksum validation
 logging.getLogger("boto3").setLevel(logging.WARNING)
@@ -78,7 +73,7 @@ def download_all_files():
 
     logging.info(f"Total files to download: {len(all_files)}")
 
-    with Pool(cpu_count() * 2) as pool:
+    with Pool(cpu_count() * 2, initializer=worker_logging, initargs=(log_queue(),)) as pool:
         # Display progress with tqdm
         for _ in tqdm(
             pool.imap(download_file, all_files),
@@ -91,4 +86,6 @@ def download_all_files():
 
 
 if __name__ == "__main__":
+    # the scripts that download before they process log to their own log file
+    setup_logging("download_log.log")
     download_all_files()
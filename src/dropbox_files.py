@@ -0,0 +1,177 @@
+"""
+Helpers for reading files from the project's Dropbox.
+
+The functions that talk to Dropbox take the client as their first argument, so
+they accept a dropbox.Dropbox or any object with the same files_* methods (e.g.
+a local fake that serves files from disk in tests).
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import dropbox
+import requests
+from dotenv import load_dotenv
+
+from src.ledger import atomic_path
+
+# Attempts per Dropbox call before giving up
+MAX_RETRIES = 5
+# Seconds before the first retry; doubles with every attempt
+BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 120
+# Size of the pieces a download is streamed in
+DOWNLOAD_CHUNK = 1024 * 1024
+# Dropbox content_hash block size
+HASH_BLOCK = 4 * 1024 * 1024
+
+# When Dropbox rate-limits one thread, every thread waits until this time
+_rate_limit_lock = threading.Lock()
+_rate_limited_until = 0.0
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def make_client():
+    load_dotenv()
+    return dropbox.Dropbox(os.getenv("DROPBOX_ACCESS_TOKEN"))
+
+
+def wait_for_rate_limit():
+    with _rate_limit_lock:
+        delay = _rate_limited_until - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def set_rate_limit(seconds):
+    global _rate_limited_until
+    with _rate_limit_lock:
+        _rate_limited_until = max(_rate_limited_until, time.time() + seconds)
+
+
+def call_with_retries(fn, *args, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Call a Dropbox API function, retrying rate limits, server errors and
+    connection errors with exponential backoff. A rate limit pauses all threads
+    for the backoff Dropbox asks for. Other errors (e.g. a missing path) are
+    raised immediately.
+    """
+    for attempt in range(1, max_retries + 1):
+        wait_for_rate_limit()
+        try:
+            return fn(*args, **kwargs)
+        except dropbox.exceptions.RateLimitError as e:
+            delay = e.backoff or min(BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+            set_rate_limit(delay)
+            error = e
+        except (
+            dropbox.exceptions.InternalServerError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            delay = min(BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+            error = e
+        if attempt == max_retries:
+            raise error
+        logging.warning(
+            f"Dropbox call {fn.__name__} failed (Attempt {attempt}/{max_retries}), retrying in {delay}s: {error}"
+        )
+        time.sleep(delay)
+
+
+def list_files(dbx, folder, suffix=None):
+    """
+    FileMetadata of the files in a Dropbox folder, following pagination.
+    suffix: Only files whose name ends with it (e.g. ".xlsx").
+    """
+    result = call_with_retries(dbx.files_list_folder, folder)
+    files = []
+    while True:
+        for entry in result.entries:
+            if isinstance(entry, dropbox.files.FileMetadata) and (
+                suffix is None or entry.name.endswith(suffix)
+            ):
+                files.append(entry)
+        if not result.has_more:
+            return files
+        result = call_with_retries(dbx.files_list_folder_continue, result.cursor)
+
+
+def content_hash(path):
+    """
+    Dropbox content_hash of a local file: the SHA-256 of the concatenated SHA-256
+    digests of its 4 MB blocks.
+    """
+    block_digests = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            block_digests.update(hashlib.sha256(block).digest())
+    return block_digests.hexdigest()
+
+
+def download_to(dbx, dropbox_path, local_path, chunk_size=DOWNLOAD_CHUNK, max_bytes=None):
+    """
+    Stream a Dropbox file to local_path in chunk_size pieces, so memory use does
+    not depend on the file size. Returns the file's metadata.
+    max_bytes: Refuse a file larger than this, from its size in the metadata
+    before anything is written, or as soon as more than this is streamed.
+    """
+
+    def fetch():
+        metadata, res = dbx.files_download(path=dropbox_path)
+        written = 0
+        try:
+            if max_bytes is not None and metadata.size > max_bytes:
+                raise ValueError(f"{dropbox_path} is {metadata.size} bytes, larger than {max_bytes}")
+            with open(local_path, "wb") as f:
+                for piece in res.iter_content(chunk_size=chunk_size):
+                    written += len(piece)
+                    if max_bytes is not None and written > max_bytes:
+                        raise ValueError(f"{dropbox_path} is larger than {max_bytes} bytes")
+                    f.write(piece)
+        finally:
+            res.close()
+        return metadata
+
+    fetch.__name__ = "files_download"
+    return call_with_retries(fetch)
+
+
+def sync_file(dbx, dropbox_path, local_path, chunk_size=DOWNLOAD_CHUNK, max_bytes=None, max_retries=MAX_RETRIES):
+    """
+    Make local_path an exact copy of a Dropbox file. Nothing is transferred if
+    the local file already has the same content_hash. Otherwise the file is
+    streamed to a temporary file, checked against Dropbox's content_hash and only
+    then renamed to local_path, so a failed or corrupted transfer never replaces
+    a good copy. A corrupted transfer is retried.
+    max_bytes: Refuse files larger than this (ValueError), before downloading.
+    Returns True if the file was downloaded, False if it was already up to date.
+    """
+    metadata = call_with_retries(dbx.files_get_metadata, dropbox_path)
+    if os.path.exists(local_path) and content_hash(local_path) == metadata.content_hash:
+        logging.info(f"{local_path} already matches {dropbox_path}, skipping download")
+        return False
+    if max_bytes is not None and metadata.size > max_bytes:
+        raise ValueError(f"{dropbox_path} is {metadata.size} bytes, larger than {max_bytes}")
+
+    logging.info(f"Downloading {dropbox_path} to {local_path}")
+    for attempt in range(1, max_retries + 1):
+        try:
+            with atomic_path(local_path) as tmp:
+                metadata = download_to(dbx, dropbox_path, tmp, chunk_size, max_bytes)
+                local_hash = content_hash(tmp)
+                if local_hash != metadata.content_hash:
+                    # raised inside the block, so the temporary file is discarded
+                    raise ChecksumMismatch(
+                        f"content_hash mismatch for {dropbox_path}: {local_hash} != {metadata.content_hash}"
+                    )
+            return True
+        except ChecksumMismatch as e:
+            if attempt == max_retries:
+                raise
+            logging.warning(f"{e} (Attempt {attempt}/{max_retries}), downloading again")
@@ -1,95 +1,118 @@
+import logging
 import os
-import dropbox
-import pandas as pd  # For handling data in Excel files
-from dotenv import load_dotenv
-from io import BytesIO
+import tempfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import orjson
+from openpyxl import load_workbook
 from tqdm import tqdm
 
-# Load environment variables from .env file
-load_dotenv()
+from src.dropbox_files import download_to, list_files, make_client
+from src.ledger import atomic_path
 
-# Replace with your own access token
-ACCESS_TOKEN = os.getenv("DROPBOX_ACCESS_TOKEN")
+# Downloads running at the same time; Dropbox rate-limits beyond a few
+MAX_CONCURRENT_DOWNLOADS = 8
+# Extracted columns, one file per (content_hash, column)
+CACHE_DIR = Path("data/cache/dropbox")
 
-# Initialize Dropbox client
-dbx = dropbox.Dropbox(ACCESS_TOKEN)
 
-# Function to process a single Excel file from Dropbox and extract a column
-def process_file(dropbox_file_path, column_name):
+def read_excel_column(path, column_name):
+    """
+    Stream one column of the first sheet of an .xlsx file in read-only mode,
+    without loading the other columns or the whole sheet into memory.
+    Returns the non-empty values, or None if the column is missing.
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
     try:
-        # Get the file content from Dropbox
-        metadata, res = dbx.files_download(path=dropbox_file_path)
+        sheet = workbook.worksheets[0]
+        header = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        if column_name not in header:
+            return None
+        column = header.index(column_name) + 1
+        return [
+            row[0]
+            for row in sheet.iter_rows(min_row=2, min_col=column, max_col=column, values_only=True)
+            if row and row[0] is not None
+        ]
+    finally:
+        workbook.close()
+
+
+def cache_path(content_hash, column_name, cache_dir=CACHE_DIR):
+    return Path(cache_dir) / f"{content_hash}.{column_name}.json"
 
-        # Load the file content into a BytesIO object
-        file_content = BytesIO(res.content)
 
-        # Read the Excel file into a DataFrame
-        df = pd.read_excel(file_content)
+# Function to process a single Excel file from Dropbox and extract a column
+def process_file(dbx, entry, column_name, cache_dir=CACHE_DIR):
+    """
+    Extract a column of a Dropbox .xlsx file. The result is cached by the file's
+    content_hash, so an unchanged file is never downloaded or parsed again.
+    entry: FileMetadata of the file (see src/dropbox_files.list_files).
+    Raises if the file cannot be downloaded or lacks the column.
+    """
+    cache = cache_path(entry.content_hash, column_name, cache_dir)
+    if cache.exists():
+        return orjson.loads(cache.read_bytes())
+
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache.parent) as tmp_dir:
+        local_file = Path(tmp_dir) / entry.name
+        download_to(dbx, entry.path_display, local_file)
+        values = read_excel_column(local_file, column_name)
+    if values is None:
+        raise KeyError(f"Column '{column_name}' not found in file: {entry.path_display}")
+
+    with atomic_path(cache) as tmp:
+        tmp.write_bytes(orjson.dumps(values))
+    return values
 
-        # Extract the specified column and return it as a list
-        if column_name in df.columns:
-            return df[column_name].dropna().tolist()
-        else:
-            print(f"Column '{column_name}' not found in file: {dropbox_file_path}")
-            return []
-    except Exception as e:
-        print(f"Error processing file {dropbox_file_path}: {e}")
-        return []
 
 # Function to process all files in a Dropbox folder and extract a column
-def process_all_files_from_dropbox(dropbox_folder_path, column_name):
-    try:
-        # List files in the folder
-        result = dbx.files_list_folder(dropbox_folder_path)
-        files_to_process = []
-
-        # Prepare a list of files to process
-        while True:
-            for entry in result.entries:
-                if isinstance(entry, dropbox.files.FileMetadata) and entry.name.endswith('.xlsx'):
-                    files_to_process.append(entry.path_display)
-
-            # Check if there are more files to list
-            if result.has_more:
-                result = dbx.files_list_folder_continue(result.cursor)
-            else:
-                break
-
-        # Initialize a list to hold all column data
-        all_data = []
-
-        # Use ThreadPoolExecutor to process files in parallel
-        num_workers = os.cpu_count() * 2  # Number of worker threads to use
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            # Initialize tqdm for progress bar
-            with tqdm(total=len(files_to_process), desc="Processing Files", unit="file") as pbar:
-                futures = {
-                    executor.submit(process_file, file_path, column_name): file_path
-                    for file_path in files_to_process
-                }
-
-                # Wait for all processing to finish
-                for future in as_completed(futures):
-                    column_data = future.result()
-                    if column_data:
-                        all_data.extend(column_data)
-                    pbar.update(1)  # Update the progress bar after each file
-
-        return all_data
-    except Exception as e:
-        print(f"Error: {e}")
-        return []
-
-def get_all_top150_academics():
+def process_all_files_from_dropbox(
+    dropbox_folder_path, column_name, dbx=None, max_workers=MAX_CONCURRENT_DOWNLOADS, cache_dir=CACHE_DIR
+):
+    """
+    Extract a column from every .xlsx file in a Dropbox folder, downloading
+    files concurrently in a bounded thread pool.
+    dbx: Dropbox client (default: from DROPBOX_ACCESS_TOKEN).
+    Raises after all files were tried if any of them failed.
+    """
+    dbx = dbx or make_client()
+    files_to_process = list_files(dbx, dropbox_folder_path, suffix=".xlsx")
+
+    all_data = []
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with tqdm(total=len(files_to_process), desc="Processing Files", unit="file") as pbar:
+            futures = {
+                executor.submit(process_file, dbx, entry, column_name, cache_dir): entry
+                for entry in files_to_process
+            }
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    all_data.extend(future.result())
+                except Exception as e:
+                    logging.error(f"Error processing file {entry.path_display}: {e}")
+                    failed[entry.path_display] = str(e)
+                pbar.update(1)
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(files_to_process)} files failed: {sorted(failed)}")
+    return all_data
+
+
+def get_all_top150_academics(dbx=None):
     shared_folder_path = '/Science Twitter/Data/Raw/openalex/people/allTop150academics'  # Replace with your folder path
     column_name = 'id'  # Replace with the name of the column to extract
-    return set(process_all_files_from_dropbox(shared_folder_path, column_name))
+    return set(process_all_files_from_dropbox(shared_folder_path, column_name, dbx))
+
 
 if __name__ == "__main__":
     data = set(get_all_top150_academics())
     # Save the data to a file
+    os.makedirs("data/ids", exist_ok=True)
     with open('data/ids/allTop150academics.txt', 'w') as f:
         for item in data:
             f.write("%s\n" % item)
-
@@ -0,0 +1,130 @@
+"""
+Shared loader for the ID lists the stages filter on (CSV, Excel, TXT or Parquet).
+
+IDs are normalized, so https://openalex.org/A123, A123 and
+https://api.openalex.org/authors/A123 are the same ID. The normalized list is
+cached as a sorted, deduplicated int64 array keyed by the source path, its mtime
+and the column, so repeat runs skip parsing the source file (Excel in particular).
+"""
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import orjson
+import pandas as pd
+
+from src.ledger import atomic_path
+
+ID_CACHE_DIR = Path("data/cache/ids")
+OPENALEX_URL = "https://openalex.org/"
+
+ID_PATTERN = re.compile(r"^(?:https?://(?:api\.)?openalex\.org/(?:[a-z]+/)?)?([AWISCPFTDaiwscpftd])(\d+)$")
+
+
+def parse_id(value):
+    """
+    (entity letter, number) of an OpenAlex ID in any of its forms, or None.
+    """
+    match = ID_PATTERN.match(str(value).strip())
+    if match is None:
+        return None
+    return match.group(1).upper(), int(match.group(2))
+
+
+def normalize_id(value):
+    """
+    Canonical form of an OpenAlex ID, as used in the snapshot records.
+    """
+    parsed = parse_id(value)
+    if parsed is None:
+        raise ValueError(f"Not an OpenAlex ID: {value}")
+    return f"{OPENALEX_URL}{parsed[0]}{parsed[1]}"
+
+
+def read_raw_ids(path, id_col):
+    """
+    The raw ID column of a list file as strings. TXT files hold one ID per line
+    and have no columns.
+    """
+    path = Path(path)
+    if path.suffix == ".txt":
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    if path.suffix == ".parquet":
+        ids = pd.read_parquet(path, columns=[id_col])[id_col]
+    elif path.suffix in (".csv", ".gz"):
+        ids = pd.read_csv(path, usecols=[id_col], dtype={id_col: str})[id_col]
+    else:
+        ids = pd.read_excel(path, usecols=[id_col], dtype={id_col: str})[id_col]
+    return ids.dropna().astype(str).tolist()
+
+
+def cache_path(path, id_col, cache_dir=ID_CACHE_DIR):
+    stat = os.stat(path)
+    key = f"{Path(path).resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{id_col}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"{Path(path).stem}.{digest}.npy"
+
+
+def load_id_numbers(path, id_col="id", cache_dir=ID_CACHE_DIR):
+    """
+    Load an ID list as (entity letter, sorted unique int64 array of ID numbers).
+    The array comes from the cache when the source file has not changed since it
+    was built. Values that are not OpenAlex IDs are dropped with a warning; a
+    list mixing entities (e.g. authors and works) is rejected.
+    """
+    cache = cache_path(path, id_col, cache_dir)
+    meta_file = cache.with_suffix(".json")
+    if cache.exists() and meta_file.exists():
+        meta = orjson.loads(meta_file.read_bytes())
+        return meta["entity"], np.load(cache)
+
+    raw = read_raw_ids(path, id_col)
+    parsed = [parse_id(value) for value in raw]
+    invalid = sum(p is None for p in parsed)
+    if invalid:
+        logging.warning(f"Dropped {invalid} values that are not OpenAlex IDs from {path}")
+    entities = {p[0] for p in parsed if p is not None}
+    if len(entities) > 1:
+        raise ValueError(f"{path} mixes IDs of several entities: {sorted(entities)}")
+    entity = entities.pop() if entities else None
+    numbers = np.unique(np.array([p[1] for p in parsed if p is not None], dtype=np.int64))
+    logging.info(f"Loaded {len(numbers)} unique IDs from {path} ({len(raw)} rows)")
+
+    # written only after the array, so a cache with metadata is always complete
+    with atomic_path(cache) as tmp:
+        with open(tmp, "wb") as f:
+            np.save(f, numbers)
+    with atomic_path(meta_file) as tmp:
+        tmp.write_bytes(orjson.dumps({"source": str(path), "id_col": id_col, "entity": entity}))
+    return entity, numbers
+
+
+def id_strings(entity, numbers):
+    """
+    Canonical IDs of an entity letter and an array of ID numbers.
+    """
+    return [f"{OPENALEX_URL}{entity}{n}" for n in numbers.tolist()]
+
+
+def load_ids(path, id_col="id", cache_dir=ID_CACHE_DIR):
+    """
+    Load an ID list as a set of canonical IDs (https://openalex.org/A123), the
+    form in which the snapshot records refer to each other.
+    """
+    entity, numbers = load_id_numbers(path, id_col, cache_dir)
+    return set(id_strings(entity, numbers))
+
+
+def contains(numbers, values):
+    """
+    Boolean mask of the values found in a sorted array of ID numbers.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(numbers) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(numbers, values), len(numbers) - 1)
+    return numbers[positions] == values
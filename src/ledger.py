@@ -0,0 +1,196 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+
+# Completion ledger kept in each stage's output folder
+LEDGER_FILE = "_ledger.jsonl"
+# The .chunkNNNNN tag of per-chunk outputs (see src/chunking.chunk_output_path)
+CHUNK_TAG = re.compile(r"\.chunk\d{5}(?=\.[^.]*$|$)")
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path next to path. It is renamed to path only when the
+    block finishes without error, so a crash never leaves a truncated output
+    behind that looks finished.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+@contextmanager
+def atomic_dir(path):
+    """
+    Like atomic_path, for outputs that are whole directories (e.g. partitioned
+    Parquet datasets): yield an empty temporary directory that replaces path only
+    when the block finishes without error.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    try:
+        yield tmp
+        if path.exists():
+            old = path.with_name(f".{path.name}.{os.getpid()}.old")
+            os.replace(path, old)
+            os.replace(tmp, path)
+            shutil.rmtree(old)
+        else:
+            os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp)
+
+
+def remove_stale_dirs(root):
+    """
+    Remove the temporary directories (.<name>.<pid>.tmp and .old) that
+    atomic_dir leaves under root when its process is killed. Only call it while
+    no process is writing under root.
+    """
+    for path in sorted(Path(root).rglob(".*"), reverse=True):
+        if path.is_dir() and path.name.endswith((".tmp", ".old")):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def record_output(ledger, path, rows):
+    """
+    Append an entry for a finished output to the ledger: row count, size and
+    checksum. An output with no rows may have no file at all; it is still
+    recorded, so reruns know the input was processed.
+    ledger: Path to the ledger file (None disables the ledger).
+    """
+    if ledger is None:
+        return
+    path = Path(path)
+    entry = {"output": str(path), "rows": rows, "time": time.time()}
+    if path.exists():
+        entry["bytes"] = path.stat().st_size
+        entry["sha256"] = file_checksum(path)
+    Path(ledger).parent.mkdir(parents=True, exist_ok=True)
+    # a single O_APPEND write keeps concurrent workers from interleaving lines
+    fd = os.open(ledger, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, orjson.dumps(entry) + b"\n")
+    finally:
+        os.close(fd)
+
+
+# Per-process index of every ledger loaded: path -> (inode, bytes read, entries)
+_indexes = {}
+
+
+def load_ledger(ledger):
+    """
+    Latest ledger entry per output path. The entries are kept per process and
+    only the lines appended since the last call are parsed, so the tasks that
+    check the ledger once each do not re-parse it all every time. The returned
+    dict is shared: do not modify it.
+    """
+    if ledger is None:
+        return {}
+    key = os.path.abspath(ledger)
+    try:
+        stat = os.stat(key)
+    except FileNotFoundError:
+        _indexes.pop(key, None)
+        return {}
+    inode, offset, entries = _indexes.get(key, (None, 0, None))
+    if entries is None or inode != stat.st_ino or stat.st_size < offset:
+        # new or replaced ledger
+        offset, entries = 0, {}
+    if stat.st_size > offset:
+        with open(key, "rb") as f:
+            f.seek(offset)
+            data = f.read(stat.st_size - offset)
+        # a line still being written is left for the next call
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # partially written line of a killed run
+            entries[entry["output"]] = entry
+        offset += end
+    _indexes[key] = (stat.st_ino, offset, entries)
+    return entries
+
+
+def is_complete(ledger, path, verify=False, entries=None):
+    """
+    Whether path was recorded in the ledger and still matches it.
+    verify: Also recompute the checksum instead of trusting the file size.
+    entries: Pre-loaded ledger (see load_ledger) when checking many outputs.
+    """
+    if entries is None:
+        entries = load_ledger(ledger)
+    entry = entries.get(str(path))
+    if entry is None:
+        return False
+    path = Path(path)
+    if "sha256" not in entry:
+        # recorded without rows
+        return not path.exists() or path.stat().st_size == 0
+    if not path.exists() or path.stat().st_size != entry["bytes"]:
+        return False
+    if verify and file_checksum(path) != entry["sha256"]:
+        return False
+    return True
+
+
+def ledger_rows(ledger, paths, entries=None):
+    """
+    Total recorded rows of the given outputs.
+    """
+    if entries is None:
+        entries = load_ledger(ledger)
+    return sum(entries.get(str(p), {}).get("rows", 0) for p in paths)
+
+
+def completed_outputs(ledger, suffix=None):
+    """
+    Sorted list of the outputs recorded in the ledger that exist and still match
+    it. Aggregation steps read these instead of globbing, so temp files and
+    truncated files are never picked up, nor chunk outputs whose merged file is
+    complete (left behind by a crash after the merge).
+    suffix: Only keep outputs with this suffix (e.g. ".csv").
+    """
+    entries = load_ledger(ledger)
+
+    def merged(output):
+        merged_output = CHUNK_TAG.sub("", output)
+        return merged_output != output and is_complete(ledger, merged_output, entries=entries)
+
+    return sorted(
+        Path(output)
+        for output, entry in entries.items()
+        if "sha256" in entry
+        and (suffix is None or Path(output).suffix == suffix)
+        and is_complete(ledger, output, entries=entries)
+        and not merged(output)
+    )
@@ -0,0 +1,187 @@
+"""
+Logging of the stage scripts and their worker processes.
+
+setup_logging replaces the logging.basicConfig every script used to run at
+import: the main process owns the log file, and every process (the main one
+and the pool workers, see worker_logging) puts its records on a queue that a
+listener thread in the main process writes out. Workers no longer contend for
+process_log.log or interleave their lines.
+
+Per-line problems (invalid JSON, records that fail to process) go through
+line_warning instead of a warning each: the first few of each kind in a file
+are logged, then one in LINE_WARNING_SAMPLE_EVERY, within a per-process rate
+limit, and file_issues logs one summary with the counts of the file.
+"""
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+
+LOG_FILE = "process_log.log"
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+# Per-line warnings: the first few of each kind in a file, then one in SAMPLE_EVERY...
+FIRST_LINE_WARNINGS = 5
+LINE_WARNING_SAMPLE_EVERY = 10_000
+# ... and at most this many per second in a process
+MAX_LINE_WARNINGS_PER_SECOND = 10
+# Longest part of a line quoted in a warning
+MAX_LINE_CHARS = 200
+
+_queue = None
+_listener = None
+
+
+def setup_logging(log_file=LOG_FILE, level=logging.INFO):
+    """
+    Log to log_file and the console through a queue and a listener thread.
+    Only the first call sets logging up (like logging.basicConfig), and worker
+    processes are left to their pool's initializer (see worker_logging).
+    Returns the queue.
+    """
+    global _queue, _listener
+    if _queue is not None or multiprocessing.parent_process() is not None:
+        return _queue
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    _queue = multiprocessing.Queue()
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    install_queue_handler(_queue, level)
+    return _queue
+
+
+def stop_logging():
+    """
+    Write out the records still queued and stop the listener.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_queue():
+    """
+    Queue of the main process's listener, or None when setup_logging was not called.
+    """
+    return _queue
+
+
+def install_queue_handler(queue, level=logging.INFO):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+
+
+def worker_logging(queue, level=logging.INFO):
+    """
+    Pool initializer: send the records of this worker to the main process's
+    queue (log_queue()). Workers keep their default logging if queue is None.
+    """
+    if queue is not None:
+        install_queue_handler(queue, level)
+
+
+class RateLimit:
+    """
+    At most per_second events per second.
+    """
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.second = None
+        self.count = 0
+
+    def allow(self):
+        second = int(time.monotonic())
+        if second != self.second:
+            self.second, self.count = second, 0
+        self.count += 1
+        return self.count <= self.per_second
+
+
+_rate_limit = RateLimit(MAX_LINE_WARNINGS_PER_SECOND)
+
+
+def shorten(line):
+    if isinstance(line, bytes):
+        line = line.decode("utf-8", errors="replace")
+    line = line.rstrip("\n")
+    if len(line) > MAX_LINE_CHARS:
+        return f"{line[:MAX_LINE_CHARS]!r}... ({len(line):,} chars)"
+    return repr(line)
+
+
+class LineIssues:
+    """
+    Counts of the problem lines of one file by kind, with sampled warnings.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.counts = {}
+        self.logged = 0
+
+    def warn(self, kind, error, line=None):
+        n = self.counts[kind] = self.counts.get(kind, 0) + 1
+        if n > FIRST_LINE_WARNINGS and n % LINE_WARNING_SAMPLE_EVERY:
+            return
+        if not _rate_limit.allow():
+            return
+        self.logged += 1
+        where = f" in {self.source}" if self.source is not None else ""
+        message = f"{kind}{where} (#{n:,}): {error}"
+        if line is not None:
+            message += f" - {shorten(line)}"
+        logging.warning(message, extra={"line_issue": kind, "source": str(self.source), "count": n})
+
+    def summary(self):
+        if not self.counts:
+            return
+        counts = ", ".join(f"{kind}: {n:,}" for kind, n in self.counts.items())
+        logging.warning(
+            f"{sum(self.counts.values()):,} problem lines in {self.source} ({counts}), {self.logged} logged",
+            extra={"line_issues": dict(self.counts), "source": str(self.source)},
+        )
+
+
+_local = threading.local()
+
+
+def current_issues():
+    if not hasattr(_local, "stack"):
+        # problems outside of file_issues are sampled over the whole process
+        _local.stack = [LineIssues()]
+    return _local.stack[-1]
+
+
+@contextmanager
+def file_issues(source):
+    """
+    Count the line_warning calls made while processing source, and log their
+    summary at the end.
+    """
+    current_issues()
+    issues = LineIssues(source)
+    _local.stack.append(issues)
+    try:
+        yield issues
+    finally:
+        _local.stack.pop()
+        issues.summary()
+
+
+def line_warning(kind, error, line=None):
+    """
+    Sampled, rate-limited warning about one line of the file being processed.
+    kind: Short name the problems are counted by, e.g. "invalid JSON".
+    """
+    current_issues().warn(kind, error, line)
@@ -0,0 +1,328 @@
+"""
+Throughput and resource instrumentation for the scan workers and aggregations.
+
+A worker fills a TaskMetrics while it processes a file (or chunk) and returns
+its result(); run_tasks appends the results to a metrics file in the output
+folder, and write_run_report turns that file into a run report. Time is split
+into phases: read (waiting on the file), decompress, parse, filter and write,
+so the report shows whether a run is I/O-, decompression- or parse-bound.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+import pandas as pd
+import psutil
+
+from src.ledger import atomic_path
+from src.progress import report_progress
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_FILE = "_metrics.jsonl"
+REPORT_FILE = "_run_report.json"
+TASKS_REPORT_FILE = "_run_report.parquet"
+
+COUNTERS = (
+    "bytes_read",
+    "bytes_decompressed",
+    "records_read",
+    "records_parsed",
+    "parse_errors",
+    "records_matched",
+    "rows_emitted",
+)
+PHASES = ("read", "decompress", "parse", "filter", "write")
+# Seconds between the RSS samples of a task where the peak cannot be reset
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes.
+    """
+    if resource is not None:
+        # kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    memory = psutil.Process().memory_info()
+    return getattr(memory, "peak_wset", memory.rss)
+
+
+def current_rss():
+    return psutil.Process().memory_info().rss
+
+
+def reset_peak_rss():
+    """
+    Reset the kernel's peak RSS of this process (VmHWM) to its current RSS.
+    Returns False where that is not possible (not Linux, or not permitted).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def status_peak_rss():
+    """
+    VmHWM of this process in bytes, or None.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler:
+    """
+    Background thread keeping the highest RSS of this process seen since the
+    last reset(); one per process, started on first use.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.peak = self.process.memory_info().rss
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @classmethod
+    def get(cls):
+        # a forked worker inherits the parent's instance, but not its thread
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls()
+        return cls._instance
+
+    def run(self):
+        while True:
+            rss = self.process.memory_info().rss
+            with self.lock:
+                self.peak = max(self.peak, rss)
+            time.sleep(RSS_SAMPLE_SECONDS)
+
+    def reset(self):
+        with self.lock:
+            self.peak = self.process.memory_info().rss
+
+    def read(self):
+        with self.lock:
+            return max(self.peak, self.process.memory_info().rss)
+
+
+class TaskPeak:
+    """
+    Peak RSS of this process during one task: the kernel's VmHWM, reset at the
+    start of the task, or else the highest RSS sampled by an RssSampler. Taking
+    the difference of the worker's lifetime peak instead reports 0 for every
+    task after one that used more memory.
+    """
+
+    def __init__(self):
+        self.sampler = None
+        if not reset_peak_rss() or status_peak_rss() is None:
+            self.sampler = RssSampler.get()
+            self.sampler.reset()
+
+    def read(self):
+        if self.sampler is not None:
+            return self.sampler.read()
+        return status_peak_rss()
+
+
+class TaskMetrics:
+    """
+    Counters and phase timers of one task.
+    """
+
+    def __init__(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.start = time.perf_counter()
+        self.rss_start = current_rss()
+        self.task_peak = TaskPeak()
+
+    def add(self, counter, n=1):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+        if counter == "bytes_read":
+            # reads come every block of the compressed file, often enough for progress
+            report_progress(self.counts)
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + time.perf_counter() - start
+
+    def timed_lines(self, lines):
+        """
+        Iterate over the lines of a decompressing reader, counting them and
+        timing the reads as decompression.
+        """
+        clock = time.perf_counter
+        lines = iter(lines)
+        while True:
+            start = clock()
+            line = next(lines, None)
+            self.seconds["decompress"] += clock() - start
+            if line is None:
+                return
+            self.counts["records_read"] += 1
+            yield line
+
+    def result(self):
+        report_progress(self.counts, force=True)
+        seconds = dict(self.seconds)
+        # reads of the compressed file happen while decompressing
+        seconds["decompress"] = max(0.0, seconds["decompress"] - seconds["read"])
+        result = dict(self.counts)
+        result.update({f"{phase}_seconds": s for phase, s in seconds.items()})
+        result["wall_seconds"] = time.perf_counter() - self.start
+        result["pid"] = os.getpid()
+        task_peak = self.task_peak.read()
+        result["peak_rss_bytes"] = max(peak_rss(), task_peak)
+        # memory the task took above the worker's RSS at its start, at its peak
+        result["rss_start_bytes"] = self.rss_start
+        result["task_peak_rss_bytes"] = task_peak
+        result["task_memory_bytes"] = max(0, task_peak - self.rss_start, current_rss() - self.rss_start)
+        return result
+
+
+class MeteredFile:
+    """
+    Read-only file wrapper that counts the bytes read and times the reads, for
+    the compressed side of a gzip reader.
+    """
+
+    def __init__(self, f, metrics):
+        self.f = f
+        self.metrics = metrics
+
+    def read(self, size=-1):
+        with self.metrics.timer("read"):
+            data = self.f.read(size)
+        self.metrics.add("bytes_read", len(data))
+        return data
+
+    def readinto(self, buffer):
+        with self.metrics.timer("read"):
+            n = self.f.readinto(buffer)
+        self.metrics.add("bytes_read", n or 0)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def record_metrics(metrics_file, name, result):
+    """
+    Append the result of a task to a metrics file.
+    """
+    if metrics_file is None or not isinstance(result, dict):
+        return
+    entry = {"task": name, "time": time.time(), **result}
+    with open(metrics_file, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+
+def load_metrics(metrics_file):
+    """
+    Latest metrics per task from a metrics file, as a DataFrame.
+    """
+    entries = {}
+    if Path(metrics_file).exists():
+        with open(metrics_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # partially written last line of a killed run
+                entries[entry["task"]] = entry
+    return pd.DataFrame(list(entries.values()))
+
+
+def summarize(tasks):
+    """
+    Totals, throughput, time per phase and peak memory per worker of a run.
+    """
+    phase_columns = [c for c in tasks.columns if c.endswith("_seconds") and c != "wall_seconds"]
+    counters = [c for c in tasks.columns if c in COUNTERS]
+    totals = {c: int(tasks[c].sum()) for c in counters}
+    phases = {c[: -len("_seconds")]: float(tasks[c].sum()) for c in phase_columns}
+    busy = sum(phases.values())
+    # tasks run in parallel, so throughput is per worker-second
+    worker_seconds = float(tasks["wall_seconds"].sum())
+    summary = {
+        "tasks": len(tasks),
+        "totals": totals,
+        "phase_seconds": phases,
+        "phase_share": {p: s / busy if busy else 0.0 for p, s in phases.items()},
+        "bound_by": max(phases, key=phases.get) if busy else None,
+        "worker_seconds": worker_seconds,
+        "per_worker_second": {
+            c: totals[c] / worker_seconds if worker_seconds else 0.0
+            for c in ("bytes_read", "bytes_decompressed", "records_read", "rows_emitted")
+            if c in totals
+        },
+        "peak_rss_bytes": {
+            str(pid): int(rss) for pid, rss in tasks.groupby("pid")["peak_rss_bytes"].max().items()
+        },
+    }
+    return summary
+
+
+def summary_table(summary):
+    rows = [
+        ("tasks", summary["tasks"]),
+        ("worker seconds", f"{summary['worker_seconds']:.1f}"),
+    ]
+    rows += [(name, f"{value:,}") for name, value in summary["totals"].items()]
+    rows += [
+        (f"{name}/worker-s", f"{value:,.0f}") for name, value in summary["per_worker_second"].items()
+    ]
+    rows += [
+        (f"{phase} time", f"{summary['phase_seconds'][phase]:.1f}s ({share:.0%})")
+        for phase, share in summary["phase_share"].items()
+    ]
+    rows.append(("bound by", summary["bound_by"]))
+    rss = summary["peak_rss_bytes"].values()
+    if rss:
+        rows.append(("peak RSS per worker", f"max {max(rss) / 2**20:,.0f} MB over {len(rss)} workers"))
+    width = max(len(name) for name, _ in rows)
+    return "\n".join(f"{name:<{width}}  {value}" for name, value in rows)
+
+
+def write_run_report(metrics_file, report_dir=None):
+    """
+    Write the run report of a metrics file: a JSON summary and a Parquet table
+    with a row per task, next to the metrics file (or in report_dir). Logs the
+    summary table and returns the summary, or None if there are no metrics.
+    """
+    tasks = load_metrics(metrics_file)
+    if tasks.empty:
+        logging.info(f"No metrics in {metrics_file}")
+        return None
+    report_dir = Path(report_dir or Path(metrics_file).parent)
+    summary = summarize(tasks)
+    with atomic_path(report_dir / REPORT_FILE) as tmp:
+        tmp.write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+    with atomic_path(report_dir / TASKS_REPORT_FILE) as tmp:
+        tasks.to_parquet(tmp, index=False)
+    logging.info(f"Run report for {report_dir}:\n{summary_table(summary)}")
+    return summary
@@ -0,0 +1,178 @@
+"""
+Hive-partitioned Parquet outputs bucketed by author ID.
+
+Rows are written under <dataset>/bucket=B/[year=Y/]*.parquet, where B is the
+numeric part of the author ID modulo the number of buckets. OpenAlex IDs are
+assigned sequentially, so this spreads authors evenly, and it is computed the
+same way in SQL and Python. Readers that only need some authors read only their
+buckets, and two datasets with the same number of buckets can be joined bucket
+by bucket in parallel.
+"""
+import os
+import re
+import shutil
+from pathlib import Path
+
+import duckdb
+import orjson
+
+from src.ledger import atomic_dir
+
+N_BUCKETS = 64
+# Written next to the partitions so readers know how the dataset was bucketed
+PARTITIONING_FILE = "_partitioning.json"
+
+
+def author_bucket(author_id, n_buckets=N_BUCKETS):
+    """
+    Bucket of an author ID (full URL, short ID or its number).
+    """
+    match = re.search(r"(\d+)$", str(author_id))
+    if match is None:
+        raise ValueError(f"Not an OpenAlex ID: {author_id}")
+    return int(match.group(1)) % n_buckets
+
+
+def bucket_expr(column, n_buckets=N_BUCKETS):
+    """
+    SQL expression of the bucket of an author ID column (string or integer).
+    """
+    digits = f"regexp_extract(CAST({column} AS VARCHAR), '(\\d+)$', 1)"
+    return f"CAST(CAST(NULLIF({digits}, '') AS HUGEINT) % {int(n_buckets)} AS INTEGER)"
+
+
+def sql_path(path):
+    return str(path).replace("'", "''")
+
+
+def load_partitioning(dataset_dir):
+    return orjson.loads((Path(dataset_dir) / PARTITIONING_FILE).read_bytes())
+
+
+def leaf_partitions(dataset_dir):
+    """
+    Relative paths of the partition directories that hold data files.
+    """
+    dataset_dir = Path(dataset_dir)
+    return sorted({f.parent.relative_to(dataset_dir) for f in dataset_dir.rglob("*.parquet")})
+
+
+def write_partitioned(
+    conn,
+    query,
+    output_dir,
+    author_col="author_id",
+    year_col=None,
+    n_buckets=N_BUCKETS,
+    replace_partitions=False,
+):
+    """
+    Write the result of a DuckDB query as a Parquet dataset partitioned by
+    author bucket (and year, if year_col is given).
+    conn: DuckDB connection the query runs on (e.g. with registered DataFrames).
+    replace_partitions: Only replace the partitions the query has rows for and
+    keep the others, for incremental updates. The query must then return every
+    row of each partition it touches. Otherwise the whole dataset is replaced.
+    Returns the number of rows written.
+    """
+    output_dir = Path(output_dir)
+    partition_by = "bucket" if year_col is None else f"bucket, {year_col}"
+    partitioning = {"author_col": author_col, "year_col": year_col, "n_buckets": n_buckets}
+    if replace_partitions and (output_dir / PARTITIONING_FILE).exists():
+        if load_partitioning(output_dir) != partitioning:
+            raise ValueError(f"{output_dir} is partitioned differently: {load_partitioning(output_dir)}")
+
+    def copy_to(tmp_dir):
+        # COPY ... PARTITION_BY wants to create the directory itself
+        tmp_dir.rmdir()
+        conn.execute(
+            f"""
+            COPY (
+                SELECT *, {bucket_expr(author_col, n_buckets)} AS bucket FROM ({query})
+            ) TO '{sql_path(tmp_dir)}'
+            (FORMAT parquet, PARTITION_BY ({partition_by}), COMPRESSION zstd)
+            """
+        )
+        (tmp_dir / PARTITIONING_FILE).write_bytes(orjson.dumps(partitioning))
+        return conn.execute(
+            f"SELECT COUNT(*) FROM read_parquet('{sql_path(tmp_dir / '**' / '*.parquet')}')"
+        ).fetchone()[0]
+
+    if not (replace_partitions and output_dir.exists()):
+        with atomic_dir(output_dir) as tmp_dir:
+            rows = copy_to(tmp_dir)
+        return rows
+
+    with atomic_dir(output_dir.with_name(f"{output_dir.name}.update")) as tmp_dir:
+        rows = copy_to(tmp_dir)
+        # swap in the new partitions one by one, leaving the others untouched
+        for partition in leaf_partitions(tmp_dir):
+            target = output_dir / partition
+            if target.exists():
+                shutil.rmtree(target)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_dir / partition, target)
+        os.replace(tmp_dir / PARTITIONING_FILE, output_dir / PARTITIONING_FILE)
+    return rows
+
+
+def write_partitioned_df(
+    df, output_dir, author_col="author_id", year_col=None, n_buckets=N_BUCKETS, replace_partitions=False
+):
+    """
+    write_partitioned for a pandas DataFrame.
+    """
+    conn = duckdb.connect(database=":memory:")
+    conn.register("df", df)
+    rows = write_partitioned(
+        conn, "SELECT * FROM df", output_dir, author_col, year_col, n_buckets, replace_partitions
+    )
+    conn.close()
+    return rows
+
+
+def bucket_files(dataset_dir, bucket):
+    """
+    Data files of one bucket, e.g. to join two datasets bucket by bucket.
+    """
+    return sorted((Path(dataset_dir) / f"bucket={bucket}").rglob("*.parquet"))
+
+
+def read_partitioned(dataset_dir, author_ids=None, years=None, columns="*"):
+    """
+    Read a partitioned dataset into a DataFrame, only opening the buckets (and
+    years) that can hold the requested rows.
+    author_ids: Only rows of these authors (default: all).
+    years: Only rows of these years; needs a dataset partitioned by year.
+    columns: SQL column list to select.
+    """
+    dataset_dir = Path(dataset_dir)
+    partitioning = load_partitioning(dataset_dir)
+    conditions = []
+    params = []
+    if author_ids is not None:
+        author_ids = list(author_ids)
+        if not author_ids:
+            conditions.append("FALSE")
+        else:
+            buckets = sorted({author_bucket(a, partitioning["n_buckets"]) for a in author_ids})
+            conditions.append(f"bucket IN ({', '.join(str(b) for b in buckets)})")
+            conditions.append(f"{partitioning['author_col']} IN (SELECT UNNEST(?))")
+            params.append(author_ids)
+    if years is not None:
+        if partitioning["year_col"] is None:
+            raise ValueError(f"{dataset_dir} is not partitioned by year")
+        conditions.append(f"{partitioning['year_col']} IN ({', '.join(str(int(y)) for y in years)})")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = duckdb.connect(database=":memory:")
+    result = conn.execute(
+        f"""
+        SELECT {columns}
+        FROM read_parquet('{sql_path(dataset_dir / '**' / '*.parquet')}', hive_partitioning = true)
+        {where}
+        """,
+        params,
+    ).df()
+    conn.close()
+    return result
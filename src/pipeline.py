@@ -0,0 +1,308 @@
+"""
+Runner for pipelines declared as a DAG of stages.
+
+A stage is a function called with keyword parameters, plus the paths it reads
+(inputs) and writes (outputs). A stage depends on the stages whose outputs
+overlap its inputs, so the DAG follows from the paths. Before running a stage
+the runner computes a key from the stage's code, parameters and the content of
+its inputs; a stage whose key matches its last successful run and whose outputs
+exist is skipped. Stages whose dependencies are done run concurrently.
+"""
+import argparse
+import hashlib
+import inspect
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import orjson
+
+from src.ledger import atomic_path, file_checksum
+from src.resources import share_machine
+
+STATE_FILE = Path("data/pipeline/_pipeline_state.jsonl")
+HASH_CACHE_FILE = Path("data/pipeline/_hash_cache.json")
+# Larger files (e.g. snapshot parts) are fingerprinted by size and mtime instead
+# of being read in full
+MAX_HASH_BYTES = 256 * 1024 * 1024
+# Stages running at the same time; each stage runs its own pool of workers, so
+# with more than one the pools split the CPUs and memory between them
+MAX_PARALLEL_STAGES = 1
+
+
+def stage(name, fn, inputs=(), outputs=(), params=None):
+    """
+    Declare a stage: fn(**params) reads inputs and writes outputs (paths of files
+    or directories).
+    """
+    return {
+        "name": name,
+        "fn": fn,
+        "inputs": [Path(p) for p in inputs],
+        "outputs": [Path(p) for p in outputs],
+        "params": params or {},
+    }
+
+
+def overlaps(a, b):
+    return a == b or a in b.parents or b in a.parents
+
+
+def dependencies(stages):
+    """
+    Names of the stages each stage depends on: those with an output that
+    overlaps one of its inputs. Raises on a cycle.
+    """
+    deps = {}
+    for s in stages:
+        deps[s["name"]] = sorted(
+            {
+                other["name"]
+                for other in stages
+                if other is not s
+                and any(overlaps(i, o) for i in s["inputs"] for o in other["outputs"])
+            }
+        )
+
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle in pipeline: {' -> '.join(path + [name])}")
+        visiting.add(name)
+        for dep in deps[name]:
+            visit(dep, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in deps:
+        visit(name, [])
+    return deps
+
+
+def upstream(targets, deps):
+    """
+    The targets and every stage they depend on, directly or not.
+    """
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(deps[name])
+    return selected
+
+
+class Fingerprints:
+    """
+    Content fingerprints of files and directories. File digests are cached by
+    path, size and mtime, so unchanged files are not read again.
+    """
+
+    def __init__(self, cache_file=HASH_CACHE_FILE, max_hash_bytes=MAX_HASH_BYTES):
+        self.cache_file = Path(cache_file)
+        self.max_hash_bytes = max_hash_bytes
+        self.cache = {}
+        if self.cache_file.exists():
+            self.cache = orjson.loads(self.cache_file.read_bytes())
+
+    def file(self, path):
+        stat = path.stat()
+        if stat.st_size > self.max_hash_bytes:
+            return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+        key = str(path.resolve())
+        cached = self.cache.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = file_checksum(path)
+        self.cache[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def path(self, path, exclude=()):
+        """
+        Fingerprint of a file or a directory tree. Bookkeeping files (names
+        starting with _ or .) and paths in exclude (outputs of other stages
+        nested in the directory) are left out.
+        """
+        path = Path(path)
+        if not path.exists():
+            return None
+        if path.is_file():
+            return self.file(path)
+        digest = hashlib.sha256()
+        for file in sorted(path.rglob("*")):
+            relative = file.relative_to(path)
+            if not file.is_file() or any(part[0] in "_." for part in relative.parts):
+                continue
+            if any(file == e or e in file.parents for e in exclude):
+                continue
+            digest.update(f"{relative}\0{self.file(file)}\n".encode())
+        return digest.hexdigest()
+
+    def save(self):
+        with atomic_path(self.cache_file) as tmp:
+            tmp.write_bytes(orjson.dumps(self.cache))
+
+
+def code_fingerprint(fn):
+    """
+    Fingerprint of the source file of a stage function, so editing a stage
+    reruns it.
+    """
+    source = inspect.getsourcefile(fn)
+    digest = file_checksum(source) if source else ""
+    return f"{fn.__module__}.{fn.__qualname__}:{digest}"
+
+
+def stage_key(s, stages, fingerprints):
+    """
+    Key of a stage's code, parameters and current inputs.
+    """
+    own_outputs = set(s["outputs"])
+    other_outputs = [o for other in stages for o in other["outputs"] if o not in own_outputs]
+    inputs = {}
+    for path in s["inputs"]:
+        exclude = [o for o in other_outputs if path in o.parents] + list(own_outputs)
+        inputs[str(path)] = fingerprints.path(path, exclude)
+    payload = {
+        "code": code_fingerprint(s["fn"]),
+        "params": s["params"],
+        "inputs": inputs,
+    }
+    return hashlib.sha256(orjson.dumps(payload, default=str, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def load_state(state_file=STATE_FILE):
+    """
+    Latest successful run per stage from an append-only state file.
+    """
+    state = {}
+    if not Path(state_file).exists():
+        return state
+    with open(state_file, "rb") as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # partially written last line of a killed run
+            state[entry["stage"]] = entry
+    return state
+
+
+def record_state(state_file, name, key, seconds):
+    Path(state_file).parent.mkdir(parents=True, exist_ok=True)
+    entry = {"stage": name, "key": key, "seconds": seconds, "time": time.time()}
+    with open(state_file, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+
+def is_up_to_date(s, key, state):
+    entry = state.get(s["name"])
+    return entry is not None and entry["key"] == key and all(p.exists() for p in s["outputs"])
+
+
+def run_stage(s):
+    logging.info(f"Running stage {s['name']}")
+    start = time.time()
+    s["fn"](**s["params"])
+    return time.time() - start
+
+
+def run_pipeline(
+    stages,
+    targets=None,
+    force=(),
+    dry_run=False,
+    max_parallel=MAX_PARALLEL_STAGES,
+    state_file=STATE_FILE,
+    fingerprints=None,
+):
+    """
+    Run the stages needed for the targets (default: all stages), skipping those
+    that are up to date.
+    force: Names of stages to run even if up to date.
+    dry_run: Only report which stages would run.
+    max_parallel: Stages run at the same time; their worker pools split the
+    machine's CPUs and memory.
+    Returns the status of each selected stage: skipped, done, failed, blocked (a
+    dependency failed) or, in a dry run, pending.
+    """
+    by_name = {s["name"]: s for s in stages}
+    deps = dependencies(stages)
+    unknown = set(targets or []) - set(by_name)
+    if unknown:
+        raise KeyError(f"Unknown stages: {sorted(unknown)}")
+    selected = upstream(targets or by_name, deps)
+    fingerprints = fingerprints or Fingerprints()
+    state = load_state(state_file)
+
+    share_machine(max_parallel)
+    status = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while len(status) < len(selected):
+            started = {name for name, _ in running.values()}
+            for name in sorted(selected - set(status) - started):
+                dep_status = [status.get(dep) for dep in deps[name] if dep in selected]
+                if any(st in ("failed", "blocked") for st in dep_status):
+                    status[name] = "blocked"
+                    logging.error(f"Stage {name} not run: a dependency failed")
+                    continue
+                if any(st is None for st in dep_status):
+                    continue  # dependencies still running
+                s = by_name[name]
+                # in a dry run, stages after one that would run cannot be checked
+                key = None if "pending" in dep_status else stage_key(s, stages, fingerprints)
+                if name not in force and key is not None and is_up_to_date(s, key, state):
+                    logging.info(f"Stage {name} is up to date")
+                    status[name] = "skipped"
+                elif dry_run:
+                    status[name] = "pending"
+                else:
+                    running[executor.submit(run_stage, s)] = (name, key)
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, key = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    logging.error(f"Stage {name} failed: {e}")
+                    status[name] = "failed"
+                    continue
+                # the key of the inputs the stage started with, so inputs changed
+                # while it ran are picked up by the next run
+                record_state(state_file, name, key, seconds)
+                status[name] = "done"
+                logging.info(f"Stage {name} done in {seconds:.0f}s")
+    fingerprints.save()
+    return status
+
+
+def main(stages, description="Run the pipeline"):
+    """
+    Command line for a pipeline: run the given targets (default: all stages).
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("targets", nargs="*", help="Stages to bring up to date, with their dependencies")
+    parser.add_argument("--force", nargs="*", default=[], help="Stages to run even if up to date")
+    parser.add_argument("--dry-run", action="store_true", help="Only show which stages would run")
+    parser.add_argument("--list", action="store_true", help="List the stages and their dependencies")
+    parser.add_argument("--parallel", type=int, default=MAX_PARALLEL_STAGES, help="Stages run at the same time")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, deps in dependencies(stages).items():
+            print(f"{name}: {', '.join(deps) or '-'}")
+        return
+    status = run_pipeline(stages, args.targets, args.force, args.dry_run, args.parallel)
+    for name, st in status.items():
+        print(f"{name}: {st}")
+    if any(st in ("failed", "blocked") for st in status.values()):
+        raise SystemExit(1)
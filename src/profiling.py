@@ -0,0 +1,216 @@
+"""
+Opt-in profiling of the tasks run by src/task_runner.run_tasks.
+
+Set PROFILE_TASKS=N to profile the first N tasks of a run (in whichever workers
+they land), e.g. PROFILE_TASKS=4 python process_scopes.py. Each profiled task
+writes its profile to PROFILE_DIR/<module.function>/ and the profiles are merged
+when the run ends:
+- PROFILE_MODE=sample (default): a sampling profiler records the worker's stack
+  every PROFILE_INTERVAL_MS milliseconds. The merged output, merged.collapsed,
+  is in the collapsed-stack format of flamegraph.pl, speedscope and inferno.
+- PROFILE_MODE=cprofile: cProfile (higher overhead, exact call counts). The
+  merged output is merged.pstats (e.g. for snakeviz) and a text summary.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import orjson
+
+PROFILE_DIR = Path("data/profiles")
+MODES = ("sample", "cprofile")
+SAMPLE_INTERVAL_MS = 5
+MERGED_COLLAPSED = "merged.collapsed"
+MERGED_PSTATS = "merged.pstats"
+
+
+def profile_settings(fn):
+    """
+    Profiling settings for the tasks of fn from the environment, or None when
+    profiling is off.
+    """
+    n_tasks = int(os.getenv("PROFILE_TASKS", "0"))
+    if n_tasks <= 0:
+        return None
+    mode = os.getenv("PROFILE_MODE", "sample")
+    if mode not in MODES:
+        raise ValueError(f"PROFILE_MODE must be one of {MODES}, not {mode}")
+    profile_dir = Path(os.getenv("PROFILE_DIR", PROFILE_DIR)) / f"{fn.__module__}.{fn.__name__}"
+    interval = float(os.getenv("PROFILE_INTERVAL_MS", SAMPLE_INTERVAL_MS)) / 1000
+    return {"profile_dir": profile_dir, "n_tasks": n_tasks, "mode": mode, "interval": interval}
+
+
+def prepare_profile_dir(profile_dir):
+    """
+    Empty the profile directory of a previous run.
+    """
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    for path in profile_dir.iterdir():
+        if path.is_file():
+            path.unlink()
+
+
+def claim_slot(profile_dir, n_tasks):
+    """
+    Claim one of the n_tasks profiling slots, across all worker processes.
+    Returns the slot number, or None when all are taken.
+    """
+    for slot in range(n_tasks):
+        try:
+            os.close(os.open(Path(profile_dir) / f".slot{slot}", os.O_CREAT | os.O_EXCL))
+            return slot
+        except FileExistsError:
+            continue
+    return None
+
+
+def frame_name(code):
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread from a background thread and counts the
+    collapsed stacks (root;...;leaf).
+    root_frame: Frame the stacks start below, to leave out the frames of the
+    process pool (and, in forked workers, of the parent) above the task.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL_MS / 1000, thread_id=None, root_frame=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.root_frame = root_frame
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root_frame:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if self.stopped.is_set():
+                break  # the task is over, the stack is the sampler's own stop
+            if frame is not self.root_frame:
+                continue  # sampled outside the task
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def write_collapsed(counts, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in sorted(counts.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def read_collapsed(path):
+    counts = Counter()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+class ProfiledTask:
+    """
+    Wrapper of a task function that profiles the call when it gets one of the
+    profiling slots. Picklable, so it can be submitted to a process pool.
+    """
+
+    def __init__(self, fn, profile_dir, n_tasks, mode="sample", interval=SAMPLE_INTERVAL_MS / 1000):
+        self.fn = fn
+        self.profile_dir = Path(profile_dir)
+        self.n_tasks = n_tasks
+        self.mode = mode
+        self.interval = interval
+
+    def __call__(self, *args):
+        slot = claim_slot(self.profile_dir, self.n_tasks)
+        if slot is None:
+            return self.fn(*args)
+
+        name = self.profile_dir / f"{slot:03d}"
+        start = time.perf_counter()
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(self.fn, *args)
+            finally:
+                profiler.dump_stats(f"{name}.pstats")
+                self.write_meta(name, args, start)
+        sampler = StackSampler(self.interval, root_frame=sys._getframe())
+        sampler.start()
+        try:
+            return self.fn(*args)
+        finally:
+            sampler.stop()
+            write_collapsed(sampler.counts, f"{name}.collapsed")
+            self.write_meta(name, args, start, sum(sampler.counts.values()))
+
+    def write_meta(self, name, args, start, samples=None):
+        meta = {
+            "task": str(args[0]) if args else None,
+            "pid": os.getpid(),
+            "seconds": time.perf_counter() - start,
+            "mode": self.mode,
+            "samples": samples,
+        }
+        Path(f"{name}.json").write_bytes(orjson.dumps(meta))
+
+
+def merge_profiles(profile_dir):
+    """
+    Merge the per-task profiles of a directory into merged.collapsed (sampled
+    profiles) and merged.pstats plus merged.txt (cProfile profiles).
+    Returns the paths written.
+    """
+    profile_dir = Path(profile_dir)
+    written = []
+    collapsed = sorted(p for p in profile_dir.glob("*.collapsed") if p.name != MERGED_COLLAPSED)
+    if collapsed:
+        counts = Counter()
+        for path in collapsed:
+            counts.update(read_collapsed(path))
+        write_collapsed(counts, profile_dir / MERGED_COLLAPSED)
+        written.append(profile_dir / MERGED_COLLAPSED)
+
+    profiles = sorted(p for p in profile_dir.glob("*.pstats") if p.name != MERGED_PSTATS)
+    if profiles:
+        stats = pstats.Stats(str(profiles[0]))
+        for path in profiles[1:]:
+            stats.add(str(path))
+        stats.dump_stats(profile_dir / MERGED_PSTATS)
+        summary = io.StringIO()
+        pstats.Stats(str(profile_dir / MERGED_PSTATS), stream=summary).sort_stats("cumulative").print_stats(40)
+        (profile_dir / "merged.txt").write_text(summary.getvalue(), encoding="utf-8")
+        written += [profile_dir / MERGED_PSTATS, profile_dir / "merged.txt"]
+
+    if written:
+        logging.info(f"Merged {len(collapsed) + len(profiles)} profiles into {', '.join(map(str, written))}")
+    return written
+
+
+if __name__ == "__main__":
+    # merge the profiles of a directory again, e.g. after copying in profiles
+    # from other hosts: python -m src.profiling data/profiles/process_scopes.process_local_file
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    merge_profiles(sys.argv[1])
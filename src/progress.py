@@ -0,0 +1,311 @@
+"""
+Progress of run_tasks runs in records and bytes instead of files.
+
+Snapshot parts range from a few dozen to hundreds of thousands of records, so a
+bar that ticks once per file gives a meaningless ETA. run_tasks weighs every
+task by the record count and size of its part in the entity's manifest (chunks
+by their share of the part), workers report the bytes and records they have
+read through a queue (see report_progress, called by src/metrics.TaskMetrics),
+and the bar, throughput and ETA follow the records read. Without a manifest the
+parts are weighed by their size on disk.
+
+The progress is also appended to a JSON-lines file every EXPORT_SECONDS, e.g.
+to plan the cluster time of a full run from a partial one.
+"""
+import logging
+import os
+import queue as queues
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import orjson
+from tqdm import tqdm
+
+PROGRESS_FILE = "_progress.jsonl"
+# Seconds between the reports of a worker, and between refreshes of the bar
+REPORT_SECONDS = 1.0
+# Seconds between the lines appended to the progress file
+EXPORT_SECONDS = 30.0
+
+_queue = None
+_task = None
+_last_report = 0.0
+
+
+# Sizes of the tasks
+
+
+@lru_cache(maxsize=None)
+def manifest_dir(directory):
+    """
+    The entity directory (the one holding the manifest) a directory is in, or None.
+    """
+    directory = Path(directory)
+    for parent in (directory, *directory.parents):
+        if (parent / "manifest").is_file():
+            return parent
+    return None
+
+
+@lru_cache(maxsize=None)
+def load_manifest_sizes(entity_dir):
+    """
+    Compressed size and record count per part (relative path) of an entity's manifest.
+    """
+    entity = Path(entity_dir).name
+    sizes = {}
+    try:
+        manifest = orjson.loads((Path(entity_dir) / "manifest").read_bytes())
+    except (OSError, orjson.JSONDecodeError) as e:
+        logging.warning(f"Could not read the manifest of {entity_dir}: {e}")
+        return sizes
+    for entry in manifest.get("entries", []):
+        relative = entry["url"].split(f"/{entity}/", 1)[-1]
+        meta = entry.get("meta", {})
+        sizes[relative] = {"bytes": meta.get("content_length"), "records": meta.get("record_count")}
+    return sizes
+
+
+def part_size(path):
+    """
+    Compressed size and record count of a part: from its manifest if it has one,
+    else its size on disk and an unknown record count.
+    """
+    path = Path(path)
+    entity_dir = manifest_dir(path.parent)
+    if entity_dir is not None:
+        size = load_manifest_sizes(entity_dir).get(path.relative_to(entity_dir).as_posix())
+        if size is not None:
+            return dict(size)
+    return {"bytes": os.path.getsize(path) if path.is_file() else None, "records": None}
+
+
+def task_sizes(keys):
+    """
+    Size of every (file, chunk) task: the part's, or the chunk's share of it.
+    """
+    sizes = {}
+    for key in keys:
+        file, chunk = key
+        size = part_size(file)
+        if chunk is not None:
+            _, n_chunks, _, n_lines = chunk
+            share = n_lines / size["records"] if size["records"] else 1 / n_chunks
+            size = {
+                "bytes": size["bytes"] * share if size["bytes"] is not None else None,
+                "records": n_lines,
+            }
+        sizes[key] = size
+    return sizes
+
+
+# Worker side
+
+
+def worker_progress(queue):
+    """
+    Pool initializer: report the progress of this worker's tasks to queue.
+    """
+    global _queue
+    _queue = queue
+
+
+def start_task(name):
+    global _task, _last_report
+    _task = name
+    _last_report = time.monotonic()
+
+
+def report_progress(counts, force=False):
+    """
+    Send the bytes and records read so far by the current task, at most once
+    every REPORT_SECONDS. Does nothing outside of run_tasks workers.
+    """
+    global _last_report
+    if _queue is None or _task is None:
+        return
+    now = time.monotonic()
+    if not force and now - _last_report < REPORT_SECONDS:
+        return
+    _last_report = now
+    _queue.put((_task, counts.get("bytes_read", 0), counts.get("records_read", 0)))
+
+
+# Parent side
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class Progress:
+    """
+    Progress bar and periodic export of a run, weighted by the task sizes.
+    sizes: dict mapping a task name to its {"bytes", "records"} (see task_sizes).
+    """
+
+    def __init__(self, sizes, desc="Overall Progress", progress_file=None, queue=None):
+        self.sizes = sizes
+        self.desc = desc
+        self.progress_file = progress_file
+        self.queue = queue
+        if sizes and all(s["records"] is not None for s in sizes.values()):
+            self.unit = "records"
+        elif sizes and all(s["bytes"] is not None for s in sizes.values()):
+            self.unit = "bytes"
+        else:
+            self.unit = "tasks"
+        self.total = sum(self.full(name)[self.unit] for name in sizes)
+        self.finished = set()
+        self.running = {}  # name -> (bytes, records) reported by its worker
+        self.reported = {}  # name -> (bytes, records) last reported, also once finished
+        self.bar = None
+
+    def full(self, name):
+        size = self.sizes[name]
+        return {"bytes": size["bytes"] or 0, "records": size["records"] or 0, "tasks": 1}
+
+    def amounts(self, name):
+        """
+        Bytes, records and tasks done of a task: all of them once it is
+        finished, else what its worker last reported.
+        """
+        full = self.full(name)
+        if name in self.finished:
+            if self.sizes[name]["records"] is None and name in self.reported:
+                # without a manifest, the records of a part are only known once read
+                full["records"] = self.reported[name][1]
+            return full
+        if name not in self.running:
+            return {"bytes": 0, "records": 0, "tasks": 0}
+        bytes_read, records = self.running[name]
+        records = min(records, full["records"]) if self.sizes[name]["records"] else records
+        if self.sizes[name]["records"]:
+            # seeking to a chunk reads the part up to it, so bytes follow the records
+            bytes_read = full["bytes"] * records / full["records"]
+        else:
+            bytes_read = min(bytes_read, full["bytes"])
+        share = records / full["records"] if full["records"] else bytes_read / full["bytes"] if full["bytes"] else 0
+        return {"bytes": bytes_read, "records": records, "tasks": share}
+
+    def done(self):
+        totals = {"bytes": 0, "records": 0, "tasks": 0}
+        for name in self.finished | set(self.running):
+            for unit, amount in self.amounts(name).items():
+                totals[unit] += amount
+        return totals
+
+    def skip(self, name):
+        """
+        Count a task done by a previous run; call before start.
+        """
+        self.finished.add(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.bar is not None:
+            self.close()
+
+    def start(self):
+        self.started = time.monotonic()
+        self.start_done = self.done()
+        self.last_export = None
+        self.bar = tqdm(
+            total=self.total,
+            initial=self.start_done[self.unit],
+            desc=self.desc,
+            unit=" records" if self.unit == "records" else "B" if self.unit == "bytes" else " tasks",
+            unit_scale=self.unit != "tasks",
+        )
+        self.export()
+
+    def finish(self, name):
+        """
+        A task succeeded, or failed for good.
+        """
+        self.finished.add(name)
+        self.running.pop(name, None)
+
+    def retry(self, name):
+        """
+        A task failed and will be retried: forget its partial progress.
+        """
+        self.running.pop(name, None)
+
+    def poll(self):
+        if self.queue is None:
+            return
+        while True:
+            try:
+                name, bytes_read, records = self.queue.get_nowait()
+            except (queues.Empty, OSError, ValueError):
+                return
+            if name not in self.sizes:
+                continue
+            self.reported[name] = (bytes_read, records)
+            if name not in self.finished:
+                self.running[name] = (bytes_read, records)
+
+    def stats(self, done=None):
+        done = done or self.done()
+        elapsed = time.monotonic() - self.started
+        rates = {
+            unit: (done[unit] - self.start_done[unit]) / elapsed if elapsed > 0 else 0.0 for unit in done
+        }
+        remaining = self.total - done[self.unit]
+        rate = rates[self.unit]
+        return {
+            "time": time.time(),
+            "elapsed_seconds": elapsed,
+            "unit": self.unit,
+            "done_bytes": done["bytes"],
+            "total_bytes": sum(self.full(n)["bytes"] for n in self.sizes),
+            "done_records": done["records"],
+            "total_records": sum(self.full(n)["records"] for n in self.sizes),
+            "tasks_finished": len(self.finished),
+            "tasks_running": len(self.running),
+            "total_tasks": len(self.sizes),
+            "bytes_per_second": rates["bytes"],
+            "records_per_second": rates["records"],
+            "eta_seconds": remaining / rate if rate > 0 else None,
+        }
+
+    def refresh(self):
+        """
+        Read the workers' reports, move the bar and export if it is time to.
+        """
+        self.poll()
+        done = self.done()
+        stats = self.stats(done)
+        self.bar.update(done[self.unit] - self.bar.n)
+        postfix = f"{len(self.finished)}/{len(self.sizes)} tasks"
+        if self.unit == "records":
+            postfix += f", {stats['bytes_per_second'] / 2**20:,.1f} MB/s"
+        self.bar.set_postfix_str(postfix, refresh=False)
+        if self.last_export is None or time.monotonic() - self.last_export >= EXPORT_SECONDS:
+            self.export(stats)
+
+    def export(self, stats=None):
+        self.last_export = time.monotonic()
+        if self.progress_file is None:
+            return
+        with open(self.progress_file, "ab") as f:
+            f.write(orjson.dumps(stats or self.stats()) + b"\n")
+
+    def close(self):
+        self.refresh()
+        stats = self.stats()
+        self.export(stats)
+        self.bar.close()
+        logging.info(
+            f"{self.desc}: {stats['done_records']:,.0f} records, {stats['done_bytes'] / 2**20:,.0f} MB in "
+            f"{format_eta(stats['elapsed_seconds'])} ({stats['records_per_second']:,.0f} records/s, "
+            f"{stats['bytes_per_second'] / 2**20:,.1f} MB/s)"
+        )
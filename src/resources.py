@@ -0,0 +1,185 @@
+"""
+CPU and memory aware sizing of the worker pools of run_tasks.
+
+The pool gets as many workers as there are CPUs (minus RESERVED_CPUS), but no
+more than the usable memory holds at the estimated cost of a typical task.
+A task is estimated to take a fixed amount plus an amount per record of its
+part (the record counts come from the manifests, see src/progress.py). The
+estimates start from the defaults below and are raised to fit the memory the
+finished tasks actually took at their peak (TaskMetrics reports it, see
+src/metrics.py); they never go below the defaults.
+
+While the run goes, a task is only submitted when the estimates of the tasks in
+flight plus its own fit in the memory budget and the machine is not under
+memory pressure, so a few very large parts run with fewer tasks alongside
+instead of running the machine out of memory. One task always runs.
+"""
+import logging
+import math
+import os
+
+import numpy as np
+import psutil
+
+# CPUs left to the main process and the rest of the machine
+RESERVED_CPUS = 2
+# Share of the memory left to the main process and the rest of the machine;
+# with less than this available, no new task is submitted
+RESERVED_MEMORY_SHARE = 0.15
+# Initial estimates: memory of an idle worker, and of a task per record
+WORKER_MEMORY = 300 * 2**20
+BYTES_PER_RECORD = 4 * 2**10
+# Records per compressed byte of a part without a record count (about 3 KB a work)
+RECORDS_PER_BYTE = 1 / 3_000
+# Margin on the fitted per-record memory
+SAFETY = 1.25
+# Finished tasks needed before the per-record memory is fitted
+MIN_OBSERVATIONS = 3
+
+# Pools running at the same time in this process (e.g. concurrent pipeline
+# stages, see src/pipeline.py), which share the CPUs and memory
+_shares = 1
+
+
+def share_machine(n):
+    """
+    Size the pools for n of them running at the same time.
+    """
+    global _shares
+    _shares = max(1, int(n))
+
+
+def cgroup_value(path):
+    try:
+        with open(path) as f:
+            value = f.read().split()
+    except OSError:
+        return None
+    return value
+
+
+def available_cpus():
+    """
+    CPUs this process may use: its affinity mask and, in a container, its
+    cgroup CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    quota = cgroup_value("/sys/fs/cgroup/cpu.max")
+    if quota and quota[0] != "max":
+        cpus = min(cpus, max(1, math.floor(int(quota[0]) / int(quota[1]))))
+    return cpus
+
+
+def cpu_workers(reserved=RESERVED_CPUS):
+    return max(1, (available_cpus() - reserved) // _shares)
+
+
+def memory_status():
+    """
+    Total and available memory in bytes, within the container's cgroup limit
+    if it has one.
+    """
+    memory = psutil.virtual_memory()
+    total, available = memory.total, memory.available
+    limit = cgroup_value("/sys/fs/cgroup/memory.max")
+    current = cgroup_value("/sys/fs/cgroup/memory.current")
+    if limit and current and limit[0] != "max":
+        total = min(total, int(limit[0]))
+        available = min(available, int(limit[0]) - int(current[0]))
+    return total, available
+
+
+class MemoryBudget:
+    """
+    Memory estimates of the tasks of a run and admission of the tasks by them.
+    sizes: dict mapping a task name to its {"bytes", "records"} (see src/progress.task_sizes).
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        total, available = memory_status()
+        self.reserved = total * RESERVED_MEMORY_SHARE
+        self.usable = max(0, available - self.reserved) / _shares
+        self.worker_memory = WORKER_MEMORY
+        self.fixed = 0
+        self.per_record = BYTES_PER_RECORD
+        self.observations = []  # (records, task memory) of the finished tasks
+        self.in_flight = {}  # name -> estimate
+        self.throttled = False
+
+    def records(self, name):
+        size = self.sizes.get(name, {})
+        if size.get("records") is not None:
+            return size["records"]
+        if size.get("bytes") is not None:
+            return size["bytes"] * RECORDS_PER_BYTE
+        return 0
+
+    def estimate(self, name):
+        return self.fixed + self.per_record * self.records(name)
+
+    def pool_size(self, max_workers=None):
+        """
+        Workers for the run: bounded by the CPUs, by max_workers and by the
+        memory at the estimated cost of a 90th-percentile task.
+        """
+        cpus = cpu_workers()
+        typical = float(np.percentile([self.estimate(n) for n in self.sizes], 90)) if self.sizes else 0.0
+        by_memory = max(1, int(self.usable // (self.worker_memory + typical)))
+        workers = max(1, min(cpus, by_memory, max_workers or cpus, len(self.sizes) or 1))
+        logging.info(
+            f"Using {workers} workers ({cpus} CPUs, memory for {by_memory} at "
+            f"{(self.worker_memory + typical) / 2**20:,.0f} MB per task of {self.usable / 2**30:,.1f} GB usable)"
+        )
+        return workers
+
+    def admit(self, name):
+        """
+        Whether the task may be submitted now, next to the tasks in flight.
+        """
+        if not self.in_flight:
+            return True
+        _, available = memory_status()
+        needed = sum(self.in_flight.values()) + self.estimate(name)
+        needed += self.worker_memory * (len(self.in_flight) + 1)
+        if available < self.reserved or needed > self.usable:
+            if not self.throttled:
+                logging.info(
+                    f"Holding back tasks: {len(self.in_flight)} in flight need about "
+                    f"{needed / 2**30:,.1f} GB of {self.usable / 2**30:,.1f} GB, "
+                    f"{available / 2**30:,.1f} GB available"
+                )
+            self.throttled = True
+            return False
+        self.throttled = False
+        return True
+
+    def started(self, name):
+        self.in_flight[name] = self.estimate(name)
+
+    def finished(self, name, result=None):
+        """
+        A task finished (or failed); result is the metrics it returned, if any.
+        """
+        self.in_flight.pop(name, None)
+        if isinstance(result, dict) and "task_memory_bytes" in result:
+            self.observe(result.get("records_read") or self.records(name), result)
+
+    def observe(self, records, result):
+        if result.get("rss_start_bytes"):
+            if not self.observations:
+                self.worker_memory = result["rss_start_bytes"]
+            self.worker_memory = max(self.worker_memory, result["rss_start_bytes"])
+        if not result["task_memory_bytes"]:
+            return  # no measure of the task's memory, not a task that took none
+        self.observations.append((records, result["task_memory_bytes"]))
+        records, memory = np.array(self.observations, dtype=float).T
+        if len(self.observations) >= MIN_OBSERVATIONS and np.ptp(records) > 0:
+            fitted = float(np.polyfit(records, memory, 1)[0]) * SAFETY
+            # the observations only raise the estimates above the defaults
+            self.per_record = max(BYTES_PER_RECORD, fitted)
+        # shift the line up so that it covers every task seen so far
+        self.fixed = max(0.0, float(np.max(memory - self.per_record * records)))
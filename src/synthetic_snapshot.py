@@ -0,0 +1,249 @@
+"""
+Generator of synthetic OpenAlex snapshots for benchmarks.
+
+Writes works and authors parts laid out like the real snapshot
+(<output_dir>/data/<entity>/updated_date=YYYY-MM-DD/part_NNN.gz, with a manifest
+per entity) with the fields the stages read. The distributions follow the
+shapes that make the real snapshot slow: a few authors sign most authorships,
+some works have hundreds of authors, reference lists have a long tail and part
+sizes vary by orders of magnitude. The output only depends on the arguments.
+"""
+import argparse
+import gzip
+import logging
+from pathlib import Path
+
+import numpy as np
+import orjson
+
+from src.ledger import atomic_path
+
+OPENALEX_URL = "https://openalex.org/"
+TYPES = ["article", "article", "article", "article", "book-chapter", "preprint", "review", "dataset"]
+FIRST_YEAR = 1990
+LAST_YEAR = 2024
+# Zipf exponent of author productivity and of citations between works
+AUTHOR_SKEW = 1.1
+CITATION_SKEW = 0.9
+# Share of works written by large collaborations, with a lognormal team size
+TEAM_SHARE = 0.01
+MAX_AUTHORS = 2000
+# Lognormal reference-list lengths: median about 27, tail up to MAX_REFERENCES
+REFERENCES_MU = 3.3
+REFERENCES_SIGMA = 1.0
+MAX_REFERENCES = 5000
+
+
+def zipf_sampler(n, skew, rng):
+    """
+    Sampler of numbers 1..n with Zipf-like probabilities (1 the most likely).
+    """
+    cdf = np.cumsum(1.0 / np.arange(1, n + 1) ** skew)
+    cdf /= cdf[-1]
+    return lambda size: np.minimum(np.searchsorted(cdf, rng.random(size)), n - 1) + 1
+
+
+def part_sizes(n_records, n_parts, rng):
+    """
+    Number of records per part, spread over orders of magnitude like the real
+    snapshot parts. Every part gets at least one record.
+    """
+    n_parts = max(1, min(n_parts, n_records))
+    shares = rng.lognormal(0, 1.5, n_parts)
+    sizes = 1 + np.floor(shares / shares.sum() * (n_records - n_parts)).astype(int)
+    sizes[np.argmax(sizes)] += n_records - sizes.sum()
+    return sizes
+
+
+def partition_dates(n_dates):
+    return [f"2025-{month:02d}-01" for month in range(1, n_dates + 1)]
+
+
+def write_parts(entity_dir, records, sizes, dates, invalid_rate, rng):
+    """
+    Write the records into gzipped JSON-lines parts spread over updated_date
+    partitions, and the entity's manifest. invalid_rate is the share of lines
+    replaced by malformed JSON. Returns the part paths.
+    """
+    entity_dir = Path(entity_dir)
+    entity = entity_dir.name
+    entries = []
+    parts = []
+    start = 0
+    for index, size in enumerate(sizes):
+        date = dates[index * len(dates) // len(sizes)]
+        part = entity_dir / f"updated_date={date}" / f"part_{index:03d}.gz"
+        with atomic_path(part) as tmp:
+            with gzip.open(tmp, "wb", compresslevel=6) as f:
+                for record in records(start, start + size):
+                    if invalid_rate and rng.random() < invalid_rate:
+                        f.write(b'{"id": "broken\n')
+                    else:
+                        f.write(orjson.dumps(record) + b"\n")
+        entries.append(
+            {
+                "url": f"s3://openalex/data/{entity}/updated_date={date}/{part.name}",
+                "meta": {"content_length": part.stat().st_size, "record_count": int(size)},
+            }
+        )
+        parts.append(part)
+        start += size
+    manifest = {
+        "entries": entries,
+        "meta": {
+            "content_length": sum(e["meta"]["content_length"] for e in entries),
+            "record_count": sum(e["meta"]["record_count"] for e in entries),
+        },
+    }
+    with atomic_path(entity_dir / "manifest") as tmp:
+        tmp.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    return parts
+
+
+def generate_works(
+    entity_dir, n_works, n_authors, n_institutions=500, n_parts=8, n_dates=2, seed=0, invalid_rate=0.0
+):
+    """
+    Write n_works synthetic works whose authors are drawn from n_authors.
+    """
+    rng = np.random.default_rng(seed)
+    sample_authors = zipf_sampler(n_authors, AUTHOR_SKEW, rng)
+    # works are cited the more the lower their number, like older, famous papers
+    sample_cited = zipf_sampler(n_works, CITATION_SKEW, rng)
+    years = np.arange(FIRST_YEAR, LAST_YEAR + 1)
+    year_weights = np.linspace(1, 4, len(years))
+    year_weights /= year_weights.sum()
+
+    def authorship(author, position, n):
+        institution = int(rng.integers(1, n_institutions + 1))
+        return {
+            "author_position": "first" if position == 0 else "last" if position == n - 1 else "middle",
+            "author": {
+                "id": f"{OPENALEX_URL}A{author}",
+                "display_name": f"Author {author}",
+                "orcid": None,
+            },
+            "institutions": [{"id": f"{OPENALEX_URL}I{institution}", "country_code": "US"}],
+            "is_corresponding": position == 0,
+        }
+
+    def records(start, stop):
+        for number in range(start + 1, stop + 1):
+            if rng.random() < TEAM_SHARE:
+                n = int(min(MAX_AUTHORS, 10 + rng.lognormal(4, 1)))
+            else:
+                n = int(rng.geometric(0.35))
+            authors = sample_authors(n)
+            n_references = int(min(MAX_REFERENCES, rng.lognormal(REFERENCES_MU, REFERENCES_SIGMA)))
+            references = sample_cited(n_references)
+            year = int(rng.choice(years, p=year_weights))
+            yield {
+                "id": f"{OPENALEX_URL}W{number}",
+                "doi": f"https://doi.org/10.0000/{number}",
+                "title": f"Work {number}",
+                "publication_year": year,
+                "publication_date": f"{year}-{int(rng.integers(1, 13)):02d}-01",
+                "type": TYPES[int(rng.integers(len(TYPES)))],
+                "language": "en",
+                "cited_by_count": int(rng.poisson(20)),
+                "is_retracted": False,
+                "primary_location": {"source": {"id": f"{OPENALEX_URL}S{int(rng.integers(1, 1000))}"}},
+                "primary_topic": {"id": f"{OPENALEX_URL}T{int(rng.integers(10000, 14500))}"},
+                "authorships": [authorship(int(a), i, n) for i, a in enumerate(authors)],
+                "referenced_works": [f"{OPENALEX_URL}W{int(r)}" for r in references],
+                "counts_by_year": [
+                    {"year": y, "cited_by_count": int(rng.poisson(3))}
+                    for y in range(max(year, 2012), LAST_YEAR + 1)
+                ],
+                "updated_date": "2025-01-01T00:00:00",
+            }
+
+    sizes = part_sizes(n_works, n_parts, rng)
+    return write_parts(entity_dir, records, sizes, partition_dates(n_dates), invalid_rate, rng)
+
+
+def generate_authors(entity_dir, n_authors, n_institutions=500, n_parts=4, n_dates=2, seed=0):
+    """
+    Write n_authors synthetic authors with affiliations at n_institutions.
+    """
+    rng = np.random.default_rng(seed + 1)
+
+    def records(start, stop):
+        for number in range(start + 1, stop + 1):
+            affiliations = []
+            for _ in range(int(rng.integers(0, 4))):
+                first = int(rng.integers(FIRST_YEAR, LAST_YEAR + 1))
+                affiliations.append(
+                    {
+                        "institution": {
+                            "id": f"{OPENALEX_URL}I{int(rng.integers(1, n_institutions + 1))}",
+                            "country_code": "US",
+                        },
+                        "years": list(range(LAST_YEAR, first - 1, -1))[:10],
+                    }
+                )
+            # productivity follows the same skew as the authorships of the works
+            works_count = int(1 + 1000 / number ** AUTHOR_SKEW + rng.poisson(2))
+            yield {
+                "id": f"{OPENALEX_URL}A{number}",
+                "display_name": f"Author {number}",
+                "orcid": None,
+                "works_count": works_count,
+                "cited_by_count": int(rng.poisson(10 * works_count)),
+                "summary_stats": {"2yr_mean_citedness": float(rng.random() * 5), "h_index": 1, "i10_index": 0},
+                "affiliations": affiliations,
+                "last_known_institutions": [a["institution"] for a in affiliations[:1]],
+                "counts_by_year": [
+                    {"year": y, "works_count": int(rng.poisson(1)), "cited_by_count": int(rng.poisson(5))}
+                    for y in range(2012, LAST_YEAR + 1)
+                ],
+                "created_date": "2023-01-01",
+                "updated_date": "2025-01-01T00:00:00",
+            }
+
+    sizes = part_sizes(n_authors, n_parts, rng)
+    return write_parts(entity_dir, records, sizes, partition_dates(n_dates), 0.0, rng)
+
+
+def generate_snapshot(
+    output_dir, n_works, n_authors=None, n_institutions=500, n_parts=8, n_dates=2, seed=0, invalid_rate=0.0001
+):
+    """
+    Write a synthetic snapshot with works and authors under output_dir/data.
+    n_authors: Defaults to a third of n_works.
+    Returns the directory of each entity.
+    """
+    n_authors = n_authors or max(1, n_works // 3)
+    data_dir = Path(output_dir) / "data"
+    works_dir = data_dir / "works"
+    authors_dir = data_dir / "authors"
+    generate_works(works_dir, n_works, n_authors, n_institutions, n_parts, n_dates, seed, invalid_rate)
+    generate_authors(authors_dir, n_authors, n_institutions, max(1, n_parts // 2), n_dates, seed)
+    logging.info(f"Generated {n_works} works and {n_authors} authors in {data_dir}")
+    return {"works": works_dir, "authors": authors_dir}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic OpenAlex snapshot")
+    parser.add_argument("output_dir")
+    parser.add_argument("--works", type=int, default=10_000)
+    parser.add_argument("--authors", type=int, default=None)
+    parser.add_argument("--parts", type=int, default=8)
+    parser.add_argument("--dates", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0001)
+    args = parser.parse_args()
+    generate_snapshot(
+        args.output_dir,
+        args.works,
+        args.authors,
+        n_parts=args.parts,
+        n_dates=args.dates,
+        seed=args.seed,
+        invalid_rate=args.invalid_rate,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    main()
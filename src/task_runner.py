@@ -0,0 +1,296 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import orjson
+
+from src.logs import file_issues, log_queue, worker_logging
+from src.metrics import record_metrics
+from src.profiling import ProfiledTask, merge_profiles, prepare_profile_dir, profile_settings
+from src.progress import PROGRESS_FILE, REPORT_SECONDS, Progress, start_task, task_sizes, worker_progress
+from src.resources import MemoryBudget
+
+# Attempts per task before it is marked as failed
+MAX_RETRIES = 4
+# Seconds before the first retry of a failed task; doubles with every attempt
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 300
+
+STATUS_FILE = "_task_status.jsonl"
+
+
+def task_name(key):
+    """
+    Readable name of a (file, chunk) task, as produced by src/chunking.plan_chunks.
+    """
+    file, chunk = key
+    return str(file) if chunk is None else f"{file}#chunk{chunk[0]}"
+
+
+def load_status(status_file):
+    """
+    Latest status per task name from an append-only status file.
+    """
+    status = {}
+    if status_file is None or not os.path.exists(status_file):
+        return status
+    with open(status_file, "rb") as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # partially written last line of a killed run
+            status[entry["task"]] = entry
+    return status
+
+
+def record_status(status_file, name, status, attempts, error=None):
+    if status_file is None:
+        return
+    entry = {"task": name, "status": status, "attempts": attempts, "time": time.time()}
+    if error is not None:
+        entry["error"] = error
+    with open(status_file, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+
+def init_worker(queue, progress_queue, initializer, initargs):
+    worker_logging(queue)
+    worker_progress(progress_queue)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_task(fn, name, args):
+    start_task(name)
+    # bad lines of the task are counted and summarized per file
+    with file_issues(name):
+        return fn(*args)
+
+
+def run_tasks(
+    fn,
+    tasks,
+    max_workers=None,
+    status_file=None,
+    on_done=None,
+    max_retries=MAX_RETRIES,
+    desc="Overall Progress",
+    initializer=None,
+    initargs=(),
+    metrics_file=None,
+    progress_file=None,
+):
+    """
+    Run fn(*args) for every task in a process pool with real retries.
+    tasks: dict mapping a (file, chunk) key to the argument tuple of fn.
+    max_workers: Upper bound on the workers. The pool is sized from the CPUs,
+    the available memory and the estimated memory of the tasks, and tasks are
+    held back while the memory would not hold them (see src/resources.py).
+    status_file: Append-only JSON-lines file with the status of every task. Tasks
+    recorded as done are skipped, so a rerun only does the missing work.
+    on_done: Called in the parent as on_done(key) after each task succeeds, and for
+    tasks skipped as already done (it must be idempotent).
+    initializer, initargs: Run once in every worker process, e.g. to load a
+    lookup table per worker instead of pickling it with every task. Workers log
+    through the main process's queue (see src/logs.py).
+    metrics_file: Append-only JSON-lines file the metrics a task returns (a dict,
+    see src/metrics.py) are written to.
+    progress_file: JSON-lines file the progress (records and bytes done,
+    throughput, ETA) is appended to periodically. Defaults to _progress.jsonl
+    next to the status file. Tasks are weighed by the record counts of their
+    parts in the snapshot manifests (see src/progress.py).
+    Setting PROFILE_TASKS=N in the environment profiles the first N tasks run and
+    merges their profiles when the run ends (see src/profiling.py).
+
+    A task that raises is resubmitted with exponential backoff until it has used
+    max_retries attempts. When a worker dies (e.g. OOM) the pool breaks and every
+    task in flight fails with BrokenProcessPool; the pool is then restarted and
+    those tasks are re-run together in a separate pool. If that pool breaks too,
+    they are split in halves that are re-run the same way, until the task that
+    actually crashes is alone, so it is found without charging the others an
+    attempt or running them all one at a time.
+    Returns a dict of the failed task names and their last error.
+    """
+    status = load_status(status_file)
+    if status_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(status_file)), exist_ok=True)
+    attempts = {key: 0 for key in tasks}  # failed attempts so far
+    ready_at = {}  # key -> time at which the task may be (re)submitted
+    suspects = []  # groups of tasks to run in their own pool: in flight when a pool broke, or crashers
+    crashed = set()  # tasks that crashed a worker on their own
+    failed = {}
+
+    profile = profile_settings(fn)
+    if profile is not None:
+        prepare_profile_dir(profile["profile_dir"])
+        fn = ProfiledTask(fn, **profile)
+        logging.info(f"Profiling the first {profile['n_tasks']} tasks into {profile['profile_dir']}")
+
+    if progress_file is None and status_file is not None:
+        progress_file = os.path.join(os.path.dirname(os.path.abspath(status_file)), PROGRESS_FILE)
+    progress_queue = multiprocessing.Queue()
+    sizes = {task_name(key): size for key, size in task_sizes(tasks).items()}
+    budget = MemoryBudget(sizes)
+
+    with Progress(sizes, desc, progress_file, progress_queue) as progress:
+        for key in tasks:
+            if status.get(task_name(key), {}).get("status") == "done":
+                progress.skip(task_name(key))
+                if on_done is not None:
+                    on_done(key)
+            else:
+                ready_at[key] = 0
+        if len(ready_at) < len(tasks):
+            logging.info(f"Skipping {len(tasks) - len(ready_at)} tasks already done")
+        progress.start()
+        workers = budget.pool_size(max_workers)
+
+        def new_pool(workers):
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(log_queue(), progress_queue, initializer, initargs),
+            )
+
+        pool = new_pool(workers)
+        isolated = None
+        running = {}  # future -> (key, is_isolated)
+
+        def submit(key, is_isolated):
+            executor = isolated if is_isolated else pool
+            running[executor.submit(run_task, fn, task_name(key), tasks[key])] = (key, is_isolated)
+            budget.started(task_name(key))
+
+        def admit(key):
+            # one task per worker, and only while the memory holds it
+            return len(running) < workers and budget.admit(task_name(key))
+
+        def isolated_running():
+            return [key for key, iso in running.values() if iso]
+
+        def interrupted(keys):
+            # the tasks of a broken pool, to run again without counting an attempt
+            for key in keys:
+                budget.finished(task_name(key))
+                progress.retry(task_name(key))
+
+        def fail(key, error):
+            budget.finished(task_name(key))
+            attempts[key] += 1
+            logging.error(
+                f"Failed processing file {task_name(key)} (Attempt {attempts[key]}/{max_retries}): {error}"
+            )
+            if attempts[key] >= max_retries:
+                logging.error(f"File {task_name(key)} failed after {max_retries} retries.")
+                record_status(status_file, task_name(key), "failed", attempts[key], error)
+                failed[task_name(key)] = error
+                progress.finish(task_name(key))
+            else:
+                progress.retry(task_name(key))
+                delay = min(BACKOFF_SECONDS * 2 ** (attempts[key] - 1), MAX_BACKOFF_SECONDS)
+                ready_at[key] = time.time() + delay
+
+        try:
+            while ready_at or suspects or running:
+                now = time.time()
+                # one group of suspects at a time runs in its own pool, before
+                # new tasks take the workers
+                if suspects and not isolated_running() and (
+                    not running or len(running) + len(suspects[0]) <= workers
+                ):
+                    group = suspects.pop(0)
+                    if isolated is not None:
+                        isolated.shutdown(wait=False)
+                    isolated = new_pool(len(group))
+                    for key in group:
+                        submit(key, True)
+                # largest tasks first; a task that does not fit holds back the smaller ones
+                due = [k for k, t in ready_at.items() if t <= now]
+                for key in sorted(due, key=lambda k: budget.estimate(task_name(k)), reverse=True):
+                    if key in crashed:
+                        del ready_at[key]
+                        suspects.append([key])
+                    elif admit(key):
+                        del ready_at[key]
+                        submit(key, False)
+                    else:
+                        break
+
+                if not running:
+                    time.sleep(min(REPORT_SECONDS, max(0, min(ready_at.values(), default=now) - now)))
+                    progress.refresh()
+                    continue
+                # wake up at least every REPORT_SECONDS to move the progress bar
+                timeout = REPORT_SECONDS
+                backoff = [t for t in ready_at.values() if t > now]
+                if backoff:
+                    timeout = min(timeout, max(0, min(backoff) - time.time()))
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                broken = []  # tasks of the main pool when it broke
+                broken_group = []  # tasks of the isolated pool when it broke
+                for future in done:
+                    key, is_isolated = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        if not is_isolated:
+                            broken.append(key)
+                        elif broken_group or isolated_running():
+                            broken_group.append(key)
+                        else:
+                            # crashed on its own: this task is the culprit
+                            isolated.shutdown(wait=False, cancel_futures=True)
+                            isolated = None
+                            crashed.add(key)
+                            fail(key, f"worker crashed: {e}")
+                        continue
+                    except Exception as e:
+                        fail(key, str(e))
+                        continue
+                    record_status(status_file, task_name(key), "done", attempts[key] + 1)
+                    record_metrics(metrics_file, task_name(key), result)
+                    budget.finished(task_name(key), result)
+                    progress.finish(task_name(key))
+                    if on_done is not None:
+                        on_done(key)
+
+                if broken:
+                    logging.error("Process pool broke (worker crashed), restarting it")
+                    for future, (key, is_isolated) in list(running.items()):
+                        if not is_isolated:
+                            del running[future]
+                            broken.append(key)
+                    interrupted(broken)
+                    suspects.append(broken)
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = new_pool(workers)
+                if broken_group:
+                    for future, (key, is_isolated) in list(running.items()):
+                        if is_isolated:
+                            del running[future]
+                            broken_group.append(key)
+                    interrupted(broken_group)
+                    # the crashing task is in one of the halves
+                    half = (len(broken_group) + 1) // 2
+                    logging.error(
+                        f"Pool of {len(broken_group)} suspect tasks broke, re-running them in halves"
+                    )
+                    suspects[:0] = [broken_group[:half], broken_group[half:]]
+                    isolated.shutdown(wait=False, cancel_futures=True)
+                    isolated = None
+                progress.refresh()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if isolated is not None:
+                isolated.shutdown(wait=True, cancel_futures=True)
+
+    if profile is not None:
+        merge_profiles(profile["profile_dir"])
+    if failed:
+        logging.error(f"{len(failed)} tasks failed: {sorted(failed)}")
+    return failed
@@ -0,0 +1,302 @@
+import logging
+import shutil
+from pathlib import Path
+
+import duckdb
+
+from author_features import AUTHOR_COLUMNS
+from get_and_clean_topics import DIMENSIONS
+from src.ledger import LEDGER_FILE, atomic_path, is_complete, load_ledger, record_output
+from src.logs import setup_logging
+from src.task_runner import STATUS_FILE, run_tasks
+
+# Local Directories
+snapshot_dir = Path("data/snapshot/openalex-snapshot/data")
+warehouse_dir = Path("data/warehouse")
+log_file = "process_log.log"
+
+# Setup logging
+setup_logging(log_file)
+
+MAX_RETRIES = 4
+
+# Explicit schema of the works fields the tables are built from
+WORK_COLUMNS = {
+    "id": "VARCHAR",
+    "doi": "VARCHAR",
+    "title": "VARCHAR",
+    "publication_year": "BIGINT",
+    "publication_date": "VARCHAR",
+    "type": "VARCHAR",
+    "language": "VARCHAR",
+    "cited_by_count": "BIGINT",
+    "is_retracted": "BOOLEAN",
+    "primary_location": "STRUCT(source STRUCT(id VARCHAR))",
+    "primary_topic": "STRUCT(id VARCHAR)",
+    "authorships": (
+        "STRUCT(author_position VARCHAR, author STRUCT(id VARCHAR), "
+        "institutions STRUCT(id VARCHAR)[], is_corresponding BOOLEAN)[]"
+    ),
+    "referenced_works": "VARCHAR[]",
+    "counts_by_year": "STRUCT(year BIGINT, cited_by_count BIGINT)[]",
+}
+
+# Typed, flattened tables built from each part of an entity; every query reads
+# the part through the view src
+TABLES = {
+    "works": {
+        "work": """
+            SELECT
+                id, doi, title, publication_year,
+                TRY_CAST(publication_date AS DATE) AS publication_date,
+                type, language, cited_by_count, is_retracted,
+                primary_location.source.id AS primary_source_id,
+                primary_topic.id AS primary_topic_id,
+                len(authorships) AS n_authors,
+                len(referenced_works) AS n_references
+            FROM src
+        """,
+        "authorship": """
+            SELECT
+                work_id,
+                a.author.id AS author_id,
+                CAST(position AS INTEGER) AS position,
+                a.author_position,
+                list_transform(a.institutions, i -> i.id) AS institution_ids,
+                a.is_corresponding,
+                year
+            FROM (
+                SELECT
+                    id AS work_id,
+                    publication_year AS year,
+                    UNNEST(authorships) AS a,
+                    UNNEST(generate_series(1, len(authorships))) AS position
+                FROM src
+            )
+            WHERE a.author.id IS NOT NULL
+        """,
+        "reference": """
+            SELECT citing_id, cited_id, citing_year
+            FROM (
+                SELECT
+                    id AS citing_id,
+                    UNNEST(referenced_works) AS cited_id,
+                    publication_year AS citing_year
+                FROM src
+            )
+        """,
+        "counts_by_year": """
+            SELECT work_id, c.year AS year, c.cited_by_count AS cited_by_count
+            FROM (SELECT id AS work_id, UNNEST(counts_by_year) AS c FROM src)
+        """,
+    },
+    "authors": {
+        "author": """
+            SELECT
+                id, display_name, orcid, works_count, cited_by_count,
+                summary_stats.h_index AS h_index,
+                summary_stats.i10_index AS i10_index,
+                coalesce(last_known_institutions[1].id, last_known_institution.id)
+                    AS last_known_institution_id
+            FROM src
+        """,
+    },
+}
+SCHEMAS = {"works": WORK_COLUMNS, "authors": AUTHOR_COLUMNS}
+# the dimension entities are flattened as in get_and_clean_topics.py
+for entity, table in [("sources", "source"), ("topics", "topic"), ("institutions", "institution")]:
+    TABLES[entity] = {table: f"SELECT {', '.join(DIMENSIONS[entity]['columns'])} FROM src"}
+    SCHEMAS[entity] = DIMENSIONS[entity]["schema"]
+
+# Tables whose rows belong to a work, by the column holding the work ID
+WORK_CHILD_TABLES = {"authorship": "work_id", "reference": "citing_id", "counts_by_year": "work_id"}
+
+
+def sql_path(path):
+    return str(path).replace("'", "''")
+
+
+def part_outputs(entity, part, entity_dir, output_dir, tables=None):
+    """
+    Output file of every table of a part: <table>/updated_date=X/part_NNN.parquet.
+    entity_dir: Directory of the entity's parts (e.g. <snapshot>/works).
+    tables: Only these tables of the entity (default: all).
+    """
+    relative = Path(part).relative_to(entity_dir).with_suffix(".parquet")
+    return {table: Path(output_dir) / table / relative for table in tables or TABLES[entity]}
+
+
+def read_part(conn, entity, part):
+    """
+    Load a snapshot part into the table src with the entity's explicit schema.
+    """
+    columns = ", ".join(f"'{name}': '{kind}'" for name, kind in SCHEMAS[entity].items())
+    # malformed records are skipped, as in the other stages
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TABLE src AS SELECT * FROM read_json(
+            '{sql_path(part)}', format = 'newline_delimited', compression = 'gzip',
+            columns = {{{columns}}}, ignore_errors = true
+        )
+        """
+    )
+
+
+def process_part(entity, part, entity_dir, output_dir, tables=None):
+    """
+    Convert one snapshot part into a Parquet file per table, in a single read of
+    the part. Skipped if its outputs are already in the ledger.
+    tables: Only build these tables of the entity (default: all).
+    """
+    ledger = Path(output_dir) / LEDGER_FILE
+    outputs = part_outputs(entity, part, entity_dir, output_dir, tables)
+    entries = load_ledger(ledger)
+    if all(is_complete(ledger, path, entries=entries) for path in outputs.values()):
+        logging.info(f"Part already converted: {part}")
+        return
+
+    conn = duckdb.connect(database=":memory:")
+    # parallelism comes from converting many parts at once
+    conn.execute("SET threads = 1")
+    read_part(conn, entity, part)
+    # stored as a column, so the views can keep the latest version of a record
+    partition = Path(part).parent.name
+    updated_date = "CAST(NULL AS DATE)"
+    if partition.startswith("updated_date="):
+        updated_date = f"TRY_CAST('{sql_path(partition.split('=', 1)[1])}' AS DATE)"
+    for table, output_file in outputs.items():
+        query = f"SELECT *, {updated_date} AS updated_date FROM ({TABLES[entity][table]})"
+        with atomic_path(output_file) as tmp:
+            conn.execute(f"COPY ({query}) TO '{sql_path(tmp)}' (FORMAT parquet, COMPRESSION zstd)")
+            rows = conn.execute(f"SELECT COUNT(*) FROM read_parquet('{sql_path(tmp)}')").fetchone()[0]
+        record_output(ledger, output_file, rows)
+    conn.close()
+    logging.info(f"Converted part: {part}")
+
+
+def prune_stale(entity, parts, entity_dir, output_dir, tables=None):
+    """
+    Remove converted files whose snapshot part no longer exists (e.g. an
+    updated_date partition that was dropped from the snapshot).
+    """
+    expected = set()
+    for part in parts:
+        expected.update(part_outputs(entity, part, entity_dir, output_dir, tables).values())
+    removed = 0
+    for table in tables or TABLES[entity]:
+        for path in (Path(output_dir) / table).rglob("*.parquet"):
+            if path not in expected:
+                path.unlink()
+                removed += 1
+        for partition in (Path(output_dir) / table).glob("updated_date=*"):
+            if partition.is_dir() and not any(partition.iterdir()):
+                shutil.rmtree(partition)
+    if removed:
+        logging.info(f"Removed {removed} stale {entity} files")
+
+
+def build_warehouse(
+    output_dir=warehouse_dir,
+    input_dir=snapshot_dir,
+    entities=("works", "authors", "sources", "topics", "institutions"),
+    db_path=None,
+):
+    """
+    Convert the snapshot into a Parquet lake of typed, flattened tables:
+    work, authorship, reference, counts_by_year, author, source, topic and
+    institution, each partitioned by updated_date like the snapshot. Parts are
+    converted in parallel, and only parts that are new since the last build are
+    converted, so refreshing after a snapshot sync is incremental.
+    db_path: Also (re)create a DuckDB database with views over the lake.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = {}
+    parts_per_entity = {}
+    for entity in entities:
+        parts = sorted((Path(input_dir) / entity).rglob("*.gz"))
+        parts_per_entity[entity] = parts
+        for part in parts:
+            tasks[(part, None)] = (entity, part, Path(input_dir) / entity, output_dir)
+    logging.info(f"Converting {len(tasks)} parts")
+
+    failed = run_tasks(
+        process_part,
+        tasks,
+        status_file=output_dir / STATUS_FILE,
+        max_retries=MAX_RETRIES,
+    )
+
+    for entity, parts in parts_per_entity.items():
+        prune_stale(entity, parts, Path(input_dir) / entity, output_dir)
+    if db_path is not None:
+        create_database(output_dir, db_path)
+    return failed
+
+
+def create_database(output_dir=warehouse_dir, db_path=Path("data/warehouse.duckdb")):
+    """
+    Create a DuckDB database with a view per table of the lake. A record that was
+    updated appears in several updated_date partitions; the views only keep its
+    latest version (the <table>_all views keep every version).
+    """
+    conn = duckdb.connect(str(db_path))
+    create_views(conn, output_dir)
+    conn.close()
+    logging.info(f"Created views over {output_dir} in {db_path}")
+
+
+# Order of the versions of a record, latest first
+LATEST_VERSION = "PARTITION BY id ORDER BY updated_date DESC NULLS LAST, part DESC"
+
+
+def create_views(conn, output_dir=warehouse_dir):
+    """
+    Create the views of create_database on an open DuckDB connection, for the
+    tables that exist in output_dir. The <table>_all views have a part column
+    (the part's path within the table), which breaks ties between versions with
+    the same updated_date (or none, for parts outside an updated_date=
+    directory) and matches the rows of a work's child tables to its version.
+    """
+    output_dir = Path(output_dir)
+    tables = [t for entity in TABLES.values() for t in entity]
+    for table in tables:
+        files = output_dir / table / "**" / "*.parquet"
+        if not list((output_dir / table).rglob("*.parquet")):
+            continue
+        conn.execute(
+            f"""
+            CREATE OR REPLACE VIEW {table}_all AS
+            SELECT * EXCLUDE (filename), regexp_extract(filename, '.*/{table}/(.*)$', 1) AS part
+            FROM read_parquet('{sql_path(files)}', hive_partitioning = false, filename = true)
+            """
+        )
+        if table in WORK_CHILD_TABLES:
+            continue
+        conn.execute(
+            f"""
+            CREATE OR REPLACE VIEW {table} AS
+            SELECT * EXCLUDE (part) FROM {table}_all
+            QUALIFY row_number() OVER ({LATEST_VERSION}) = 1
+            """
+        )
+    for table, work_col in WORK_CHILD_TABLES.items():
+        if not list((output_dir / table).rglob("*.parquet")):
+            continue
+        # updated_date can be NULL, so the version is matched by part
+        conn.execute(
+            f"""
+            CREATE OR REPLACE VIEW {table} AS
+            SELECT t.* EXCLUDE (part) FROM {table}_all t
+            SEMI JOIN (
+                SELECT id, part FROM work_all
+                QUALIFY row_number() OVER ({LATEST_VERSION}) = 1
+            ) w ON t.{work_col} = w.id AND t.part = w.part
+            """
+        )
+
+
+# Example
+if __name__ == "__main__":
+    build_warehouse(db_path=Path("data/warehouse.duckdb"))